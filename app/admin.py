@@ -1,8 +1,55 @@
+import csv
+
+from django import forms
+from django.conf.urls import url
 from django.contrib import admin
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.db import transaction
+from django.urls import reverse
+from django.utils.html import format_html
 
 from .models import CampaignList
 from .models import CampaignSubscriber
+from .models import ImportJob
+from .models import ProfilingConfig
+from .models import RequestProfile
 from .models import SubscriberCreationForm
+from .models import UpstreamOperation
+
+from .cache import invalidate
+from .cache import invalidate_lists
+
+from .counters import recount
+
+from .search import search
+
+from .imports import read_upload
+from .imports import save_upload
+from .imports import start_job
+
+from . import deletion
+from . import outbox
+
+
+def queue_memberships(added, removed):
+    """Queue membership changes made in the admin to be sent upstream.
+
+    The changes are stored in the outbox within the transaction of the admin
+    view, so that they are sent, retried and reported as failed alongside
+    those made anywhere else. See `.outbox`.
+
+    Arguments:
+        added       the (list, subscriber) pairs subscribed
+        removed     the (list, subscriber) pairs unsubscribed
+
+    """
+    outbox.enqueue_many(UpstreamOperation.SUBSCRIBE, [
+        (clist.external_id, sub.email, sub.name) for clist, sub in added
+    ])
+    outbox.enqueue_many(UpstreamOperation.UNSUBSCRIBE, [
+        (clist.external_id, sub.email, '') for clist, sub in removed
+    ])
 
 
 class CampaignListInline(admin.TabularInline):
@@ -34,21 +81,28 @@ class CampaignListAdmin(admin.ModelAdmin):
 
     readonly_fields = ('name', 'client', 'external_id', )
 
+    def get_queryset(self, request):
+        queryset = super(CampaignListAdmin, self).get_queryset(request)
+        return queryset.prefetch_related('counters')
+
     def subscribers(self, clist):
-        return clist.campaignsubscriber_set.count()
+        return clist.subscriber_count
 
     def active(self, clist):
-        return clist.campaignsubscriber_set.filter(state='Active').count()
+        return clist.state_counts.get('Active', 0)
 
     def purge(self, request, queryset):
-        for clist in queryset:
-            for sub in clist.campaignsubscriber_set.all():
-                sub.delete()
+        total, deleted = deletion.purge_lists(queryset)
+        self.message_user(request, 'Deleted %d subscriber(s), whose upstream '
+                          'removal has been queued' % deleted.get(
+                              CampaignSubscriber._meta.label, 0))
     purge.short_description = 'Delete subscribers (only)'
 
     def delete_selected(self, request, queryset):
-        for clist in queryset:
-            clist.delete()
+        total, deleted = deletion.delete_lists(queryset)
+        self.message_user(request, 'Deleted %d list(s), whose subscribers\' '
+                          'upstream removal has been queued' % deleted.get(
+                              CampaignList._meta.label, 0))
     delete_selected.short_description = 'Delete lists'
 
     def save_related(self, request, form, formsets, change):
@@ -57,13 +111,14 @@ class CampaignListAdmin(admin.ModelAdmin):
                                                     change)
         new_subs = set(form.instance.campaignsubscriber_set.all())
         # Calculate the diff of subscribers prior to and after the update
-        # operation (using a logical XOR) in order to update the upstream
-        # subscription list.
-        for sub in (old_subs ^ new_subs):
-            if sub in new_subs:
-                form.instance.subscribe(sub)
-            if sub in old_subs:
-                form.instance.unsubscribe(sub)
+        # operation in order to update the upstream subscription list in
+        # bulk.
+        clist = form.instance
+        queue_memberships([(clist, sub) for sub in new_subs - old_subs],
+                          [(clist, sub) for sub in old_subs - new_subs])
+        # The inline formset edits the m2m through table directly.
+        recount([form.instance])
+        invalidate(form.instance.client.external_id)
 
     def has_add_permission(self, request, obj=None):
         return False
@@ -95,20 +150,27 @@ class CampaignSubscriberAdmin(admin.ModelAdmin):
     list_display = ('name', 'email', 'state', )
     list_display_links = ('email', )
 
+    def get_search_results(self, request, queryset, search_term):
+        """Search through the subscribers' index, see `.search`."""
+        return search(queryset, search_term), False
+
     def save_related(self, request, form, formsets, change):
         old_lists = set(form.instance.lists.all())
         super(CampaignSubscriberAdmin, self).save_related(request, form,
                                                           formsets, change)
         new_lists = set(form.instance.lists.all())
-        for clist in (old_lists ^ new_lists):
-            if clist in new_lists:
-                clist.subscribe(form.instance)
-            if clist in old_lists:
-                clist.unsubscribe(form.instance)
+        sub = form.instance
+        queue_memberships([(clist, sub) for clist in new_lists - old_lists],
+                          [(clist, sub) for clist in old_lists - new_lists])
+        # The inline formset edits the m2m through table directly.
+        recount(old_lists | new_lists)
+        invalidate_lists(old_lists | new_lists)
 
     def delete_selected(self, request, queryset):
-        for subscriber in queryset:
-            subscriber.delete()
+        total, deleted = deletion.delete_subscribers(queryset)
+        self.message_user(request, 'Deleted %d subscriber(s), whose upstream '
+                          'removal has been queued' % deleted.get(
+                              CampaignSubscriber._meta.label, 0))
     delete_selected.short_description = 'Delete'
 
     def get_readonly_fields(self, request, obj=None):
@@ -118,5 +180,151 @@ class CampaignSubscriberAdmin(admin.ModelAdmin):
         return readonly_fields
 
 
+class UpstreamOperationAdmin(admin.ModelAdmin):
+
+    list_display = ('__str__', 'created_at', 'attempts', 'next_attempt_at',
+                    'failed', 'last_error', )
+    list_filter = ('failed', 'action', )
+    search_fields = ('email', 'list_id', )
+
+    actions = ('retry', )
+
+    readonly_fields = ('action', 'list_id', 'email', 'name', 'created_at',
+                       'next_attempt_at', 'attempts', 'failed',
+                       'last_error', )
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+    def retry(self, request, queryset):
+        count = outbox.retry(queryset)
+        self.message_user(request, 'Queued %d failed operation(s) to be '
+                          'sent again' % count)
+    retry.short_description = 'Retry failed operations'
+
+
+class ProfilingConfigAdmin(admin.ModelAdmin):
+
+    list_display = ('__str__', 'sample_rate', 'path_prefix', )
+
+    def has_add_permission(self, request, obj=None):
+        # Only the first config is taken into account.
+        return not ProfilingConfig.objects.exists()
+
+
+class RequestProfileAdmin(admin.ModelAdmin):
+
+    list_display = ('created_at', 'method', 'path', 'status', 'duration',
+                    'queries', 'trigger', 'download', )
+    list_filter = ('trigger', 'status', )
+    search_fields = ('path', )
+
+    fields = ('created_at', 'method', 'path', 'status', 'duration',
+              'trigger', 'queries', 'download', 'summary_text', 'sql_text', )
+    readonly_fields = fields
+
+    def get_urls(self):
+        return [
+            url(r'^(?P<pk>\d+)/download/$',
+                self.admin_site.admin_view(self.download_view),
+                name='app_requestprofile_download'),
+        ] + super(RequestProfileAdmin, self).get_urls()
+
+    def download_view(self, request, pk):
+        """Return the profile as a file loadable by `pstats`."""
+        profile = get_object_or_404(RequestProfile, pk=pk)
+        response = HttpResponse(bytes(profile.stats),
+                                content_type='application/octet-stream')
+        response['Content-Disposition'] = (
+            'attachment; filename="request-%d.prof"' % profile.pk
+        )
+        return response
+
+    def download(self, profile):
+        return format_html('<a href="{}">request-{}.prof</a>', reverse(
+            'admin:app_requestprofile_download', args=(profile.pk, )
+        ), profile.pk)
+
+    def summary_text(self, profile):
+        return format_html('<pre>{}</pre>', profile.summary)
+    summary_text.short_description = 'Summary'
+
+    def sql_text(self, profile):
+        return format_html('<pre>{}</pre>', profile.sql)
+    sql_text.short_description = 'SQL'
+
+    def has_add_permission(self, request, obj=None):
+        return False
+
+
+class ImportJobForm(forms.ModelForm):
+    """A form uploading a CSV file of subscribers to import into a list."""
+
+    file = forms.FileField(help_text='A CSV file with an "email" and, '
+                                     'optionally, a "name" column.')
+
+    class Meta:
+        model = ImportJob
+        fields = ('clist', )
+
+    def clean_file(self):
+        # The upload is only stored once the job is saved, so that invalid
+        # ones leave no files behind.
+        upload = self.cleaned_data['file']
+        try:
+            self.total_rows = sum(1 for row in read_upload(upload))
+        except (UnicodeDecodeError, csv.Error) as exc:
+            raise forms.ValidationError('Invalid CSV file: %s' % exc)
+        return upload
+
+
+class ImportJobAdmin(admin.ModelAdmin):
+
+    list_display = ('__str__', 'status', 'progress', 'rows_processed',
+                    'total_rows', 'imported', 'skipped', 'updated_at', )
+    list_filter = ('status', )
+
+    actions = ('resume', )
+
+    readonly_fields = ('clist', 'path', 'status', 'total_rows',
+                       'rows_processed', 'imported', 'skipped',
+                       'last_error', 'created_at', 'updated_at', )
+
+    def get_form(self, request, obj=None, **kwargs):
+        if obj is None:
+            kwargs['form'] = ImportJobForm
+        return super(ImportJobAdmin, self).get_form(request, obj, **kwargs)
+
+    def get_fields(self, request, obj=None):
+        if obj is None:
+            return ('clist', 'file', )
+        return self.readonly_fields
+
+    def get_readonly_fields(self, request, obj=None):
+        return self.readonly_fields if obj is not None else ()
+
+    def progress(self, job):
+        return '%d%%' % job.progress
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            obj.path = save_upload(form.cleaned_data['file'])
+            obj.total_rows = form.total_rows
+        super(ImportJobAdmin, self).save_model(request, obj, form, change)
+        if not change:
+            transaction.on_commit(lambda: start_job(obj.pk))
+
+    def resume(self, request, queryset):
+        jobs = list(queryset.exclude(status=ImportJob.DONE))
+        for job in jobs:
+            start_job(job.pk)
+        self.message_user(request, 'Resumed %d import(s)' % len(jobs))
+    resume.short_description = 'Resume unfinished imports'
+
+
 admin.site.register(CampaignList, CampaignListAdmin)
 admin.site.register(CampaignSubscriber, CampaignSubscriberAdmin)
+admin.site.register(ProfilingConfig, ProfilingConfigAdmin)
+admin.site.register(RequestProfile, RequestProfileAdmin)
+admin.site.register(ImportJob, ImportJobAdmin)
+admin.site.register(UpstreamOperation, UpstreamOperationAdmin)
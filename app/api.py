@@ -0,0 +1,245 @@
+"""A read-only JSON API over the locally stored clients, lists and subscribers.
+
+Collections are paginated by keyset: each page is ordered by an indexed key
+and links to the next one with an opaque cursor holding the last key served,
+so that every page costs the same, however deep into a collection it is.
+Responses carry an ETag, and conditional requests for an unchanged page get
+a 304 response.
+
+"""
+
+import json
+import base64
+import hashlib
+import binascii
+
+from django.conf import settings
+from django.http import JsonResponse
+from django.http import StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.views.generic import View
+
+from .models import STATES
+from .models import CampaignList
+from .models import CampaignClient
+from .models import CampaignSubscriber
+from .models import CampaignListCounter
+
+from .export import FORMATS
+from .export import export
+
+from .search import search
+
+
+class BadRequest(Exception):
+    """Raised for invalid query parameters."""
+
+
+def encode_cursor(key):
+    """Return the opaque cursor of a page starting after `key`."""
+    data = json.dumps(key).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return the key encoded in `cursor` by `encode_cursor`."""
+    try:
+        data = base64.urlsafe_b64decode(str(cursor + '=' * (-len(cursor) % 4)))
+        key = json.loads(data.decode('utf-8'))
+    except (TypeError, ValueError, binascii.Error):
+        raise BadRequest('Invalid cursor')
+    if not isinstance(key, int):
+        raise BadRequest('Invalid cursor')
+    return key
+
+
+class APIView(View):
+    """A JSON view of a single resource or a page of a collection."""
+
+    http_method_names = ['get', 'head']
+
+    def get(self, request, *args, **kwargs):
+        try:
+            data = self.get_data(request, **kwargs)
+        except BadRequest as exc:
+            return JsonResponse({'error': str(exc)}, status=400)
+        except (CampaignClient.DoesNotExist, CampaignList.DoesNotExist):
+            return JsonResponse({'error': 'Not found'}, status=404)
+        response = JsonResponse(data)
+        etag = 'W/"%s"' % hashlib.md5(response.content).hexdigest()
+        conditional = get_conditional_response(request, etag=etag)
+        if conditional is not None:
+            response = conditional
+        response['ETag'] = etag
+        return response
+
+    def get_data(self, request, **kwargs):
+        raise NotImplementedError
+
+    def paginate(self, request, queryset, key, serialize):
+        """Return a page of `queryset`, which is ordered by `key`.
+
+        Arguments:
+            request     the request, holding the "cursor" and "limit"
+                        query parameters
+            queryset    the queryset of the whole collection, ordered
+                        by `key` and evaluated into dicts
+            key         the name of the indexed integer field to order by
+            serialize   a function serializing each item of `queryset`
+
+        """
+        try:
+            limit = int(request.GET.get('limit', settings.API_PAGE_SIZE))
+        except ValueError:
+            raise BadRequest('Invalid limit')
+        if not 0 < limit <= settings.API_MAX_PAGE_SIZE:
+            raise BadRequest('The limit must be from 1 to %d' %
+                             settings.API_MAX_PAGE_SIZE)
+        cursor = request.GET.get('cursor')
+        if cursor:
+            queryset = queryset.filter(**{
+                '%s__gt' % key: decode_cursor(cursor)
+            })
+        # Fetch an extra item, to tell whether there is a next page.
+        items = list(queryset[:limit + 1])
+        next_url = None
+        if len(items) > limit:
+            items = items[:limit]
+            params = request.GET.copy()
+            params['cursor'] = encode_cursor(items[-1][key])
+            next_url = request.build_absolute_uri(
+                '%s?%s' % (request.path, params.urlencode())
+            )
+        return {'results': [serialize(item) for item in items],
+                'next': next_url}
+
+
+class ClientDetail(APIView):
+    """Return the details of a client."""
+
+    def get_data(self, request, client_id):
+        client = CampaignClient.objects.get(external_id=client_id)
+        return {'id': client.external_id,
+                'name': client.name,
+                'email': client.email,
+                'company': client.company,
+                'country': client.country,
+                'synced_at': client.synced_at}
+
+
+class ClientLists(APIView):
+    """Return a page of a client's lists, with their subscriber counts."""
+
+    def get_data(self, request, client_id):
+        client = CampaignClient.objects.get(external_id=client_id)
+        lists = client.campaignlist_set.order_by('pk').values(
+            'pk', 'external_id', 'name', 'synced_at'
+        )
+        page = self.paginate(request, lists, 'pk', lambda clist: clist)
+        counts = {}
+        for counter in CampaignListCounter.objects.filter(
+            clist__in=[clist['pk'] for clist in page['results']]
+        ).values('clist', 'state', 'count'):
+            counts.setdefault(counter['clist'], {})[counter['state']] = (
+                counter['count']
+            )
+        page['results'] = [
+            {'id': clist['external_id'],
+             'name': clist['name'],
+             'synced_at': clist['synced_at'],
+             'subscribers': sum(counts.get(clist['pk'], {}).values()),
+             'states': counts.get(clist['pk'], {})}
+            for clist in page['results']
+        ]
+        return page
+
+
+class ListSubscribers(APIView):
+    """Return a page of a list's subscribers, optionally of a given state.
+
+    Subscribers are paged through the list's memberships, in the order of
+    the index on the membership table.
+
+    """
+
+    def get_data(self, request, client_id, list_id):
+        clist = CampaignList.objects.get(client__external_id=client_id,
+                                         external_id=list_id)
+        memberships = CampaignSubscriber.lists.through.objects.filter(
+            campaignlist=clist
+        )
+        state = request.GET.get('state')
+        if state:
+            if state not in dict(STATES):
+                raise BadRequest('Invalid state')
+            memberships = memberships.filter(campaignsubscriber__state=state)
+        memberships = memberships.order_by('campaignsubscriber_id').values(
+            'campaignsubscriber_id', 'campaignsubscriber__email',
+            'campaignsubscriber__name', 'campaignsubscriber__state',
+        )
+        return self.paginate(
+            request, memberships, 'campaignsubscriber_id',
+            lambda membership: {
+                'email': membership['campaignsubscriber__email'],
+                'name': membership['campaignsubscriber__name'],
+                'state': membership['campaignsubscriber__state'],
+            },
+        )
+
+
+class SearchSubscribers(APIView):
+    """Return a page of a client's subscribers matching a search query.
+
+    The "q" query parameter holds the terms to search for in the e-mail
+    addresses and names of subscribers, see `.search`.
+
+    """
+
+    def get_data(self, request, client_id):
+        client = CampaignClient.objects.get(external_id=client_id)
+        query = request.GET.get('q', '').strip()
+        if not query:
+            raise BadRequest('Missing search query')
+        subscribers = search(CampaignSubscriber.objects.filter(
+            pk__in=CampaignSubscriber.lists.through.objects.filter(
+                campaignlist__client=client
+            ).values('campaignsubscriber_id')
+        ), query).order_by('pk').values('pk', 'email', 'name', 'state')
+        return self.paginate(
+            request, subscribers, 'pk',
+            lambda subscriber: {'email': subscriber['email'],
+                                'name': subscriber['name'],
+                                'state': subscriber['state']},
+        )
+
+
+class ClientExport(View):
+    """Stream the subscriptions of a client as NDJSON or CSV.
+
+    The "format" query parameter selects either "ndjson", the default, or
+    "csv". The "list" and "state" query parameters filter subscriptions by
+    ListID and state, and "gzip=1" compresses the export.
+
+    """
+
+    http_method_names = ['get']
+
+    def get(self, request, client_id):
+        if not CampaignClient.objects.filter(external_id=client_id).exists():
+            return JsonResponse({'error': 'Not found'}, status=404)
+        fmt = request.GET.get('format', 'ndjson')
+        if fmt not in FORMATS:
+            return JsonResponse({'error': 'Invalid format'}, status=400)
+        state = request.GET.get('state')
+        if state and state not in dict(STATES):
+            return JsonResponse({'error': 'Invalid state'}, status=400)
+        compress = request.GET.get('gzip') in ('1', 'true')
+        response = StreamingHttpResponse(
+            export(fmt, compress, client_id=client_id,
+                   list_id=request.GET.get('list'), state=state),
+            content_type='application/gzip' if compress else FORMATS[fmt],
+        )
+        response['Content-Disposition'] = 'attachment; filename="%s.%s%s"' % (
+            client_id, fmt, '.gz' if compress else ''
+        )
+        return response
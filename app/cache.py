@@ -0,0 +1,94 @@
+"""Caching of rendered client pages."""
+
+import time
+import hashlib
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.utils.http import http_date
+from django.utils.cache import get_conditional_response
+
+
+# Rendered in place of the CSRF token of cached pages, so that each visitor
+# gets their own token when the page is served.
+CSRF_PLACEHOLDER = '__csrf_token__'
+
+
+def _key(client_id):
+    return 'client-page:%s' % client_id
+
+
+def get_page(client_id):
+    """Return the cached page of a client, or None if not cached.
+
+    Arguments:
+        client_id   the ClientID assigned by Campaign Monitoring
+
+    """
+    return caches['pages'].get(_key(client_id))
+
+
+def set_page(client_id, content):
+    """Cache the rendered page of a client and return the cache entry.
+
+    Arguments:
+        client_id   the ClientID assigned by Campaign Monitoring
+        content     the page's content, rendered with `CSRF_PLACEHOLDER`
+                    as the CSRF token
+
+    """
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    page = {
+        'content': content,
+        'etag': 'W/"%s"' % hashlib.md5(content.encode('utf-8')).hexdigest(),
+        'last_modified': int(time.time()),
+    }
+    caches['pages'].set(_key(client_id), page, settings.PAGE_CACHE_TIMEOUT)
+    return page
+
+
+def page_response(request, page):
+    """Serve a cached page, or a 304 if the visitor's copy is up to date."""
+    response = get_conditional_response(request, etag=page['etag'],
+                                        last_modified=page['last_modified'])
+    if response is None:
+        response = HttpResponse(
+            page['content'].replace(CSRF_PLACEHOLDER, get_token(request))
+        )
+    response['ETag'] = page['etag']
+    response['Last-Modified'] = http_date(page['last_modified'])
+    return response
+
+
+def invalidate(*client_ids):
+    """Drop the cached pages of the specified clients.
+
+    Within a transaction, the pages are dropped once it commits, so that a
+    concurrent request cannot cache a page rendered from the data as it was
+    before the commit. Outside of a transaction, they are dropped at once.
+
+    Arguments:
+        client_ids  the ClientIDs assigned by Campaign Monitoring
+
+    """
+    keys = [_key(client_id) for client_id in client_ids]
+    if keys:
+        transaction.on_commit(lambda: caches['pages'].delete_many(keys))
+
+
+def invalidate_lists(clists):
+    """Drop the cached pages of the clients owning the specified lists.
+
+    Arguments:
+        clists  an iterable or queryset of `.models.CampaignList`
+
+    """
+    from .models import CampaignClient
+    client_ids = CampaignClient.objects.filter(
+        campaignlist__in=clists
+    ).values_list('external_id', flat=True).distinct()
+    invalidate(*list(client_ids))
@@ -0,0 +1,95 @@
+"""Incremental maintenance of per-list subscriber counts by state.
+
+Each `.models.CampaignListCounter` holds the number of subscribers of a list
+in a given state. Counters are adjusted as subscriptions are added and
+removed, and as subscribers change state, so that the size of a list can be
+read without scanning its subscriptions.
+
+"""
+
+from collections import Counter
+
+from django.db import IntegrityError
+from django.db import transaction
+from django.db.models import F
+from django.db.models import Count
+
+
+def tally(**filters):
+    """Count subscriptions by list and subscriber state.
+
+    Arguments:
+        filters     lookups to filter the m2m through table with
+
+    Returns a `Counter` keyed by (list pk, state) pairs.
+
+    """
+    from .models import CampaignSubscriber
+    membership = CampaignSubscriber.lists.through
+    rows = membership.objects.filter(**filters).values(
+        'campaignlist_id', 'campaignsubscriber__state'
+    ).annotate(n=Count('pk')).order_by()
+    return Counter({
+        (row['campaignlist_id'], row['campaignsubscriber__state']): row['n']
+        for row in rows
+    })
+
+
+def update(deltas, sign=1):
+    """Add `deltas` to the corresponding counters, creating missing ones.
+
+    Arguments:
+        deltas  a mapping of (list pk, state) pairs to the count to add
+        sign    -1 to subtract `deltas` instead
+
+    """
+    from .models import CampaignListCounter
+    for (list_id, state), delta in deltas.items():
+        delta *= sign
+        if not delta:
+            continue
+        counters = CampaignListCounter.objects.filter(clist_id=list_id,
+                                                      state=state)
+        if counters.update(count=F('count') + delta):
+            continue
+        try:
+            with transaction.atomic():
+                CampaignListCounter.objects.create(clist_id=list_id,
+                                                   state=state, count=delta)
+        except IntegrityError:
+            # Created concurrently in the mean time.
+            counters.update(count=F('count') + delta)
+
+
+def transition(subscriber, old_state, new_state):
+    """Move a subscriber's subscriptions from one state's counters to another.
+
+    Arguments:
+        subscriber  an instance of `.models.CampaignSubscriber`
+        old_state   the subscriber's previous state
+        new_state   the subscriber's current state
+
+    """
+    deltas = Counter()
+    for list_id in subscriber.lists.values_list('pk', flat=True):
+        deltas[(list_id, old_state)] -= 1
+        deltas[(list_id, new_state)] += 1
+    update(deltas)
+
+
+def recount(clists):
+    """Recompute the counters of the specified lists from scratch.
+
+    Arguments:
+        clists  an iterable or queryset of `.models.CampaignList`
+
+    """
+    from .models import CampaignListCounter
+    with transaction.atomic():
+        CampaignListCounter.objects.filter(clist__in=clists).delete()
+        CampaignListCounter.objects.bulk_create([
+            CampaignListCounter(clist_id=list_id, state=state, count=count)
+            for (list_id, state), count in tally(
+                campaignlist__in=clists
+            ).items()
+        ])
@@ -0,0 +1,160 @@
+"""Set-based deletion of clients, lists and subscribers.
+
+Deletions run a few queryset-level queries per batch within a single
+transaction, instead of deleting objects one by one. The corresponding
+upstream removals are queued in the outbox, from where they are sent in
+batches by `manage.py drain-outbox`, which reports its progress and picks
+up where it left off if interrupted.
+
+"""
+
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+
+from .cache import invalidate
+from .cache import invalidate_lists
+from .utils import chunked
+from .outbox import enqueue_many
+from .counters import recount
+
+
+def _raw_delete(queryset):
+    """Delete the rows matched by `queryset` with a single query.
+
+    Unlike `QuerySet.delete`, objects are not loaded in memory and no
+    signals are sent, so counters and caches are left to the caller.
+
+    Returns the number of rows deleted, and the number per model, as
+    `QuerySet.delete` does.
+
+    """
+    count = queryset._raw_delete(queryset.db)
+    return count, {queryset.model._meta.label: count}
+
+
+def _merge(*deletions):
+    """Sum the (total, per model) counts returned by deletions."""
+    counts = Counter()
+    for total, per_model in deletions:
+        counts.update(per_model)
+    return sum(counts.values()), dict(counts)
+
+
+def _unsubscribe(memberships):
+    """Queue the upstream removal of the specified subscriptions."""
+    from .models import UpstreamOperation
+    subscriptions = memberships.values_list('campaignlist__external_id',
+                                            'campaignsubscriber__email')
+    enqueue_many(UpstreamOperation.UNSUBSCRIBE,
+                 ((list_id, email, '') for list_id, email in subscriptions))
+
+
+def delete_subscribers(subscribers):
+    """Delete subscribers both locally and remotely.
+
+    Subscribers are deleted in batches of `settings.SYNC_BATCH_SIZE`, while
+    their removal from all of their lists is queued to be sent upstream.
+
+    Arguments:
+        subscribers     a queryset of `.models.CampaignSubscriber`
+
+    Returns the number of rows deleted, and the number per model, as
+    `QuerySet.delete` does.
+
+    """
+    from .models import CampaignList
+    from .models import CampaignSubscriber
+    membership = CampaignSubscriber.lists.through
+    db = subscribers.db
+    pks = list(subscribers.values_list('pk', flat=True))
+    list_ids = set()
+    deleted = []
+    with transaction.atomic(using=db):
+        for chunk in chunked(pks, settings.SYNC_BATCH_SIZE):
+            memberships = membership.objects.using(db).filter(
+                campaignsubscriber__in=chunk
+            )
+            list_ids.update(memberships.values_list('campaignlist_id',
+                                                    flat=True))
+            _unsubscribe(memberships)
+            deleted.append(_raw_delete(memberships))
+            deleted.append(_raw_delete(
+                CampaignSubscriber.objects.using(db).filter(pk__in=chunk)
+            ))
+        clists = list(CampaignList.objects.using(db).filter(pk__in=list_ids))
+        recount(clists)
+    invalidate_lists(clists)
+    return _merge(*deleted)
+
+
+def purge_lists(clists):
+    """Delete all subscribers of the specified lists.
+
+    Arguments:
+        clists  a queryset of `.models.CampaignList`
+
+    Returns the number of rows deleted, and the number per model, as
+    `QuerySet.delete` does.
+
+    """
+    from .models import CampaignSubscriber
+    return delete_subscribers(
+        CampaignSubscriber.objects.using(clists.db).filter(
+            lists__in=clists
+        ).distinct()
+    )
+
+
+def delete_lists(clists):
+    """Delete lists and queue the upstream removal of their subscribers.
+
+    The subscribers themselves are kept locally.
+
+    Arguments:
+        clists  a queryset of `.models.CampaignList`
+
+    Returns the number of rows deleted, and the number per model, as
+    `QuerySet.delete` does.
+
+    """
+    from .models import CampaignClient
+    from .models import CampaignSubscriber
+    membership = CampaignSubscriber.lists.through
+    db = clists.db
+    client_ids = list(CampaignClient.objects.using(db).filter(
+        campaignlist__in=clists
+    ).values_list('external_id', flat=True).distinct())
+    with transaction.atomic(using=db):
+        memberships = membership.objects.using(db).filter(
+            campaignlist__in=clists
+        )
+        _unsubscribe(memberships)
+        deleted = _merge(_raw_delete(memberships), clists.delete())
+    invalidate(*client_ids)
+    return deleted
+
+
+def delete_clients(clients):
+    """Delete clients alongside all of their lists and subscribers.
+
+    Arguments:
+        clients     a queryset of `.models.CampaignClient`
+
+    Returns the number of rows deleted, and the number per model, as
+    `QuerySet.delete` does.
+
+    """
+    from .models import CampaignList
+    db = clients.db
+    client_ids = list(clients.values_list('external_id', flat=True))
+    with transaction.atomic(using=db):
+        deleted = _merge(
+            purge_lists(CampaignList.objects.using(db).filter(
+                client__in=clients
+            )),
+            clients.delete(),
+        )
+    invalidate(*client_ids)
+    return deleted
@@ -0,0 +1,116 @@
+"""Streaming exports of subscriptions, as NDJSON or CSV.
+
+Subscriptions are read through a single, ordered query, whose rows are
+fetched from a server-side cursor where the db supports it, and in chunks
+otherwise, so that exports of any size run in constant memory. Rows are
+serialized and, optionally, gzip-compressed on the fly, and yielded in
+buffers of about `BUFFER_SIZE` bytes.
+
+"""
+
+import csv
+import json
+import zlib
+
+from django.utils import six
+
+
+# The columns of every exported row.
+FIELDS = ('list_id', 'email', 'name', 'state', )
+
+# The approximate size of every chunk yielded, in bytes.
+BUFFER_SIZE = 64 * 1024
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def subscriptions(client_id=None, list_id=None, state=None):
+    """Yield the (ListID, email, name, state) of subscriptions.
+
+    Arguments:
+        client_id   if given, the ClientID of the client to export
+        list_id     if given, the ListID of the list to export
+        state       if given, the state of the subscribers to export
+
+    """
+    from .models import CampaignSubscriber
+    memberships = CampaignSubscriber.lists.through.objects.all()
+    if client_id:
+        memberships = memberships.filter(
+            campaignlist__client__external_id=client_id
+        )
+    if list_id:
+        memberships = memberships.filter(campaignlist__external_id=list_id)
+    if state:
+        memberships = memberships.filter(campaignsubscriber__state=state)
+    return memberships.order_by(
+        'campaignlist_id', 'campaignsubscriber_id'
+    ).values_list(
+        'campaignlist__external_id', 'campaignsubscriber__email',
+        'campaignsubscriber__name', 'campaignsubscriber__state',
+    ).iterator()
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(FIELDS, row))) + '\n'
+
+
+class _Echo(object):
+    """A file-like object returning, instead of writing, what is written."""
+
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(FIELDS)
+    for row in rows:
+        if six.PY2:
+            row = [value.encode('utf-8') for value in row]
+        yield writer.writerow(row)
+
+
+def buffered(lines):
+    """Join lines into byte strings of about `BUFFER_SIZE` bytes."""
+    buf, size = [], 0
+    for line in lines:
+        if not isinstance(line, bytes):
+            line = line.encode('utf-8')
+        buf.append(line)
+        size += len(line)
+        if size >= BUFFER_SIZE:
+            yield b''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield b''.join(buf)
+
+
+def gzipped(chunks):
+    """Compress byte strings into a gzip stream, on the fly."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def export(format='ndjson', compress=False, **filters):
+    """Yield the chunks of an export of the subscriptions matching `filters`.
+
+    Arguments:
+        format      either "ndjson" or "csv"
+        compress    whether to gzip the export
+        filters     the filters of `subscriptions`
+
+    """
+    if format not in FORMATS:
+        raise ValueError('Unknown format: %s' % format)
+    lines = {'ndjson': ndjson_lines, 'csv': csv_lines}[format]
+    chunks = buffered(lines(subscriptions(**filters)))
+    return gzipped(chunks) if compress else chunks
@@ -0,0 +1,529 @@
+"""A local stand-in for the parts of the createsend API used by `.upstream`.
+
+The fake API serves client details, client lists, paged subscribers of every
+status, and accepts subscribers being added, deleted and imported, all over
+plain HTTP. Its clients are synthetic: the subscribers of each list are
+generated on the fly, page by page, so that clients with millions of them
+cost no memory. Every response may be delayed, to simulate network latency.
+
+Lists may have webhooks registered, to which the changes of their
+subscribers are POSTed in batches by a `FakeWebhookSender`, which may also
+make up changes at a given rate.
+
+Point the app to it by setting `settings.CREATESEND_BASE_URI` to the
+`base_uri` of a running `FakeServer`, e.g. one started by
+`manage.py fake-createsend`.
+
+"""
+
+import re
+import sys
+import json
+import time
+import random
+import socket
+import hashlib
+import logging
+import threading
+
+from collections import deque
+from collections import Counter
+from collections import OrderedDict
+
+from django.utils.six.moves import socketserver
+from django.utils.six.moves import BaseHTTPServer
+from django.utils.six.moves.urllib.parse import parse_qs
+from django.utils.six.moves.urllib.parse import urlparse
+from django.utils.six.moves.urllib.request import Request
+from django.utils.six.moves.urllib.request import urlopen
+
+
+log = logging.getLogger(__name__)
+
+
+# The share of each list's subscribers in each status.
+SHARES = OrderedDict((('active', 0.9),
+                      ('bounced', 0.02),
+                      ('deleted', 0.02),
+                      ('unconfirmed', 0.02),
+                      ('unsubscribed', 0.04)))
+
+# The path all API endpoints are served under.
+BASE_PATH = '/api/v3.1'
+
+# The date of every generated subscriber.
+DATE = '2017-01-01 00:00:00'
+
+# The most events POSTed to a webhook at once.
+WEBHOOK_BATCH_SIZE = 1000
+
+
+def external_id(*parts):
+    """Return a deterministic, 32 character ID derived from `parts`."""
+    key = ':'.join(str(part) for part in parts)
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+def parse_size(size):
+    """Parse a number of subscribers such as "10000", "100k" or "1m"."""
+    size = str(size).strip().lower()
+    multiplier = {'k': 1000, 'm': 1000000}.get(size[-1:], 1)
+    if multiplier > 1:
+        size = size[:-1]
+    return int(float(size) * multiplier)
+
+
+def format_size(size):
+    """Format a number of subscribers as e.g. "100k" or "1m"."""
+    for suffix, multiplier in (('m', 1000000), ('k', 1000)):
+        if size >= multiplier and not size % multiplier:
+            return '%d%s' % (size // multiplier, suffix)
+    return str(size)
+
+
+class FakeList(object):
+    """A synthetic campaign list, with subscribers generated on the fly.
+
+    Subscribers added, deleted or imported are kept in memory, on top of
+    the generated ones, and are reported as changed by incremental syncs.
+
+    """
+
+    def __init__(self, list_id, name, size):
+        """Initialize a list of `size` subscribers, split by `SHARES`."""
+        self.list_id = list_id
+        self.name = name
+        self.counts = OrderedDict(
+            (status, int(size * share)) for status, share in SHARES.items()
+        )
+        self.counts['active'] += size - sum(self.counts.values())
+        self.changes = OrderedDict()
+        # The URL of every webhook, by WebhookID, and the events pending to
+        # be POSTed to them.
+        self.webhooks = OrderedDict()
+        self.events = []
+
+    def generated(self, status, index):
+        """Return the `index`-th generated subscriber of `status`."""
+        email = '%s.%d@%s.example.com' % (status, index, self.list_id[:8])
+        return {'EmailAddress': email,
+                'Name': 'Subscriber %d' % index,
+                'Date': DATE,
+                'State': status.title(),
+                'CustomFields': [],
+                'ReadsEmailWith': ''}
+
+    def change(self, email, name, status, old_email=None):
+        """Record a change to a subscriber.
+
+        The change is reported by incremental syncs, and queued as an event
+        to POST to the list's webhooks, if any.
+
+        Arguments:
+            email       the e-mail address of the subscriber
+            name        the name of the subscriber
+            status      the new status of the subscriber, e.g. "active"
+            old_email   if given, the previous e-mail address of the
+                        subscriber, which is then reported as updated
+
+        """
+        self.changes.pop(email, None)
+        if old_email is not None:
+            self.changes.pop(old_email, None)
+        record = {'EmailAddress': email,
+                  'Name': name,
+                  'Date': time.strftime('%Y-%m-%d %H:%M:%S'),
+                  'State': status.title(),
+                  'CustomFields': [],
+                  'ReadsEmailWith': ''}
+        self.changes[email] = record
+        if not self.webhooks:
+            return
+        event = {'Type': 'Subscribe' if status == 'active' else 'Deactivate',
+                 'EmailAddress': email,
+                 'Name': name,
+                 'Date': record['Date'],
+                 'State': record['State'],
+                 'CustomFields': []}
+        if old_email is not None:
+            event['Type'] = 'Update'
+            event['OldEmailAddress'] = old_email
+        self.events.append(event)
+
+    def page(self, status, page, page_size, changed=None):
+        """Return a page of subscribers of `status`.
+
+        Arguments:
+            status      the subscriber status, e.g. "active"
+            page        the number of the page, starting from 1
+            page_size   the number of subscribers per page
+            changed     if given, the number of generated subscribers
+                        to report, as if only those had changed
+
+        """
+        generated = self.counts[status]
+        if changed is not None:
+            generated = min(generated, changed)
+        changes = [record for record in self.changes.values()
+                   if record['State'] == status.title()]
+        total = generated + len(changes)
+        start = (page - 1) * page_size
+        stop = min(start + page_size, total)
+        results = [self.generated(status, index)
+                   if index < generated else changes[index - generated]
+                   for index in range(start, max(start, stop))]
+        return {'Results': results,
+                'ResultsOrderedBy': 'email',
+                'OrderDirection': 'asc',
+                'PageNumber': page,
+                'PageSize': page_size,
+                'RecordsOnThisPage': len(results),
+                'TotalNumberOfRecords': total,
+                'NumberOfPages': max(1, -(-total // page_size))}
+
+
+class FakeCreateSend(object):
+    """The state of a fake createsend API, and its request handling.
+
+    Arguments:
+        latency     seconds to delay every response by
+        changed     the number of generated subscribers of each list and
+                    status reported by incremental syncs
+
+    """
+
+    def __init__(self, latency=0, changed=10):
+        self.latency = latency
+        self.changed = changed
+        self.clients = OrderedDict()
+        self.lists = OrderedDict()
+        self.calls = Counter()
+        self.churned = 0
+        # The (status, Retry-After) to respond to the next requests with.
+        self.faults = deque()
+        self.lock = threading.Lock()
+        self.routes = [
+            ('GET', r'/clients/(\w+)\.json', self.client_details),
+            ('GET', r'/clients/(\w+)/lists\.json', self.client_lists),
+            ('GET', r'/lists/(\w+)/(%s)\.json' % '|'.join(SHARES),
+             self.list_subscribers),
+            ('POST', r'/subscribers/(\w+)\.json', self.add_subscriber),
+            ('DELETE', r'/subscribers/(\w+)\.json', self.delete_subscriber),
+            ('POST', r'/subscribers/(\w+)/import\.json',
+             self.import_subscribers),
+            ('GET', r'/lists/(\w+)/webhooks\.json', self.list_webhooks),
+            ('POST', r'/lists/(\w+)/webhooks\.json', self.create_webhook),
+            ('DELETE', r'/lists/(\w+)/webhooks/(\w+)\.json',
+             self.delete_webhook),
+        ]
+
+    def add_client(self, size, lists=4, index=0):
+        """Add a client with `size` subscribers split across `lists` lists.
+
+        Returns the ClientID of the new client, which only depends on the
+        arguments, so that clients are the same across runs. Clients of the
+        same size are told apart by their `index`.
+
+        """
+        parts = ('client', size, lists) + ((index, ) if index else ())
+        client_id = external_id(*parts)
+        list_ids = []
+        for index in range(lists):
+            list_size = size // lists + (index < size % lists)
+            clist = FakeList(external_id(client_id, 'list', index),
+                             'List %d' % (index + 1), list_size)
+            self.lists[clist.list_id] = clist
+            list_ids.append(clist.list_id)
+        self.clients[client_id] = {'size': size, 'lists': list_ids}
+        return client_id
+
+    def fail(self, status, count=1, retry_after=None):
+        """Respond to the next `count` requests with an error instead.
+
+        Arguments:
+            status          the status code to respond with, e.g. 429
+            count           the number of requests to fail
+            retry_after     if given, the value of the Retry-After header
+
+        """
+        with self.lock:
+            self.faults.extend([(status, retry_after)] * count)
+
+    def fault(self):
+        """Return the (status, Retry-After) of the next failure, if any."""
+        with self.lock:
+            if not self.faults:
+                return None
+            self.calls['fault'] += 1
+            return self.faults.popleft()
+
+    def handle(self, method, url, body):
+        """Handle an API request.
+
+        Returns the status code of the response and its payload.
+
+        """
+        url = urlparse(url)
+        path = url.path
+        if path.startswith(BASE_PATH):
+            path = path[len(BASE_PATH):]
+        query = {key: values[-1]
+                 for key, values in parse_qs(url.query).items()}
+        for route_method, pattern, view in self.routes:
+            match = re.match(pattern + '$', path)
+            if route_method == method and match:
+                with self.lock:
+                    self.calls[view.__name__] += 1
+                data = json.loads(body.decode('utf-8')) if body else None
+                return view(query, data, *match.groups())
+        return 404, {'Code': 404, 'Message': 'Not found'}
+
+    def get_list(self, list_id):
+        clist = self.lists.get(list_id)
+        if clist is None:
+            raise LookupError('Invalid ListID')
+        return clist
+
+    def client_details(self, query, data, client_id):
+        if client_id not in self.clients:
+            return 400, {'Code': 102, 'Message': 'Invalid ClientID'}
+        size = self.clients[client_id]['size']
+        return 200, {
+            'ApiKey': external_id('key', client_id),
+            'BasicDetails': {'ClientID': client_id,
+                             'CompanyName': 'Client %s' % format_size(size),
+                             'ContactName': 'Contact %s' % format_size(size),
+                             'EmailAddress': '%s@example.com' % client_id,
+                             'Country': 'Greece',
+                             'TimeZone': '(GMT+02:00) Athens'},
+            'BillingDetails': {},
+        }
+
+    def client_lists(self, query, data, client_id):
+        if client_id not in self.clients:
+            return 400, {'Code': 102, 'Message': 'Invalid ClientID'}
+        return 200, [{'ListID': list_id, 'Name': self.lists[list_id].name}
+                     for list_id in self.clients[client_id]['lists']]
+
+    def list_subscribers(self, query, data, list_id, status):
+        try:
+            clist = self.get_list(list_id)
+        except LookupError as exc:
+            return 400, {'Code': 101, 'Message': str(exc)}
+        changed = self.changed if query.get('date') else None
+        return 200, clist.page(status, int(query.get('page', 1)),
+                               int(query.get('pagesize', 1000)),
+                               changed=changed)
+
+    def add_subscriber(self, query, data, list_id):
+        try:
+            clist = self.get_list(list_id)
+        except LookupError as exc:
+            return 400, {'Code': 101, 'Message': str(exc)}
+        with self.lock:
+            clist.change(data['EmailAddress'], data.get('Name', ''), 'active')
+        return 201, data['EmailAddress']
+
+    def delete_subscriber(self, query, data, list_id):
+        try:
+            clist = self.get_list(list_id)
+        except LookupError as exc:
+            return 400, {'Code': 101, 'Message': str(exc)}
+        with self.lock:
+            clist.change(query.get('email', ''), '', 'deleted')
+        return 200, None
+
+    def import_subscribers(self, query, data, list_id):
+        try:
+            clist = self.get_list(list_id)
+        except LookupError as exc:
+            return 400, {'Code': 101, 'Message': str(exc)}
+        subscribers = data.get('Subscribers', [])
+        with self.lock:
+            for subscriber in subscribers:
+                clist.change(subscriber['EmailAddress'],
+                             subscriber.get('Name', ''), 'active')
+        return 201, {'FailureDetails': [],
+                     'TotalUniqueEmailsSubmitted': len(subscribers),
+                     'TotalExistingSubscribers': 0,
+                     'TotalNewSubscribers': len(subscribers),
+                     'DuplicateEmailsInSubmission': []}
+
+    def list_webhooks(self, query, data, list_id):
+        try:
+            clist = self.get_list(list_id)
+        except LookupError as exc:
+            return 400, {'Code': 101, 'Message': str(exc)}
+        return 200, [{'WebhookID': webhook_id,
+                      'Events': ['Subscribe', 'Deactivate', 'Update'],
+                      'Url': url,
+                      'Status': 'Active',
+                      'PayloadFormat': 'Json'}
+                     for webhook_id, url in clist.webhooks.items()]
+
+    def create_webhook(self, query, data, list_id):
+        try:
+            clist = self.get_list(list_id)
+        except LookupError as exc:
+            return 400, {'Code': 101, 'Message': str(exc)}
+        with self.lock:
+            webhook_id = external_id(list_id, 'webhook', data['Url'])
+            clist.webhooks[webhook_id] = data['Url']
+        return 201, webhook_id
+
+    def delete_webhook(self, query, data, list_id, webhook_id):
+        try:
+            clist = self.get_list(list_id)
+        except LookupError as exc:
+            return 400, {'Code': 101, 'Message': str(exc)}
+        with self.lock:
+            if clist.webhooks.pop(webhook_id, None) is None:
+                return 400, {'Code': 600, 'Message': 'Invalid WebhookID'}
+        return 200, None
+
+    def churn(self, count):
+        """Make up `count` changes to the subscribers of lists with webhooks.
+
+        Subscribers are added, unsubscribed and renamed at random.
+
+        """
+        with self.lock:
+            clists = [clist for clist in self.lists.values()
+                      if clist.webhooks]
+            for _ in range(count if clists else 0):
+                self.churned += 1
+                number = self.churned
+                clist = random.choice(clists)
+                index = random.randrange(max(1, clist.counts['active']))
+                email = clist.generated('active', index)['EmailAddress']
+                kind = random.random()
+                if kind < 0.5:
+                    clist.change('pushed.%d.%s' % (number, email),
+                                 'Pushed %d' % number, 'active')
+                elif kind < 0.8:
+                    clist.change(email, 'Subscriber %d' % index,
+                                 'unsubscribed')
+                else:
+                    clist.change('renamed.%s' % email, 'Renamed %d' % index,
+                                 'active', old_email=email)
+
+    def deliver(self):
+        """POST the pending events of every list to its webhooks.
+
+        Events that fail to be POSTed are kept, to be retried.
+
+        Returns the number of events POSTed.
+
+        """
+        delivered = 0
+        for clist in list(self.lists.values()):
+            with self.lock:
+                events, clist.events = clist.events, []
+                webhooks = list(clist.webhooks.values())
+            failed = []
+            for start in range(0, len(events), WEBHOOK_BATCH_SIZE):
+                batch = events[start:start + WEBHOOK_BATCH_SIZE]
+                payload = json.dumps({'ListID': clist.list_id,
+                                      'Events': batch}).encode('utf-8')
+                try:
+                    for url in webhooks:
+                        urlopen(Request(url, payload, {
+                            'Content-Type': 'application/json',
+                        }), timeout=30).close()
+                except Exception as exc:
+                    log.warning('Failed to POST %d events of %s: %r',
+                                len(batch), clist.list_id, exc)
+                    failed.extend(batch)
+                else:
+                    delivered += len(batch)
+            if failed:
+                with self.lock:
+                    clist.events[:0] = failed
+        return delivered
+
+
+class FakeWebhookSender(threading.Thread):
+    """POSTs the events of a `FakeCreateSend` API every `interval` seconds.
+
+    Arguments:
+        api         the `FakeCreateSend` API
+        churn       the number of changes to make up per second
+        interval    the seconds between deliveries
+
+    """
+
+    def __init__(self, api, churn=0, interval=1.0):
+        super(FakeWebhookSender, self).__init__()
+        self.daemon = True
+        self.api = api
+        self.churn = churn
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.api.churn(int(round(self.churn * self.interval)))
+            self.api.deliver()
+
+
+class FakeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the requests of a `FakeServer` over persistent connections."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def handle_request(self):
+        api = self.server.api
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+        if api.latency:
+            time.sleep(api.latency)
+        fault = api.fault()
+        if fault is None:
+            status, payload = api.handle(self.command, self.path, body)
+        else:
+            status = fault[0]
+            payload = {'Code': status, 'Message': 'Injected failure'}
+        content = b'' if payload is None else json.dumps(payload).encode()
+        self.send_response(status)
+        if fault is not None and fault[1] is not None:
+            self.send_header('Retry-After', str(fault[1]))
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_GET = do_POST = do_PUT = do_DELETE = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A threaded HTTP server of a `FakeCreateSend` API."""
+
+    daemon_threads = True
+
+    def __init__(self, api, host='127.0.0.1', port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port),
+                                           FakeRequestHandler)
+        self.api = api
+
+    def handle_error(self, request, client_address):
+        # Clients dropping their persistent connections, as happens to idle
+        # ones at exit, are not errors.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                                   client_address)
+
+    @property
+    def base_uri(self):
+        """The URI to set `createsend.CreateSend.base_uri` to."""
+        host, port = self.server_address[:2]
+        return 'http://%s:%d%s' % (host, port, BASE_PATH)
+
+    def start(self):
+        """Serve requests in a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
@@ -0,0 +1,245 @@
+"""Resumable bulk imports of subscribers from CSV files.
+
+A CSV file is parsed incrementally and imported into a list in batches of
+`settings.IMPORT_BATCH_SIZE` rows. Every batch is stored locally and its
+progress is recorded in a single transaction, see `import_batch`, so that an
+interrupted `.models.ImportJob` resumes from the row after its last batch.
+The subscriptions are sent upstream through the outbox, from where they are
+drained in chunked bulk imports by `manage.py drain-outbox`.
+
+Jobs are run in the background when uploaded in the admin, and in the
+foreground by `manage.py import-subscribers`, which also resumes any
+unfinished jobs.
+
+"""
+
+import os
+import io
+import csv
+import codecs
+import uuid
+import logging
+import itertools
+import threading
+import collections
+
+from django.conf import settings
+from django.db import connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import six
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+
+from .utils import chunked
+from .cache import invalidate_lists
+from .outbox import enqueue_many
+from .upstream import store_subscribers
+from .singleflight import InFlight
+from .singleflight import SingleFlight
+
+
+log = logging.getLogger(__name__)
+
+# A subscriber to import, in the shape of createsend's subscriber details.
+Subscriber = collections.namedtuple('Subscriber', 'EmailAddress Name State')
+
+# Ensures that every job is run by a single thread or process at a time.
+_flights = SingleFlight(settings.SYNC_LOCK_DIR)
+
+
+def read_rows(path):
+    """Yield the (e-mail, name) of every row of a CSV file.
+
+    The file may have a header with an "email" and optionally a "name"
+    column. Otherwise the e-mail address is expected in the first column,
+    and the name in the second one.
+
+    """
+    if six.PY2:
+        f = open(path, 'rb')
+    else:
+        f = io.open(path, newline='', encoding='utf-8-sig')
+    with f:
+        for row in parse_rows(f):
+            yield row
+
+
+def read_upload(upload):
+    """Yield the (e-mail, name) of every row of an uploaded CSV file.
+
+    The upload is read in chunks, from memory or from its temporary file,
+    without being stored. See `read_rows`.
+
+    """
+    if six.PY2:
+        lines = upload
+    else:
+        lines = codecs.iterdecode(upload, 'utf-8-sig')
+    return parse_rows(lines)
+
+
+def parse_rows(lines):
+    """Yield the (e-mail, name) of every row of the lines of a CSV file.
+
+    Arguments:
+        lines: The lines of the file, encoded in UTF-8 under Python 2.
+
+    """
+    email_column, name_column = 0, 1
+    for index, row in enumerate(csv.reader(lines)):
+        if six.PY2:
+            row = [value.decode('utf-8-sig') for value in row]
+        row = [value.strip() for value in row]
+        if index == 0 and row and '@' not in row[0]:
+            header = [value.lower() for value in row]
+            for column, value in enumerate(header):
+                if value in ('email', 'e-mail', 'emailaddress'):
+                    email_column = column
+                elif value == 'name':
+                    name_column = column
+            continue
+        if not row:
+            continue
+        email = row[email_column] if email_column < len(row) else ''
+        name = row[name_column] if name_column < len(row) else ''
+        yield email, name
+
+
+def count_rows(path):
+    """Return the number of rows of a CSV file to import."""
+    return sum(1 for row in read_rows(path))
+
+
+def save_upload(upload):
+    """Store an uploaded CSV file in `settings.IMPORT_DIR`.
+
+    Returns the path of the stored file.
+
+    """
+    if not os.path.isdir(settings.IMPORT_DIR):
+        os.makedirs(settings.IMPORT_DIR)
+    path = os.path.join(settings.IMPORT_DIR, '%s-%s' % (
+        uuid.uuid4().hex, os.path.basename(upload.name)
+    ))
+    with open(path, 'wb') as f:
+        for chunk in upload.chunks():
+            f.write(chunk)
+    return path
+
+
+def create_job(clist, path):
+    """Create a job importing the CSV file at `path` into `clist`."""
+    from .models import ImportJob
+    return ImportJob.objects.create(clist=clist, path=path,
+                                    total_rows=count_rows(path))
+
+
+def import_batch(clist, rows):
+    """Store a batch of (e-mail, name) rows as subscribers of a list.
+
+    Rows with an invalid e-mail address are skipped, as are rows without a
+    name, unless for an existing subscriber, who keeps their name. Rows of
+    existing subscribers who are not active, e.g. who unsubscribed or
+    bounced, are skipped too, so that they are not subscribed again. Of rows
+    with the same address, the last one wins.
+
+    Returns the number of subscribers imported and of rows skipped.
+
+    """
+    from .models import CampaignSubscriber
+    from .models import UpstreamOperation
+    records = collections.OrderedDict()
+    for email, name in rows:
+        try:
+            validate_email(email)
+        except ValidationError:
+            continue
+        records[email] = name[:64]
+    existing = []
+    for chunk in chunked(list(records), settings.SYNC_BATCH_SIZE):
+        existing.extend(CampaignSubscriber.objects.filter(
+            email__in=chunk
+        ).values_list('email', 'name', 'state'))
+    inactive = []
+    for email, name, state in existing:
+        if state != 'Active':
+            inactive.append(email)
+            del records[email]
+        elif not records[email]:
+            records[email] = name
+    if inactive:
+        log.info('Skipping %d inactive subscriber(s) imported into %s',
+                 len(inactive), clist)
+    for email in [email for email, name in records.items() if not name]:
+        del records[email]
+    store_subscribers(clist, [Subscriber(email, name, 'Active')
+                              for email, name in records.items()])
+    enqueue_many(UpstreamOperation.SUBSCRIBE,
+                 ((clist.external_id, email, name)
+                  for email, name in records.items()))
+    return len(records), len(rows) - len(records)
+
+
+def run_job(job_id, progress=None):
+    """Run an import job, resuming it from its last batch.
+
+    Raises `.singleflight.InFlight` if the job is already being run.
+
+    Arguments:
+        job_id      the pk of the `.models.ImportJob` to run
+        progress    if given, a function called with the job after
+                    every batch
+
+    """
+    return _flights.do('import-%s' % job_id,
+                       lambda: _run_job(job_id, progress), timeout=0)
+
+
+def _run_job(job_id, progress=None):
+    from .models import ImportJob
+    job = ImportJob.objects.select_related('clist').get(pk=job_id)
+    if job.status == ImportJob.DONE:
+        return job
+    ImportJob.objects.filter(pk=job.pk).update(status=ImportJob.RUNNING)
+    rows = itertools.islice(read_rows(job.path), job.rows_processed, None)
+    try:
+        for batch in chunked(rows, settings.IMPORT_BATCH_SIZE):
+            with transaction.atomic():
+                imported, skipped = import_batch(job.clist, batch)
+                ImportJob.objects.filter(pk=job.pk).update(
+                    rows_processed=F('rows_processed') + len(batch),
+                    imported=F('imported') + imported,
+                    skipped=F('skipped') + skipped,
+                )
+            job.refresh_from_db()
+            if progress is not None:
+                progress(job)
+    except Exception as exc:
+        log.error('Failed to run %s: %r', job, exc)
+        ImportJob.objects.filter(pk=job.pk).update(status=ImportJob.FAILED,
+                                                   last_error=repr(exc))
+        raise
+    finally:
+        invalidate_lists([job.clist])
+    ImportJob.objects.filter(pk=job.pk).update(status=ImportJob.DONE,
+                                               last_error='')
+    job.refresh_from_db()
+    return job
+
+
+def start_job(job_id):
+    """Run an import job in a background thread."""
+    def run():
+        try:
+            run_job(job_id)
+        except InFlight:
+            pass
+        except Exception as exc:
+            log.error('Failed to import job %s: %r', job_id, exc)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
@@ -0,0 +1,290 @@
+"""An HTTP load generator for the public views of the app.
+
+The app is served in-process by a threaded WSGI server with a bounded number
+of workers, against a fake createsend API (see `.fake`). A number of client
+threads then send a weighted mix of requests to it for a while:
+
+    read            GET a client's page, see `.views.CampaignClientDetail`
+    subscribe       POST a new subscriber, see `.views.AddSubscriberToList`
+    unsubscribe     POST the removal of an existing subscriber, see
+                    `.views.RemoveSubscriberFromList`
+
+The latency of every request is measured by the client threads, while the
+db queries each request issues are counted by the server.
+
+"""
+
+import time
+import random
+import itertools
+import threading
+
+from collections import OrderedDict
+
+from django.db import connection
+from django.urls import resolve
+from django.urls import Resolver404
+from django.core.wsgi import get_wsgi_application
+from django.core.servers.basehttp import WSGIServer
+from django.core.servers.basehttp import WSGIRequestHandler
+from django.utils.six.moves import socketserver
+from django.utils.six.moves import http_client
+from django.utils.six.moves.urllib.parse import urlencode
+
+
+# The name of the endpoint of each kind of request, as in `.urls`.
+ENDPOINTS = OrderedDict((('read', 'client'),
+                         ('subscribe', 'add-subscriber'),
+                         ('unsubscribe', 'remove-subscriber')))
+
+
+def percentile(values, fraction):
+    """Return the nearest-rank percentile of sorted `values`."""
+    if not values:
+        return 0
+    index = int(round(fraction * len(values) + 0.5)) - 1
+    return values[min(max(index, 0), len(values) - 1)]
+
+
+def parse_mix(mix):
+    """Parse a mix of requests such as "read=8,subscribe=1,unsubscribe=1".
+
+    Returns a dict mapping each kind of request to its weight.
+
+    """
+    weights = OrderedDict()
+    for part in mix.split(','):
+        kind, _, weight = part.partition('=')
+        kind = kind.strip()
+        if kind not in ENDPOINTS:
+            raise ValueError('Unknown kind of request: %s' % kind)
+        weights[kind] = float(weight or 1)
+    return weights
+
+
+class Stats(object):
+    """Thread-safe latencies, statuses and query counts per endpoint."""
+
+    def __init__(self):
+        self.latencies = {}
+        self.statuses = {}
+        self.queries = {}
+        self.lock = threading.Lock()
+
+    def request(self, endpoint, seconds, status):
+        """Record a request sent to `endpoint`."""
+        with self.lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            statuses = self.statuses.setdefault(endpoint, {})
+            statuses[status] = statuses.get(status, 0) + 1
+
+    def served(self, endpoint, queries):
+        """Record the number of queries of a request served by `endpoint`."""
+        with self.lock:
+            self.queries.setdefault(endpoint, []).append(queries)
+
+    def report(self, elapsed):
+        """Return the summary of every endpoint, over `elapsed` seconds."""
+        summary = OrderedDict()
+        for endpoint in ENDPOINTS.values():
+            latencies = sorted(self.latencies.get(endpoint, []))
+            if not latencies:
+                continue
+            queries = self.queries.get(endpoint, [])
+            statuses = self.statuses[endpoint]
+            summary[endpoint] = OrderedDict((
+                ('requests', len(latencies)),
+                ('errors', sum(count for status, count in statuses.items()
+                               if status >= 400)),
+                ('throughput', len(latencies) / elapsed),
+                ('p50', percentile(latencies, 0.50)),
+                ('p95', percentile(latencies, 0.95)),
+                ('p99', percentile(latencies, 0.99)),
+                ('queries', sum(queries) / float(len(queries) or 1)),
+                ('statuses', statuses),
+            ))
+        return summary
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+
+class LoadTestServer(socketserver.ThreadingMixIn, WSGIServer):
+    """A WSGI server handling up to `workers` requests concurrently.
+
+    The app served is wrapped so that the db queries of every request are
+    recorded in `stats`, per endpoint.
+
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, stats, workers, host='127.0.0.1', port=0):
+        super(LoadTestServer, self).__init__((host, port),
+                                             QuietRequestHandler)
+        self.stats = stats
+        self.workers = threading.BoundedSemaphore(workers)
+        self.set_app(self.count_queries(get_wsgi_application()))
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server_address[:2]
+
+    def count_queries(self, app):
+        def counting_app(environ, start_response):
+            try:
+                endpoint = resolve(environ['PATH_INFO']).url_name
+            except Resolver404:
+                endpoint = None
+            connection.force_debug_cursor = True
+            connection.queries_log.clear()
+            response = app(environ, start_response)
+            try:
+                # Consume streaming responses here, to count their queries.
+                content = [b''.join(response)]
+            finally:
+                if hasattr(response, 'close'):
+                    response.close()
+            self.stats.served(endpoint, len(connection.queries_log))
+            return content
+        return counting_app
+
+    def process_request(self, request, client_address):
+        self.workers.acquire()
+        socketserver.ThreadingMixIn.process_request(self, request,
+                                                    client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            socketserver.ThreadingMixIn.process_request_thread(
+                self, request, client_address
+            )
+        finally:
+            connection.close()
+            self.workers.release()
+
+    def start(self):
+        """Serve requests in a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class LoadTest(object):
+    """Sends a weighted mix of requests to a `LoadTestServer`.
+
+    Arguments:
+        address         the "host:port" of the server
+        clients         the ClientIDs of the clients to request
+        lists           a list of (ClientID, list pk) pairs to subscribe to
+        memberships     a list of (ClientID, ListID, subscriber pk) triples
+                        to unsubscribe, each at most once
+        weights         the weight of each kind of request, see `parse_mix`
+        stats           the `Stats` to record requests in
+
+    """
+
+    def __init__(self, address, clients, lists, memberships, weights, stats):
+        self.address = address
+        self.clients = clients
+        self.lists = lists
+        self.memberships = list(memberships)
+        self.kinds = list(weights)
+        self.weights = [weights[kind] for kind in self.kinds]
+        self.stats = stats
+        self.emails = itertools.count()
+        self.lock = threading.Lock()
+        self.csrf_token = None
+
+    def send(self, method, path, data=None):
+        """Send a request and return the response's status and headers."""
+        headers = {}
+        body = None
+        if self.csrf_token:
+            headers['Cookie'] = 'csrftoken=%s' % self.csrf_token
+            headers['X-CSRFToken'] = self.csrf_token
+        if data is not None:
+            body = urlencode(data, doseq=True)
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        conn = http_client.HTTPConnection(self.address, timeout=60)
+        try:
+            conn.request(method, path, body, headers)
+            response = conn.getresponse()
+            response.read()
+            return response.status, response.getheaders()
+        finally:
+            conn.close()
+
+    def warm_up(self):
+        """Request every client once, and keep the CSRF token handed out."""
+        for client_id in self.clients:
+            status, headers = self.send('GET', '/%s/' % client_id)
+            for name, value in headers:
+                if name.lower() == 'set-cookie' and 'csrftoken=' in value:
+                    self.csrf_token = value.split('csrftoken=')[1]
+                    self.csrf_token = self.csrf_token.split(';')[0]
+
+    def read(self):
+        return 'GET', '/%s/' % random.choice(self.clients), None
+
+    def subscribe(self):
+        client_id, list_pk = random.choice(self.lists)
+        with self.lock:
+            index = next(self.emails)
+        return 'POST', '/%s/lists/subscribe/' % client_id, {
+            'name': 'Load Test %d' % index,
+            'email': 'loadtest.%d.%d@example.com' % (index, time.time()),
+            'lists': [list_pk],
+        }
+
+    def unsubscribe(self):
+        with self.lock:
+            if not self.memberships:
+                return None
+            membership = self.memberships.pop()
+        return 'POST', '/%s/lists/%s/subscribers/%s/unsubscribe/' % (
+            membership
+        ), {}
+
+    def worker(self, deadline):
+        while time.time() < deadline:
+            kind = self.choose()
+            request = getattr(self, kind)()
+            if request is None:
+                continue
+            started = time.time()
+            try:
+                status, headers = self.send(*request)
+            except Exception:
+                status = 599
+            self.stats.request(ENDPOINTS[kind], time.time() - started,
+                               status)
+
+    def choose(self):
+        point = random.uniform(0, sum(self.weights))
+        for kind, weight in zip(self.kinds, self.weights):
+            point -= weight
+            if point <= 0:
+                return kind
+        return self.kinds[-1]
+
+    def run(self, concurrency, duration):
+        """Send requests from `concurrency` threads for `duration` seconds.
+
+        Returns the number of seconds the requests took.
+
+        """
+        started = time.time()
+        deadline = started + duration
+        threads = [threading.Thread(target=self.worker, args=(deadline, ))
+                   for _ in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - started
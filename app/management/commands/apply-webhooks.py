@@ -0,0 +1,35 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.singleflight import InFlight
+from app.webhooks import apply
+from app.webhooks import pending
+
+
+class Command(BaseCommand):
+
+    help = 'Apply the subscriber changes pushed by list webhooks'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-l', '--loop', default=False,
+                            action='store_true',
+                            help='keep applying events until interrupted')
+        parser.add_argument('-i', '--interval', default=1.0, type=float,
+                            help='seconds to sleep when there is no work')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                applied = apply()
+                while applied:
+                    self.stdout.write('Applied %d event(s), %d pending' % (
+                        applied, pending()
+                    ))
+                    applied = apply()
+            except InFlight:
+                self.stderr.write('Events are being applied by another '
+                                  'process')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
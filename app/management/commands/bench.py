@@ -0,0 +1,205 @@
+import os
+import json
+import time
+import resource
+
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connection
+from django.test import Client
+from django.urls import reverse
+from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from app.fake import FakeServer
+from app.fake import FakeCreateSend
+from app.fake import parse_size
+from app.fake import format_size
+from app.models import CampaignList
+from app.models import CampaignSubscriber
+from app.transport import install
+from app.transport import close_pools
+from app.upstream import sync_client
+
+
+# Metrics that vary from run to run, and are only compared with tolerance.
+# Any increase of the rest, which are deterministic, is a regression.
+NOISY = ('seconds', 'peak_rss_kb', )
+
+
+class Command(BaseCommand):
+
+    help = 'Benchmark syncing synthetic clients from a fake createsend API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sizes', nargs='*', metavar='SIZE',
+                            default=['10k', '100k'],
+                            help='the number of subscribers of each client '
+                                 'to sync, e.g. 10k, 100k or 1m')
+        parser.add_argument('-l', '--lists', default=4, type=int,
+                            help='the number of lists of each client')
+        parser.add_argument('--latency', default=0.0, type=float,
+                            help='seconds to delay every upstream response')
+        parser.add_argument('--rate', default=1000.0, type=float,
+                            help='upstream requests allowed per second')
+        parser.add_argument('-b', '--baseline',
+                            default=os.path.join(settings.BASE_DIR,
+                                                 'benchmarks.json'),
+                            help='the file of the baseline to compare with')
+        parser.add_argument('-c', '--check', default=False,
+                            action='store_true',
+                            help='fail if there is no baseline to compare '
+                                 'with')
+        parser.add_argument('-t', '--tolerance', default=0.25, type=float,
+                            help='the fraction by which wall time and peak '
+                                 'RSS may exceed the baseline')
+        parser.add_argument('-s', '--save', default=False,
+                            action='store_true',
+                            help='store the results as the new baseline')
+
+    def handle(self, *args, **options):
+        if options['check'] and not os.path.exists(options['baseline']):
+            raise CommandError('No baseline to compare with: %s' %
+                               options['baseline'])
+        api = FakeCreateSend(latency=options['latency'])
+        server = FakeServer(api).start()
+        install(server.base_uri)
+        # Run against a throwaway test db, to leave the real one untouched.
+        old_name = connection.creation.create_test_db(verbosity=0,
+                                                      autoclobber=True,
+                                                      serialize=False)
+        try:
+            with override_settings(UPSTREAM_RATE=options['rate'],
+                                   UPSTREAM_BURST=int(options['rate']),
+                                   ALLOWED_HOSTS=['testserver']):
+                results = self.run_cases(api, options)
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            close_pools()
+            server.shutdown()
+            server.server_close()
+
+        baseline = self.load(options['baseline'])
+        if options['save']:
+            baseline.update(results)
+            with open(options['baseline'], 'w') as f:
+                json.dump(baseline, f, indent=2, sort_keys=True)
+                f.write('\n')
+            self.stdout.write('Saved baseline to %s' % options['baseline'])
+            return
+        regressions = list(self.compare(results, baseline,
+                                        options['tolerance']))
+        if regressions:
+            raise CommandError('Regressed past the baseline:\n  %s' %
+                               '\n  '.join(regressions))
+
+    def run_cases(self, api, options):
+        """Run the full and incremental sync of every client size.
+
+        Clients are synced from the smallest to the largest, so that the
+        peak RSS reported for each case, which is that of the whole process,
+        is mostly due to the case itself. The views are then exercised
+        against the largest client, see `run_views`.
+
+        """
+        results = OrderedDict()
+        for size in sorted(parse_size(size) for size in options['sizes']):
+            client_id = api.add_client(size, lists=options['lists'])
+            for case in ('sync', 'resync'):
+                name = '%s-%s' % (case, format_size(size))
+                results[name] = self.measure(api, client_id)
+                self.stdout.write(
+                    '%-12s %9.2fs %9d queries %7d calls %9d KB peak RSS' % (
+                        name, results[name]['seconds'],
+                        results[name]['queries'],
+                        results[name]['upstream_calls'],
+                        results[name]['peak_rss_kb'],
+                    ))
+        results.update(self.run_views(client_id))
+        return results
+
+    def run_views(self, client_id):
+        """Subscribe to and unsubscribe from the lists of a synced client.
+
+        Only the db queries of the requests are reported, as their number
+        should not grow with the size of the client, nor of the subscriber's
+        lists.
+
+        """
+        client = Client()
+        clists = list(CampaignList.objects.filter(
+            client__external_id=client_id
+        ).order_by('pk')[:2])
+        email = 'bench@example.com'
+        results = OrderedDict()
+        results['view-subscribe'] = self.measure_request(
+            client, 'view-subscribe',
+            reverse('add-subscriber', kwargs={'client_id': client_id}),
+            {'email': email, 'name': 'Bench',
+             'lists': [clist.pk for clist in clists]},
+        )
+        results['view-unsubscribe'] = self.measure_request(
+            client, 'view-unsubscribe',
+            reverse('remove-subscriber', kwargs={
+                'client_id': client_id,
+                'list_id': clists[0].external_id,
+                'subscriber_id': CampaignSubscriber.objects.get(
+                    email=email
+                ).pk,
+            }), {},
+        )
+        return results
+
+    def measure_request(self, client, name, url, data):
+        """POST `data` to `url` and return the db queries it took."""
+        with CaptureQueriesContext(connection) as queries:
+            response = client.post(url, data)
+        if response.status_code != 302:
+            raise CommandError('%s: unexpected status %d' % (
+                name, response.status_code
+            ))
+        self.stdout.write('%-12s %20d queries' % (name, len(queries)))
+        return OrderedDict((('queries', len(queries)), ))
+
+    def measure(self, api, client_id):
+        """Sync a client and return the resources it took."""
+        calls = sum(api.calls.values())
+        with CaptureQueriesContext(connection) as queries:
+            started = time.time()
+            sync_client(client_id)
+            seconds = time.time() - started
+        return OrderedDict((
+            ('seconds', round(seconds, 3)),
+            ('queries', len(queries)),
+            ('upstream_calls', sum(api.calls.values()) - calls),
+            # In kilobytes on Linux, though in bytes on macOS.
+            ('peak_rss_kb',
+             resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+        ))
+
+    def load(self, path):
+        """Return the baseline stored in `path`, if any."""
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def compare(self, results, baseline, tolerance):
+        """Yield a description of every metric worse than its baseline."""
+        if not baseline:
+            self.stdout.write('No baseline to compare with, run with --save '
+                              'to store one')
+        for name, metrics in results.items():
+            for metric, value in metrics.items():
+                expected = baseline.get(name, {}).get(metric)
+                if expected is None:
+                    continue
+                limit = expected
+                if metric in NOISY:
+                    limit = expected * (1 + tolerance)
+                if value > limit:
+                    yield '%s %s: %s, baseline %s' % (name, metric, value,
+                                                      expected)
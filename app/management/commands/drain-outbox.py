@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.outbox import drain
+from app.outbox import retry
+from app.outbox import failed
+from app.outbox import pending
+
+
+class Command(BaseCommand):
+
+    help = 'Send pending subscription changes to Campaign Monitoring'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-l', '--loop', default=False,
+                            action='store_true',
+                            help='keep draining the outbox until interrupted')
+        parser.add_argument('-i', '--interval', default=1.0, type=float,
+                            help='seconds to sleep when there is no work')
+        parser.add_argument('--retry-failed', default=False,
+                            action='store_true',
+                            help='queue the operations that failed '
+                                 'too many times to be sent again')
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            self.stdout.write('Queued %d failed operation(s)' % retry())
+        while True:
+            sent = drain()
+            while sent:
+                self.stdout.write('Sent %d operation(s), %d pending' % (
+                    sent, pending()
+                ))
+                sent = drain()
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+        count = failed()
+        if count:
+            self.stderr.write('%d operation(s) failed too many times, see '
+                              'the admin or run with --retry-failed' % count)
@@ -0,0 +1,47 @@
+import sys
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from app.export import FORMATS
+from app.export import export
+from app.models import STATES
+
+
+class Command(BaseCommand):
+
+    help = 'Export subscriptions as NDJSON or CSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-c', '--client',
+                            help='the ClientID of the client to export')
+        parser.add_argument('-l', '--list',
+                            help='the ListID of the list to export')
+        parser.add_argument('-s', '--state', choices=dict(STATES),
+                            help='the state of the subscribers to export')
+        parser.add_argument('-f', '--format', default='ndjson',
+                            choices=sorted(FORMATS))
+        parser.add_argument('-z', '--gzip', default=False,
+                            action='store_true',
+                            help='compress the export')
+        parser.add_argument('-o', '--output',
+                            help='the file to write to, instead of stdout')
+
+    def handle(self, *args, **options):
+        if not (options['client'] or options['list']):
+            raise CommandError('Specify a client, a list, or both')
+        chunks = export(options['format'], options['gzip'],
+                        client_id=options['client'],
+                        list_id=options['list'], state=options['state'])
+        if options['output']:
+            out = open(options['output'], 'wb')
+        else:
+            out = getattr(sys.stdout, 'buffer', sys.stdout)
+        try:
+            for chunk in chunks:
+                out.write(chunk)
+        finally:
+            if options['output']:
+                out.close()
+            else:
+                out.flush()
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+
+from app.fake import FakeServer
+from app.fake import FakeCreateSend
+from app.fake import FakeWebhookSender
+from app.fake import parse_size
+
+
+class Command(BaseCommand):
+
+    help = 'Serve a fake createsend API with synthetic clients'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sizes', nargs='*', metavar='SIZE',
+                            default=['10k', '100k', '1m'],
+                            help='the number of subscribers of each client, '
+                                 'e.g. 10k, 100k or 1m')
+        parser.add_argument('-l', '--lists', default=4, type=int,
+                            help='the number of lists of each client')
+        parser.add_argument('-H', '--host', default='127.0.0.1',
+                            help='the address to listen on')
+        parser.add_argument('-p', '--port', default=8001, type=int,
+                            help='the port to listen on')
+        parser.add_argument('--latency', default=0.0, type=float,
+                            help='seconds to delay every response by')
+        parser.add_argument('--changed', default=10, type=int,
+                            help='subscribers of each list and status '
+                                 'reported by incremental syncs')
+        parser.add_argument('--churn', default=0, type=int,
+                            help='subscriber changes to make up per second, '
+                                 'across the lists with webhooks')
+        parser.add_argument('--push-interval', default=1.0, type=float,
+                            help='seconds between POSTing the pending '
+                                 'events to the webhooks')
+
+    def handle(self, *args, **options):
+        api = FakeCreateSend(latency=options['latency'],
+                             changed=options['changed'])
+        for size in options['sizes']:
+            client_id = api.add_client(parse_size(size),
+                                       lists=options['lists'])
+            self.stdout.write('Client %s: %s subscribers' % (client_id, size))
+        server = FakeServer(api, options['host'], options['port'])
+        FakeWebhookSender(api, options['churn'],
+                          options['push_interval']).start()
+        self.stdout.write('Serving on %s' % server.base_uri)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,61 @@
+import os
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from app.imports import run_job
+from app.imports import create_job
+from app.models import ImportJob
+from app.models import CampaignList
+from app.singleflight import InFlight
+
+
+class Command(BaseCommand):
+
+    help = 'Import subscribers into a list from a CSV file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('list', nargs='?', metavar='LIST_ID',
+                            help='the ListID of the list to import into')
+        parser.add_argument('file', nargs='?', metavar='FILE',
+                            help='the CSV file to import')
+        parser.add_argument('--resume', default=False, action='store_true',
+                            help='resume the unfinished imports instead')
+
+    def progress(self, job):
+        self.stdout.write('%s: %d/%d rows, %d imported, %d skipped' % (
+            job, job.rows_processed, job.total_rows, job.imported,
+            job.skipped,
+        ))
+
+    def run(self, job):
+        try:
+            job = run_job(job.pk, self.progress)
+        except InFlight:
+            self.stderr.write('%s is already running' % job)
+            return False
+        except Exception as exc:
+            self.stderr.write('%s failed: %r' % (job, exc))
+            return False
+        self.stdout.write('%s: done' % job)
+        return True
+
+    def handle(self, *args, **options):
+        if options['resume']:
+            jobs = list(ImportJob.objects.exclude(
+                status=ImportJob.DONE
+            ).order_by('pk'))
+        else:
+            if not (options['list'] and options['file']):
+                raise CommandError('Specify a list and a file, or --resume')
+            if not os.path.isfile(options['file']):
+                raise CommandError('No such file: %s' % options['file'])
+            try:
+                clist = CampaignList.objects.get(external_id=options['list'])
+            except CampaignList.DoesNotExist:
+                raise CommandError('No such list: %s' % options['list'])
+            jobs = [create_job(clist, os.path.abspath(options['file']))]
+        failed = [job for job in jobs if not self.run(job)]
+        if failed:
+            raise CommandError('%d of %d import(s) failed' % (len(failed),
+                                                              len(jobs)))
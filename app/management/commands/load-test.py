@@ -0,0 +1,125 @@
+import random
+
+from django.conf import settings
+from django.db import connection
+from django.test.utils import override_settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from app.fake import FakeServer
+from app.fake import FakeCreateSend
+from app.fake import parse_size
+from app.models import CampaignSubscriber
+from app.loadtest import Stats
+from app.loadtest import LoadTest
+from app.loadtest import LoadTestServer
+from app.loadtest import parse_mix
+from app.transport import install
+from app.transport import close_pools
+from app.upstream import sync_client
+
+
+class Command(BaseCommand):
+
+    help = 'Load test the public views against a fake createsend API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('-m', '--mix',
+                            default='read=8,subscribe=1,unsubscribe=1',
+                            help='the weight of each kind of request')
+        parser.add_argument('-c', '--concurrency', default=8, type=int,
+                            help='the number of clients sending requests')
+        parser.add_argument('-w', '--workers', default=4, type=int,
+                            help='the number of requests served at once')
+        parser.add_argument('-d', '--duration', default=10.0, type=float,
+                            help='seconds to send requests for')
+        parser.add_argument('--clients', default=4, type=int,
+                            help='the number of clients to request')
+        parser.add_argument('--size', default='1k',
+                            help='the number of subscribers of each client')
+        parser.add_argument('--lists', default=4, type=int,
+                            help='the number of lists of each client')
+        parser.add_argument('--latency', default=0.0, type=float,
+                            help='seconds to delay every upstream response')
+
+    def handle(self, *args, **options):
+        try:
+            weights = parse_mix(options['mix'])
+        except ValueError as exc:
+            raise CommandError(exc)
+
+        api = FakeCreateSend(latency=options['latency'])
+        upstream = FakeServer(api).start()
+        install(upstream.base_uri)
+        client_ids = [api.add_client(parse_size(options['size']),
+                                     lists=options['lists'], index=index)
+                      for index in range(options['clients'])]
+
+        # Run against a throwaway test db, to leave the real one untouched.
+        # Requests are served by several threads, which cannot share an
+        # in-memory SQLite db, so SQLite test dbs are kept in a file.
+        test_settings = connection.settings_dict['TEST']
+        if connection.vendor == 'sqlite' and not test_settings['NAME']:
+            test_settings['NAME'] = settings.DATABASES['default']['NAME'] + (
+                '.loadtest'
+            )
+        old_name = connection.creation.create_test_db(verbosity=0,
+                                                      autoclobber=True,
+                                                      serialize=False)
+        server = None
+        try:
+            with override_settings(UPSTREAM_RATE=1000.0, UPSTREAM_BURST=1000):
+                for client_id in client_ids:
+                    sync_client(client_id)
+                server = LoadTestServer(Stats(), options['workers']).start()
+                load_test = LoadTest(server.address, client_ids,
+                                     *self.targets(), weights=weights,
+                                     stats=Stats())
+                load_test.warm_up()
+                stats = server.stats = load_test.stats
+                elapsed = load_test.run(options['concurrency'],
+                                        options['duration'])
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            close_pools()
+            upstream.shutdown()
+            upstream.server_close()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        self.stdout.write('%s, %d clients, %d workers, %.1fs' % (
+            connection.vendor, options['concurrency'], options['workers'],
+            elapsed,
+        ))
+        self.stdout.write('%-18s %8s %7s %8s %8s %8s %8s %8s' % (
+            'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+            'p99 ms', 'queries',
+        ))
+        for endpoint, summary in stats.report(elapsed).items():
+            self.stdout.write(
+                '%-18s %8d %7d %8.1f %8.1f %8.1f %8.1f %8.1f' % (
+                    endpoint, summary['requests'], summary['errors'],
+                    summary['throughput'], summary['p50'] * 1000,
+                    summary['p95'] * 1000, summary['p99'] * 1000,
+                    summary['queries'],
+                ))
+
+    def targets(self):
+        """Return the lists to subscribe to and the subscriptions to remove.
+
+        Lists are (ClientID, list pk) pairs, and subscriptions are
+        (ClientID, ListID, subscriber pk) triples, in random order.
+
+        """
+        lists = set()
+        membership = CampaignSubscriber.lists.through
+        memberships = list(membership.objects.values_list(
+            'campaignlist__client__external_id', 'campaignlist__external_id',
+            'campaignsubscriber_id', 'campaignlist_id',
+        ))
+        random.shuffle(memberships)
+        for client_id, list_id, subscriber_id, list_pk in memberships:
+            lists.add((client_id, list_pk))
+        return (sorted(lists),
+                [row[:3] for row in memberships])
@@ -0,0 +1,16 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app.profiling import make_token
+
+
+class Command(BaseCommand):
+
+    help = 'Print a token that triggers profiling of the requests sent with it'
+
+    def handle(self, *args, **options):
+        header = settings.PROFILE_HEADER[len('HTTP_'):].replace('_', '-')
+        self.stdout.write('%s: %s' % (header.title(), make_token()))
+        self.stdout.write('Valid for %d seconds' % (
+            settings.PROFILE_TOKEN_MAX_AGE
+        ))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from app.models import CampaignList
+from app.counters import recount
+
+
+class Command(BaseCommand):
+
+    help = "Recompute the lists' subscriber counters from scratch"
+
+    def add_arguments(self, parser):
+        parser.add_argument('lists', nargs='*', metavar='LIST_ID',
+                            help='the ListIDs to recount (default: all)')
+
+    def handle(self, *args, **options):
+        clists = CampaignList.objects.all()
+        if options['lists']:
+            clists = clists.filter(external_id__in=options['lists'])
+        for clist in clists.iterator():
+            recount([clist])
+            self.stdout.write('Recounted %s' % clist)
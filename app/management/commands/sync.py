@@ -0,0 +1,121 @@
+import sys
+import time
+import random
+
+from multiprocessing import Pool
+
+from django.db import connection
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from app import metrics
+from app.upstream import sync_client_once
+
+
+def sync(task):
+    """Sync a client, and return its ID, duration, subscribers and error.
+
+    Failed syncs, e.g. of SQLite dbs locked by other workers, are retried,
+    resuming from their checkpoints. Clients synced since the run started,
+    by any process, are not synced again.
+
+    """
+    client_id, full, retries, run_started = task
+    started = time.time()
+    # Clients are synced one at a time per process.
+    processed = metrics.SYNC_SUBSCRIBERS.labels()
+    for attempt in range(retries + 1):
+        before = processed.value
+        try:
+            sync_client_once(client_id, max_age=time.time() - run_started,
+                             full=full, checkpoint=True)
+            subscribers = processed.value - before
+            error = None
+            break
+        except Exception as exc:
+            subscribers, error = 0, repr(exc)
+            time.sleep(random.uniform(0, 2 ** attempt))
+        finally:
+            connection.close()
+    return client_id, time.time() - started, subscribers, error
+
+
+class Command(BaseCommand):
+
+    help = 'Sync clients from Campaign Monitoring, resuming interrupted syncs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('client_ids', nargs='*', metavar='CLIENT_ID',
+                            help='the ClientIDs of the clients to sync')
+        parser.add_argument('-f', '--file',
+                            help='a file of ClientIDs, one per line, or - '
+                                 'to read them from stdin')
+        parser.add_argument('-p', '--processes', default=4, type=int,
+                            help='the number of clients synced in parallel')
+        parser.add_argument('-r', '--retries', default=3, type=int,
+                            help='times to retry each failed sync')
+        parser.add_argument('--full', default=False, action='store_true',
+                            help='re-download all subscribers of every list')
+
+    def handle(self, *args, **options):
+        client_ids = list(options['client_ids'])
+        if options['file']:
+            if options['file'] == '-':
+                client_ids.extend(sys.stdin)
+            else:
+                with open(options['file']) as f:
+                    client_ids.extend(f)
+        client_ids = [client_id.strip() for client_id in client_ids]
+        client_ids = sorted(set(filter(None, client_ids)),
+                            key=client_ids.index)
+        if not client_ids:
+            raise CommandError('No clients to sync')
+
+        run_started = time.time()
+        tasks = [(client_id, options['full'], options['retries'],
+                  run_started)
+                 for client_id in client_ids]
+        processes = min(options['processes'], len(tasks))
+        pool = None
+        if processes > 1:
+            # Each worker process opens its own db connection.
+            connection.close()
+            pool = Pool(processes)
+            results = pool.imap_unordered(sync, tasks)
+        else:
+            results = (sync(task) for task in tasks)
+
+        synced = subscribers = 0
+        failed = []
+        try:
+            for client_id, seconds, count, error in results:
+                if error is None:
+                    synced += 1
+                    subscribers += count
+                    self.stdout.write('Synced %s in %.1fs, %d subscribers' % (
+                        client_id, seconds, count
+                    ))
+                else:
+                    failed.append(client_id)
+                    self.stderr.write('Failed to sync %s: %s' % (client_id,
+                                                                 error))
+        except KeyboardInterrupt:
+            if pool is not None:
+                pool.terminate()
+            raise CommandError('Interrupted, run again to resume')
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        elapsed = time.time() - run_started
+        self.stdout.write(
+            'Synced %d/%d client(s), %d subscribers in %.1fs '
+            '(%.2f clients/s, %.0f subscribers/s)' % (
+                synced, len(tasks), subscribers, elapsed, synced / elapsed,
+                subscribers / elapsed,
+            ))
+        if failed:
+            raise CommandError('Failed to sync %d client(s): %s' % (
+                len(failed), ' '.join(failed)
+            ))
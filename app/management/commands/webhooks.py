@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from app.models import CampaignList
+from app.webhooks import register
+from app.webhooks import unregister
+
+
+class Command(BaseCommand):
+
+    help = 'Register or unregister the webhooks pushing list changes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=('register', 'unregister',
+                                               'list'))
+        parser.add_argument('lists', nargs='*', metavar='LIST_ID',
+                            help='the ListIDs of the lists (default: all)')
+        parser.add_argument('-c', '--client',
+                            help='the ClientID of the client whose lists '
+                                 'to act on')
+        parser.add_argument('-u', '--base-url',
+                            help='the URL the app is reachable at by '
+                                 'Campaign Monitoring (default: '
+                                 'settings.WEBHOOK_BASE_URL)')
+
+    def report(self, clist):
+        self.stdout.write('%s: %s' % (clist, clist.webhook_id or 'no webhook'))
+
+    def handle(self, *args, **options):
+        clists = CampaignList.objects.select_related('client').order_by('pk')
+        if options['lists']:
+            clists = clists.filter(external_id__in=options['lists'])
+        if options['client']:
+            clists = clists.filter(client__external_id=options['client'])
+        failed = 0
+        for clist in clists:
+            if options['action'] == 'list':
+                self.report(clist)
+                continue
+            try:
+                if options['action'] == 'register':
+                    register(clist, options['base_url'])
+                else:
+                    unregister(clist)
+            except Exception as exc:
+                failed += 1
+                self.stderr.write('Failed to %s the webhook of %s: %r' % (
+                    options['action'], clist, exc
+                ))
+                continue
+            self.report(clist)
+        if failed:
+            raise CommandError('Failed to %s %d webhook(s)' % (
+                options['action'], failed
+            ))
@@ -0,0 +1,376 @@
+"""In-process metrics, exposed in the Prometheus text format.
+
+Metrics are kept in memory by every process, so that recording them costs
+little more than a lock and an addition. Each process serves its own on
+`/metrics`, see `.views.metrics`, which is to be scraped per process, from
+`settings.METRICS_ALLOWED_IPS` or with `settings.METRICS_TOKEN`.
+
+Metrics are not labelled by client or list, since their IDs give access to
+their pages, and their number is unbounded.
+
+The app records:
+
+    createsend calls        timers and counters per operation and outcome,
+                            see `upstream_call`
+    requests                latency, db queries and db time per view, see
+                            `MetricsMiddleware`
+    sync progress           pages fetched and subscribers processed, see
+                            `.upstream.sync_lists`
+
+"""
+
+import time
+import threading
+
+from contextlib import contextmanager
+
+from django.db import connections
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.deprecation import MiddlewareMixin
+
+
+# The default histogram buckets of latencies, in seconds.
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# The default histogram buckets of counts, such as of queries.
+COUNTS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return '%d' % value
+    return repr(float(value))
+
+
+def format_labels(names, values, extra=()):
+    labels = list(zip(names, values)) + list(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                                     .replace('"', r'\"')
+                                     .replace('\n', r'\n'))
+        for name, value in labels
+    )
+
+
+class Metric(object):
+    """A named metric, with a child per combination of label values."""
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.children = {}
+        self.lock = threading.Lock()
+        (REGISTRY if registry is None else registry).append(self)
+
+    def labels(self, *values, **kwargs):
+        """Return the child of the given label values."""
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.label_names)
+        values = tuple(str(value) for value in values)
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.child())
+        return child
+
+    def child(self):
+        raise NotImplementedError
+
+    def samples(self):
+        """Yield the (suffix, label values, extra labels, value) of self."""
+        for values, child in sorted(self.children.items()):
+            for suffix, extra, value in child.samples():
+                yield suffix, values, extra, value
+
+    def render(self):
+        """Return self in the Prometheus text format."""
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for suffix, values, extra, value in self.samples():
+            lines.append('%s%s%s %s' % (
+                self.name, suffix,
+                format_labels(self.label_names, values, extra),
+                format_value(value),
+            ))
+        return '\n'.join(lines)
+
+
+class Value(object):
+    """A thread-safe number."""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def samples(self):
+        yield '', (), self.value
+
+
+class Counter(Metric):
+    """A number that only goes up."""
+
+    kind = 'counter'
+    child = Value
+
+
+class Gauge(Metric):
+    """A number that goes up and down."""
+
+    kind = 'gauge'
+    child = Value
+
+
+class Buckets(object):
+    """The thread-safe observations of a histogram."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            self.count += 1
+            self.sum += value
+            for index, bound in enumerate(self.bounds):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+
+    def samples(self):
+        with self.lock:
+            counts, count, total = list(self.counts), self.count, self.sum
+        cumulative = 0
+        for bound, bucket in zip(self.bounds, counts):
+            cumulative += bucket
+            yield '_bucket', (('le', format_value(bound)), ), cumulative
+        yield '_bucket', (('le', '+Inf'), ), count
+        yield '_count', (), count
+        yield '_sum', (), total
+
+
+class Histogram(Metric):
+    """Observations counted in buckets of upper bounds."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=SECONDS,
+                 registry=None):
+        self.buckets = tuple(buckets)
+        super(Histogram, self).__init__(name, documentation, labels,
+                                        registry=registry)
+
+    def child(self):
+        return Buckets(self.buckets)
+
+
+# All metrics, in the order they are rendered.
+REGISTRY = []
+
+
+def render(registry=None):
+    """Return all metrics of `registry` in the Prometheus text format."""
+    started = time.time()
+    registry = REGISTRY if registry is None else registry
+    content = '\n'.join(metric.render() for metric in registry) + '\n'
+    RENDER_SECONDS.labels().observe(time.time() - started)
+    return content
+
+
+UPSTREAM_CALLS = Counter(
+    'createsend_calls_total',
+    'Calls to the createsend API, by operation and outcome.',
+    ('operation', 'outcome'),
+)
+UPSTREAM_SECONDS = Histogram(
+    'createsend_call_seconds',
+    'Duration of calls to the createsend API, by operation.',
+    ('operation', ),
+)
+REQUESTS = Counter(
+    'http_requests_total',
+    'Requests served, by view and status code.',
+    ('view', 'status'),
+)
+REQUEST_SECONDS = Histogram(
+    'http_request_seconds',
+    'Duration of requests, by view.',
+    ('view', ),
+)
+REQUEST_QUERIES = Histogram(
+    'http_request_queries',
+    'Db queries issued per request, by view.',
+    ('view', ),
+    buckets=COUNTS,
+)
+REQUEST_DB_SECONDS = Histogram(
+    'http_request_db_seconds',
+    'Time spent in db queries per request, by view.',
+    ('view', ),
+)
+SYNC_PAGES = Counter(
+    'sync_pages_fetched_total',
+    'Pages of subscribers fetched by syncs.',
+)
+SYNC_SUBSCRIBERS = Counter(
+    'sync_subscribers_processed_total',
+    'Subscribers stored by syncs.',
+)
+OVERHEAD_SECONDS = Counter(
+    'metrics_overhead_seconds_total',
+    'Time spent recording request metrics.',
+)
+RENDER_SECONDS = Histogram(
+    'metrics_render_seconds',
+    'Duration of rendering all metrics.',
+)
+
+
+@contextmanager
+def upstream_call(operation):
+    """Time a createsend call and count it by its outcome.
+
+    The outcome is "success", or the name of the exception raised.
+
+    Arguments:
+        operation   the name of the call, e.g. "list.active"
+
+    """
+    started = time.time()
+    outcome = 'success'
+    try:
+        yield
+    except Exception as exc:
+        outcome = exc.__class__.__name__
+        raise
+    finally:
+        UPSTREAM_SECONDS.labels(operation).observe(time.time() - started)
+        UPSTREAM_CALLS.labels(operation, outcome).inc()
+
+
+class CountingCursorWrapper(object):
+    """A cursor counting and timing the queries executed through it."""
+
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        return self.cursor.__exit__(type, value, traceback)
+
+    def timed(self, method, *args):
+        started = time.time()
+        try:
+            return method(*args)
+        finally:
+            self.counter.queries += 1
+            self.counter.seconds += time.time() - started
+
+    def callproc(self, procname, params=None):
+        return self.timed(self.cursor.callproc, procname, params)
+
+    def execute(self, sql, params=None):
+        return self.timed(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self.timed(self.cursor.executemany, sql, param_list)
+
+
+class QueryCounter(object):
+    """Counts and times the queries of a connection, from `start` to `stop`.
+
+    The cursors of the connection, debug cursors included, are wrapped in a
+    `CountingCursorWrapper` in between, so that counting costs no more than
+    an addition per query, and is not capped as `connection.queries` is.
+
+    """
+
+    METHODS = ('make_cursor', 'make_debug_cursor')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.queries = 0
+        self.seconds = 0.0
+        self.saved = {}
+
+    def wrap(self, make_cursor):
+        return lambda cursor: CountingCursorWrapper(make_cursor(cursor), self)
+
+    def start(self):
+        # Connections are per thread, so the wrappers are set on the
+        # instance, and only count the queries of the current thread.
+        for name in self.METHODS:
+            self.saved[name] = self.connection.__dict__.get(name)
+            setattr(self.connection, name,
+                    self.wrap(getattr(self.connection, name)))
+        return self
+
+    def stop(self):
+        for name in self.METHODS:
+            if self.saved[name] is None:
+                delattr(self.connection, name)
+            else:
+                setattr(self.connection, name, self.saved[name])
+        return self
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """Record the latency, db queries and db time of every request.
+
+    Queries are counted by a `QueryCounter` of the default connection for
+    the duration of each request. Queries issued while a streaming response
+    is being consumed are not accounted for.
+
+    """
+
+    def process_request(self, request):
+        started = time.time()
+        request._metrics_started = started
+        request._metrics_queries = QueryCounter(
+            connections[DEFAULT_DB_ALIAS]
+        ).start()
+        OVERHEAD_SECONDS.labels().inc(time.time() - started)
+
+    def process_response(self, request, response):
+        started = getattr(request, '_metrics_started', None)
+        if started is None:
+            return response
+        finished = time.time()
+        queries = request._metrics_queries.stop()
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match and match.url_name else 'unresolved'
+        REQUESTS.labels(view, response.status_code).inc()
+        REQUEST_SECONDS.labels(view).observe(finished - started)
+        REQUEST_QUERIES.labels(view).observe(queries.queries)
+        REQUEST_DB_SECONDS.labels(view).observe(queries.seconds)
+        OVERHEAD_SECONDS.labels().inc(time.time() - finished)
+        return response
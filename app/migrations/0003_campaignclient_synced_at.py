@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 07:36
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0002_campaignlist_synced_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='campaignclient',
+            name='synced_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
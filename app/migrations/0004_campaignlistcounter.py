@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 07:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_counters(apps, schema_editor):
+    CampaignSubscriber = apps.get_model('app', 'CampaignSubscriber')
+    CampaignListCounter = apps.get_model('app', 'CampaignListCounter')
+    rows = CampaignSubscriber.lists.through.objects.values(
+        'campaignlist_id', 'campaignsubscriber__state'
+    ).annotate(n=models.Count('pk')).order_by()
+    CampaignListCounter.objects.bulk_create([
+        CampaignListCounter(clist_id=row['campaignlist_id'],
+                            state=row['campaignsubscriber__state'],
+                            count=row['n'])
+        for row in rows
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0003_campaignclient_synced_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CampaignListCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(choices=[('Active', 'Active'), ('Bounced', 'Bounced'), ('Deleted', 'Deleted'), ('Unconfirmed', 'Unconfirmed'), ('Unsubscribed', 'Unsubscribed')], max_length=12)),
+                ('count', models.IntegerField(default=0)),
+                ('clist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='counters', to='app.CampaignList')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='campaignlistcounter',
+            unique_together=set([('clist', 'state')]),
+        ),
+        migrations.RunPython(populate_counters, migrations.RunPython.noop),
+    ]
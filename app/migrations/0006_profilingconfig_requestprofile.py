@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 07:53
+from __future__ import unicode_literals
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0005_upstreamoperation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProfilingConfig',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sample_rate', models.FloatField(default=0, help_text='The fraction of requests to profile, from 0 to 1.', validators=[django.core.validators.MinValueValidator(0), django.core.validators.MaxValueValidator(1)])),
+                ('path_prefix', models.CharField(blank=True, help_text='Only sample requests whose path starts with this.', max_length=255)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='RequestProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('method', models.CharField(max_length=8)),
+                ('path', models.CharField(max_length=255)),
+                ('status', models.IntegerField()),
+                ('duration', models.FloatField()),
+                ('trigger', models.CharField(choices=[('header', 'Header'), ('sample', 'Sample')], max_length=8)),
+                ('queries', models.IntegerField()),
+                ('sql', models.TextField(blank=True)),
+                ('summary', models.TextField(blank=True)),
+                ('stats', models.BinaryField()),
+            ],
+        ),
+    ]
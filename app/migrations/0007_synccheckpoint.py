@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 07:56
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_profilingconfig_requestprofile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SyncCheckpoint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(max_length=12)),
+                ('page', models.IntegerField(default=0)),
+                ('since', models.DateTimeField(null=True)),
+                ('started_at', models.DateTimeField()),
+                ('clist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoints', to='app.CampaignList')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='synccheckpoint',
+            unique_together=set([('clist', 'status')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 08:01
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_importjob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='campaignsubscriber',
+            name='state',
+            field=models.CharField(choices=[('Active', 'Active'), ('Bounced', 'Bounced'), ('Deleted', 'Deleted'), ('Unconfirmed', 'Unconfirmed'), ('Unsubscribed', 'Unsubscribed')], db_index=True, default='Active', max_length=12),
+        ),
+        migrations.AlterUniqueTogether(
+            name='campaignlist',
+            unique_together=set([('client', 'external_id')]),
+        ),
+        # The subscriptions of a list are read in the order of their
+        # subscribers, which the auto-created membership table has no index
+        # for, so it cannot be declared on the model.
+        migrations.RunSQL(
+            ['CREATE INDEX app_campaignsubscriber_lists_list_subscriber '
+             'ON app_campaignsubscriber_lists '
+             '(campaignlist_id, campaignsubscriber_id)'],
+            ['DROP INDEX app_campaignsubscriber_lists_list_subscriber'],
+        ),
+    ]
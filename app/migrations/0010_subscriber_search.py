@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db import OperationalError
+
+
+# An FTS5 table of the subscribers' e-mail addresses and names, tokenized
+# into trigrams, and kept up to date by triggers. See `app.search`.
+#
+# Note that SQLite drops the triggers whenever Django remakes the subscriber
+# table to alter it. They are recreated after every migration, see
+# `app.search.ensure_index`.
+SQLITE_INDEX = [
+    "CREATE VIRTUAL TABLE app_campaignsubscriber_search USING fts5("
+    "email, name, content='app_campaignsubscriber', content_rowid='id', "
+    "tokenize='trigram')",
+    "CREATE TRIGGER app_campaignsubscriber_search_insert "
+    "AFTER INSERT ON app_campaignsubscriber BEGIN "
+    "INSERT INTO app_campaignsubscriber_search (rowid, email, name) "
+    "VALUES (new.id, new.email, new.name); "
+    "END",
+    "CREATE TRIGGER app_campaignsubscriber_search_delete "
+    "AFTER DELETE ON app_campaignsubscriber BEGIN "
+    "INSERT INTO app_campaignsubscriber_search "
+    "(app_campaignsubscriber_search, rowid, email, name) "
+    "VALUES ('delete', old.id, old.email, old.name); "
+    "END",
+    "CREATE TRIGGER app_campaignsubscriber_search_update "
+    "AFTER UPDATE OF email, name ON app_campaignsubscriber BEGIN "
+    "INSERT INTO app_campaignsubscriber_search "
+    "(app_campaignsubscriber_search, rowid, email, name) "
+    "VALUES ('delete', old.id, old.email, old.name); "
+    "INSERT INTO app_campaignsubscriber_search (rowid, email, name) "
+    "VALUES (new.id, new.email, new.name); "
+    "END",
+    "INSERT INTO app_campaignsubscriber_search "
+    "(app_campaignsubscriber_search) VALUES ('rebuild')",
+]
+
+SQLITE_DROP = [
+    "DROP TRIGGER IF EXISTS app_campaignsubscriber_search_insert",
+    "DROP TRIGGER IF EXISTS app_campaignsubscriber_search_delete",
+    "DROP TRIGGER IF EXISTS app_campaignsubscriber_search_update",
+    "DROP TABLE IF EXISTS app_campaignsubscriber_search",
+]
+
+# Trigram indexes serving the `icontains` lookups of Django, which compare
+# the upper-cased columns.
+POSTGRESQL_INDEX = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX app_campaignsubscriber_email_trgm "
+    "ON app_campaignsubscriber USING gin (UPPER(email) gin_trgm_ops)",
+    "CREATE INDEX app_campaignsubscriber_name_trgm "
+    "ON app_campaignsubscriber USING gin (UPPER(name) gin_trgm_ops)",
+]
+
+POSTGRESQL_DROP = [
+    "DROP INDEX IF EXISTS app_campaignsubscriber_email_trgm",
+    "DROP INDEX IF EXISTS app_campaignsubscriber_name_trgm",
+]
+
+
+def create_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        try:
+            for sql in SQLITE_INDEX:
+                schema_editor.execute(sql)
+        except OperationalError:
+            # FTS5 or its trigram tokenizer, of SQLite 3.34+, is missing, so
+            # searches fall back to scanning the subscribers.
+            for sql in SQLITE_DROP:
+                schema_editor.execute(sql)
+    elif vendor == 'postgresql':
+        for sql in POSTGRESQL_INDEX:
+            schema_editor.execute(sql)
+
+
+def drop_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        for sql in SQLITE_DROP:
+            schema_editor.execute(sql)
+    elif vendor == 'postgresql':
+        for sql in POSTGRESQL_DROP:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
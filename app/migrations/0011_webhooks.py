@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 08:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_subscriber_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('list_id', models.CharField(max_length=32)),
+                ('kind', models.CharField(choices=[('Subscribe', 'Subscribe'), ('Deactivate', 'Deactivate'), ('Update', 'Update')], max_length=10)),
+                ('email', models.EmailField(max_length=254)),
+                ('old_email', models.EmailField(blank=True, max_length=254)),
+                ('name', models.CharField(blank=True, max_length=64)),
+                ('state', models.CharField(choices=[('Active', 'Active'), ('Bounced', 'Bounced'), ('Deleted', 'Deleted'), ('Unconfirmed', 'Unconfirmed'), ('Unsubscribed', 'Unsubscribed')], max_length=12)),
+                ('date', models.DateTimeField(blank=True, null=True)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='campaignlist',
+            name='webhook_id',
+            field=models.CharField(blank=True, editable=False, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='campaignlist',
+            name='webhook_since',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
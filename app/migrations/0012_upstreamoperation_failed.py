@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 08:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0011_webhooks'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='upstreamoperation',
+            name='failed',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 08:28
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0012_upstreamoperation_failed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(max_length=254)),
+                ('date', models.DateTimeField()),
+                ('clist', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='webhook_watermarks', to='app.CampaignList')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='webhookwatermark',
+            unique_together=set([('clist', 'email')]),
+        ),
+    ]
@@ -1,11 +1,50 @@
 from __future__ import unicode_literals
 
+import os
+import datetime
+
 from django import forms
 from django.db import models
+from django.db import router
+from django.db import transaction
+from django.dispatch import receiver
+from django.db.models.signals import m2m_changed
+from django.db.models.signals import post_migrate
+from django.conf import settings
+from django.utils import timezone
 from django.core.exceptions import ValidationError
+from django.core.validators import MaxValueValidator
+from django.core.validators import MinValueValidator
+
+from .cache import invalidate
+from .cache import invalidate_lists
+
+from . import counters
+from . import deletion
+from . import search
+
+from .outbox import enqueue
+from .outbox import enqueue_many
+
 
-from .upstream import import_subscriber
-from .upstream import delete_subscriber
+STATES = (('Active', 'Active'),
+          ('Bounced', 'Bounced'),
+          ('Deleted', 'Deleted'),
+          ('Unconfirmed', 'Unconfirmed'),
+          ('Unsubscribed', 'Unsubscribed'))
+
+
+class SetDeletionMixin(object):
+    """Delete instances through the set-based deletions of `.deletion`."""
+
+    def _same(self, using=None):
+        """Return a queryset of self, on the db to delete it from."""
+        assert self.pk is not None, (
+            "%s object can't be deleted because its %s attribute is set "
+            "to None." % (self._meta.object_name, self._meta.pk.attname)
+        )
+        using = using or router.db_for_write(self.__class__, instance=self)
+        return self.__class__._default_manager.using(using).filter(pk=self.pk)
 
 
 def validate_external_id(_id):
@@ -14,7 +53,7 @@ def validate_external_id(_id):
         raise ValidationError("Invalid external ID")
 
 
-class CampaignClient(models.Model):
+class CampaignClient(SetDeletionMixin, models.Model):
     """The base campaign client entity model.
 
     This class stores basic, high-level client information as retrieved
@@ -32,23 +71,45 @@ class CampaignClient(models.Model):
     external_id = models.CharField(max_length=32, unique=True,
                                    validators=[validate_external_id])
 
+    # The time the client was last synced with Campaign Monitoring.
+    synced_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    @property
+    def stale(self):
+        """Whether the local copy is older than `settings.CLIENT_TTL`."""
+        return self.older_than(settings.CLIENT_TTL)
+
+    @property
+    def expired(self):
+        """Whether the local copy is older than `settings.CLIENT_MAX_AGE`."""
+        return self.older_than(settings.CLIENT_MAX_AGE)
+
+    def older_than(self, seconds):
+        """Whether the client was last synced more than `seconds` ago."""
+        if self.synced_at is None:
+            return True
+        age = timezone.now() - self.synced_at
+        return age > datetime.timedelta(seconds=seconds)
+
     def save(self, *args, **kwargs):
         """Perform full validation and save."""
         self.full_clean()
         super(CampaignClient, self).save(*args, **kwargs)
 
-    def delete(self, *args, **kwargs):
-        """Delete self alongside all associated lists and subscribers."""
-        for clist in self.campaignlist_set.all():
-            for sub in clist.campaignsubscriber_set.all():
-                sub.delete()
-        super(CampaignClient, self).delete(*args, **kwargs)
+    def delete(self, using=None, keep_parents=False):
+        """Delete self alongside all associated lists and subscribers.
+
+        Returns the number of rows deleted, and the number per model, as
+        `Model.delete` does. Clients have no parents to keep.
+
+        """
+        return deletion.delete_clients(self._same(using))
 
     def __str__(self):
         return 'Client %s (%s)' % (self.name or self.company, self.external_id)
 
 
-class CampaignList(models.Model):
+class CampaignList(SetDeletionMixin, models.Model):
     """A campaign list associated with a specific client.
 
     A campaign list groups subscribers logically together.
@@ -61,35 +122,72 @@ class CampaignList(models.Model):
     external_id = models.CharField(max_length=32,
                                    validators=[validate_external_id])
 
+    # The time of the last successful sync, from which the next incremental
+    # sync picks up.
+    synced_at = models.DateTimeField(null=True, blank=True, editable=False)
+
+    # The WebhookID of the webhook pushing the list's changes, if any, and
+    # the time it was registered. See `.webhooks`.
+    webhook_id = models.CharField(max_length=32, blank=True, editable=False)
+    webhook_since = models.DateTimeField(null=True, blank=True,
+                                         editable=False)
+
+    class Meta:
+        # Lists are looked up by their ListID within their client's.
+        unique_together = (('client', 'external_id'), )
+
     def subscribe(self, subscriber):
-        """Add `subscriber` to self."""
+        """Add `subscriber` to self.
+
+        The change is sent upstream asynchronously, through the outbox.
+
+        """
         assert isinstance(subscriber, CampaignSubscriber)
-        params = {'name': subscriber.name, 'email_address': subscriber.email}
-        import_subscriber(self.external_id, **params)
-        self.campaignsubscriber_set.add(subscriber)
+        subscriber.subscribe(self)
 
     def unsubscribe(self, subscriber):
-        """Remove `subscriber` from self."""
+        """Remove `subscriber` from self.
+
+        The change is sent upstream asynchronously, through the outbox.
+
+        """
         assert isinstance(subscriber, CampaignSubscriber)
-        delete_subscriber(self.external_id, subscriber.email)
-        self.campaignsubscriber_set.remove(subscriber)
+        with transaction.atomic():
+            self.campaignsubscriber_set.remove(subscriber)
+            enqueue(UpstreamOperation.UNSUBSCRIBE, self.external_id,
+                    subscriber.email)
+        invalidate(self.client.external_id)
+
+    @property
+    def state_counts(self):
+        """Map each state to the number of subscribers of self in it."""
+        return {counter.state: counter.count
+                for counter in self.counters.all()}
+
+    @property
+    def subscriber_count(self):
+        """The number of subscribers of self, regardless of their state."""
+        return sum(self.state_counts.values())
 
     def save(self, *args, **kwargs):
         """Perform full validation and save."""
         self.full_clean()
         super(CampaignList, self).save(*args, **kwargs)
 
-    def delete(self, *args, **kwargs):
-        """Delete a list and remove all of its subscribers."""
-        for subscriber in self.campaignsubscriber_set.all():
-            delete_subscriber(self.external_id, subscriber.email)
-        super(CampaignList, self).delete(*args, **kwargs)
+    def delete(self, using=None, keep_parents=False):
+        """Delete a list and remove all of its subscribers.
+
+        Returns the number of rows deleted, and the number per model, as
+        `Model.delete` does. Lists have no parents to keep.
+
+        """
+        return deletion.delete_lists(self._same(using))
 
     def __str__(self):
         return 'List "%s" of %s' % (self.name, self.client)
 
 
-class CampaignSubscriber(models.Model):
+class CampaignSubscriber(SetDeletionMixin, models.Model):
     """The base subscriber model.
 
     Each subscriber is identified by his e-mail address.
@@ -105,46 +203,169 @@ class CampaignSubscriber(models.Model):
 
     email = models.EmailField(unique=True)
     name = models.CharField(max_length=64)
-    state = models.CharField(max_length=12,
-                             default='Active',
-                             choices=(('Active', 'Active'),
-                                      ('Bounced', 'Bounced'),
-                                      ('Deleted', 'Deleted'),
-                                      ('Unconfirmed', 'Unconfirmed'),
-                                      ('Unsubscribed', 'Unsubscribed')))
+    state = models.CharField(max_length=12, default='Active', choices=STATES,
+                             db_index=True)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Remember the details loaded, in order to track changes."""
+        instance = super(CampaignSubscriber, cls).from_db(db, field_names,
+                                                          values)
+        instance._loaded_state = instance.__dict__.get('state')
+        instance._loaded_details = instance.details
+        return instance
+
+    @property
+    def details(self):
+        """The e-mail address, name and state of self, as shown on pages."""
+        return (self.__dict__.get('email'), self.__dict__.get('name'),
+                self.__dict__.get('state'))
 
     @property
     def active(self):
         return self.state == 'Active'
 
-    def subscribe(self, clist):
-        """Subscribe self to the specified list."""
-        assert isinstance(clist, CampaignList)
-        params = {'name': self.name, 'email_address': self.email}
-        import_subscriber(clist.external_id, **params)
-        self.lists.add(clist)
+    def subscribe(self, *clists):
+        """Subscribe self to the specified lists.
+
+        Self is added to all of them, and the changes are queued to be sent
+        upstream, with a single query each. See `.outbox`.
+
+        """
+        if not clists:
+            return
+        with transaction.atomic():
+            self.lists.add(*clists)
+            enqueue_many(UpstreamOperation.SUBSCRIBE, [
+                (clist.external_id, self.email, self.name)
+                for clist in clists
+            ])
+        invalidate(*set(clist.client.external_id for clist in clists))
 
     def unsubscribe(self, clist):
         """Unsubscribe self from the specific subscribtion list."""
-        assert isinstance(clist, CampaignList)
-        delete_subscriber(clist.external_id, self.email)
-        self.lists.remove(clist)
+        clist.unsubscribe(self)
 
     def save(self, *args, **kwargs):
         """Perform full validation and save."""
         self.full_clean()
         super(CampaignSubscriber, self).save(*args, **kwargs)
-
-    def delete(self, *args, **kwargs):
-        """Delete a subscriber both locally and remotely."""
-        for clist in self.lists.all():
-            delete_subscriber(clist.external_id, self.email)
-        super(CampaignSubscriber, self).delete(*args, **kwargs)
+        loaded_state = getattr(self, '_loaded_state', None)
+        if loaded_state is not None and loaded_state != self.state:
+            counters.transition(self, loaded_state, self.state)
+        self._loaded_state = self.state
+        # New subscribers are on no page yet, and changes to the lists of
+        # self alone are invalidated by the ones making them.
+        loaded = getattr(self, '_loaded_details', None)
+        self._loaded_details = self.details
+        if loaded is not None and loaded != self.details:
+            invalidate_lists(self.lists.all())
+
+    def delete(self, using=None, keep_parents=False):
+        """Delete a subscriber both locally and remotely.
+
+        Returns the number of rows deleted, and the number per model, as
+        `Model.delete` does. Subscribers have no parents to keep.
+
+        """
+        return deletion.delete_subscribers(self._same(using))
 
     def __str__(self):
         return 'Subscriber "%s"' % (self.name or self.email)
 
 
+class CampaignListCounter(models.Model):
+    """The number of subscribers of a campaign list in a specific state.
+
+    Counters are denormalized from the subscriptions of each list, so that
+    list sizes can be read without counting subscriptions. They are kept up
+    to date by `.counters` and can be recomputed by `manage.py recount-lists`.
+
+    """
+
+    clist = models.ForeignKey(CampaignList, on_delete=models.CASCADE,
+                              related_name='counters')
+
+    state = models.CharField(max_length=12, choices=STATES)
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = (('clist', 'state'), )
+
+    def __str__(self):
+        return '%s %s subscribers of %s' % (self.count, self.state, self.clist)
+
+
+class UpstreamOperation(models.Model):
+    """A subscription change pending to be sent to Campaign Monitoring.
+
+    Operations refer to lists by their ListID, so that they outlive the
+    lists deleted locally. See `.outbox`.
+
+    """
+
+    SUBSCRIBE = 'subscribe'
+    UNSUBSCRIBE = 'unsubscribe'
+
+    action = models.CharField(max_length=12,
+                              choices=((SUBSCRIBE, 'Subscribe'),
+                                       (UNSUBSCRIBE, 'Unsubscribe')))
+
+    list_id = models.CharField(max_length=32)
+    email = models.EmailField()
+    name = models.CharField(max_length=64, blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now,
+                                           db_index=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    # Whether the operation failed `settings.OUTBOX_MAX_ATTEMPTS` times, and
+    # is no longer retried.
+    failed = models.BooleanField(default=False)
+
+    class Meta:
+        index_together = (('list_id', 'email'), )
+
+    def __str__(self):
+        return '%s %s (%s)' % (self.action.title(), self.email, self.list_id)
+
+
+@receiver(m2m_changed, sender=CampaignSubscriber.lists.through)
+def count_subscriptions(sender, instance, action, reverse, pk_set, **kwargs):
+    """Keep list counters up to date as subscriptions are added or removed.
+
+    Removals are accounted for before they take place, so that only the
+    subscriptions that actually exist are subtracted.
+
+    """
+    if action in ('post_add', 'pre_remove'):
+        if reverse:
+            lookups = {'campaignlist': instance,
+                       'campaignsubscriber__in': pk_set}
+        else:
+            lookups = {'campaignsubscriber': instance,
+                       'campaignlist__in': pk_set}
+        sign = 1 if action == 'post_add' else -1
+    elif action == 'pre_clear':
+        if reverse:
+            lookups = {'campaignlist': instance}
+        else:
+            lookups = {'campaignsubscriber': instance}
+        sign = -1
+    else:
+        return
+    counters.update(counters.tally(**lookups), sign=sign)
+
+
+@receiver(post_migrate)
+def ensure_search_index(sender, using, **kwargs):
+    """Recreate the search index triggers dropped by migrations, if any."""
+    if sender.name == 'app':
+        search.ensure_index(using)
+
+
 class SubscriberCreationForm(forms.ModelForm):
     """A form for adding new subscribers to an existing list."""
 
@@ -153,3 +374,177 @@ class SubscriberCreationForm(forms.ModelForm):
     class Meta:
         model = CampaignSubscriber
         fields = ('name', 'email', )
+
+
+class ProfilingConfig(models.Model):
+    """The admin-set rate at which requests are profiled.
+
+    Only the first instance is taken into account. See `.profiling`.
+
+    """
+
+    sample_rate = models.FloatField(
+        default=0, validators=[MinValueValidator(0), MaxValueValidator(1)],
+        help_text='The fraction of requests to profile, from 0 to 1.',
+    )
+    path_prefix = models.CharField(
+        max_length=255, blank=True,
+        help_text='Only sample requests whose path starts with this.',
+    )
+
+    def __str__(self):
+        return 'Profile %g%% of requests to %s*' % (
+            self.sample_rate * 100, self.path_prefix or '/'
+        )
+
+
+class RequestProfile(models.Model):
+    """The profile of a single request, and the SQL it issued.
+
+    Only the latest `settings.PROFILE_KEEP` profiles are kept.
+
+    """
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    method = models.CharField(max_length=8)
+    path = models.CharField(max_length=255)
+    status = models.IntegerField()
+    duration = models.FloatField()
+    trigger = models.CharField(max_length=8, choices=(('header', 'Header'),
+                                                      ('sample', 'Sample')))
+
+    queries = models.IntegerField()
+    sql = models.TextField(blank=True)
+
+    # The top of the profile, and the whole of it, as dumped by `pstats`.
+    summary = models.TextField(blank=True)
+    stats = models.BinaryField()
+
+    def __str__(self):
+        return 'Profile of %s %s (%s)' % (self.method, self.path,
+                                          self.created_at)
+
+
+class SyncCheckpoint(models.Model):
+    """The progress of a resumable sync of a campaign list's subscribers.
+
+    A checkpoint records the last page of each status stored, alongside the
+    watermark and the start time of the sync, so that an interrupted sync
+    resumes from the next page. See `.upstream.sync_lists`.
+
+    """
+
+    clist = models.ForeignKey(CampaignList, on_delete=models.CASCADE,
+                              related_name='checkpoints')
+
+    status = models.CharField(max_length=12)
+    page = models.IntegerField(default=0)
+
+    # The watermark the sync started from, None for full syncs.
+    since = models.DateTimeField(null=True)
+    started_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('clist', 'status'), )
+
+    def __str__(self):
+        return 'Page %d of %s subscribers of %s' % (
+            self.page, self.status, self.clist
+        )
+
+
+class ImportJob(models.Model):
+    """A resumable import of subscribers from a CSV file into a list.
+
+    Rows are imported in batches, each recorded as processed alongside the
+    subscribers it stored, so that an interrupted job resumes from the row
+    after the last batch. See `.imports`.
+
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    clist = models.ForeignKey(CampaignList, on_delete=models.CASCADE,
+                              related_name='imports')
+
+    path = models.CharField(max_length=255)
+    status = models.CharField(max_length=8, default=PENDING,
+                              choices=((PENDING, 'Pending'),
+                                       (RUNNING, 'Running'),
+                                       (DONE, 'Done'),
+                                       (FAILED, 'Failed')))
+
+    total_rows = models.IntegerField(default=0)
+    rows_processed = models.IntegerField(default=0)
+    imported = models.IntegerField(default=0)
+    skipped = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    @property
+    def progress(self):
+        """The percentage of rows processed."""
+        if not self.total_rows:
+            return 100 if self.status == ImportJob.DONE else 0
+        return min(100, 100 * self.rows_processed // self.total_rows)
+
+    def __str__(self):
+        return 'Import of %s into %s' % (os.path.basename(self.path),
+                                         self.clist)
+
+
+class WebhookEvent(models.Model):
+    """A subscriber change pushed by a list webhook, pending to be applied.
+
+    Events are stored as they are received, and applied in bulk by
+    `manage.py apply-webhooks`. See `.webhooks`.
+
+    """
+
+    SUBSCRIBE = 'Subscribe'
+    DEACTIVATE = 'Deactivate'
+    UPDATE = 'Update'
+
+    list_id = models.CharField(max_length=32)
+    kind = models.CharField(max_length=10,
+                            choices=((SUBSCRIBE, 'Subscribe'),
+                                     (DEACTIVATE, 'Deactivate'),
+                                     (UPDATE, 'Update')))
+
+    email = models.EmailField()
+    old_email = models.EmailField(blank=True)
+    name = models.CharField(max_length=64, blank=True)
+    state = models.CharField(max_length=12, choices=STATES)
+
+    # The time of the change upstream, and of its receipt.
+    date = models.DateTimeField(null=True, blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '%s %s on %s' % (self.kind, self.email, self.list_id)
+
+
+class WebhookWatermark(models.Model):
+    """The date of the latest webhook event applied to a list's subscriber.
+
+    Events older than the watermark of their list and e-mail address, as
+    redelivered out of order by Campaign Monitoring, are skipped. See
+    `.webhooks.apply_events`.
+
+    """
+
+    clist = models.ForeignKey(CampaignList, on_delete=models.CASCADE,
+                              related_name='webhook_watermarks')
+    email = models.EmailField()
+    date = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('clist', 'email'), )
+
+    def __str__(self):
+        return '%s on %s at %s' % (self.email, self.clist, self.date)
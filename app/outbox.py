@@ -0,0 +1,175 @@
+"""Write-behind delivery of subscription changes to Campaign Monitoring.
+
+Instead of calling the createsend API within the request that changes a
+subscription, an `.models.UpstreamOperation` is stored alongside the local
+change. Pending operations are then sent upstream in bulk by `drain`, which
+is run by `manage.py drain-outbox`.
+
+"""
+
+import random
+import logging
+import datetime
+
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from .utils import chunked
+
+
+log = logging.getLogger(__name__)
+
+
+def enqueue(action, list_id, email, name=''):
+    """Store a subscription change to be sent upstream.
+
+    Arguments:
+        action      either "subscribe" or "unsubscribe"
+        list_id     the ListID assigned by Campaign Monitoring
+        email       the e-mail address of the subscriber
+        name        the name of the subscriber
+
+    """
+    enqueue_many(action, [(list_id, email, name)])
+
+
+def enqueue_many(action, subscriptions):
+    """Store many subscription changes to be sent upstream.
+
+    Any pending operations for the same list and e-mail address are
+    superseded by the new ones, so that at most one operation per
+    subscription is ever pending.
+
+    Arguments:
+        action          either "subscribe" or "unsubscribe"
+        subscriptions   an iterable of (ListID, e-mail, name) tuples
+
+    """
+    from .models import UpstreamOperation
+    with transaction.atomic():
+        for chunk in chunked(subscriptions, settings.SYNC_BATCH_SIZE):
+            emails = defaultdict(set)
+            for list_id, email, name in chunk:
+                emails[list_id].add(email)
+            for list_id, chunk_emails in emails.items():
+                UpstreamOperation.objects.filter(
+                    list_id=list_id, email__in=chunk_emails
+                ).delete()
+            UpstreamOperation.objects.bulk_create([
+                UpstreamOperation(action=action, list_id=list_id,
+                                  email=email, name=name or '')
+                for list_id, email, name in chunk
+            ])
+
+
+def pending():
+    """Return the number of operations not sent upstream yet."""
+    from .models import UpstreamOperation
+    return UpstreamOperation.objects.filter(failed=False).count()
+
+
+def failed():
+    """Return the number of operations that are no longer retried."""
+    from .models import UpstreamOperation
+    return UpstreamOperation.objects.filter(failed=True).count()
+
+
+def retry(operations=None):
+    """Queue failed operations to be sent again, with a fresh attempt count.
+
+    Arguments:
+        operations  a queryset of `.models.UpstreamOperation`, all failed
+                    ones by default
+
+    Returns the number of operations queued.
+
+    """
+    from .models import UpstreamOperation
+    if operations is None:
+        operations = UpstreamOperation.objects.all()
+    return operations.filter(failed=True).update(
+        failed=False, attempts=0, next_attempt_at=timezone.now()
+    )
+
+
+def backoff(attempts):
+    """Return the delay before retrying an operation that failed again."""
+    delay = min(settings.OUTBOX_MAX_DELAY,
+                settings.OUTBOX_RETRY_DELAY * 2 ** (attempts - 1))
+    return datetime.timedelta(seconds=random.uniform(delay / 2.0, delay))
+
+
+def drain(limit=None):
+    """Send due operations upstream in bulk.
+
+    Due operations are claimed for `settings.OUTBOX_LEASE` seconds, so that
+    concurrent workers do not send them twice. Subscriptions are sent as
+    bulk imports and unsubscriptions as concurrent deletions, grouped by
+    list. Operations that succeed are deleted, while failed ones are retried
+    later with exponential backoff, up to `settings.OUTBOX_MAX_ATTEMPTS`
+    times. Operations failing more often are marked as failed, and are kept
+    until retried with `retry`, or superseded.
+
+    Arguments:
+        limit   the maximum number of operations to send
+
+    Returns the number of operations sent, including failed ones.
+
+    """
+    from .models import UpstreamOperation
+    from .upstream import import_subscribers
+    from .upstream import delete_subscribers
+
+    now = timezone.now()
+    limit = limit or settings.IMPORT_BATCH_SIZE
+    due = UpstreamOperation.objects.filter(next_attempt_at__lte=now,
+                                           failed=False)
+    pks = due.order_by('pk').values_list('pk', flat=True)
+    last = list(pks[limit - 1:limit]) or list(pks.reverse()[:1])
+    if not last:
+        return 0
+    # Claim the due operations up to the last one by pk range, rather than
+    # by a list of pks, which could exceed the bound variables allowed by
+    # the db.
+    lease = now + datetime.timedelta(seconds=settings.OUTBOX_LEASE)
+    due.filter(pk__lte=last[0]).update(next_attempt_at=lease)
+    ops = list(UpstreamOperation.objects.filter(pk__lte=last[0],
+                                                next_attempt_at=lease))
+
+    groups = defaultdict(list)
+    for op in ops:
+        groups[(op.action, op.list_id)].append(op)
+
+    failures = {}
+    for (action, list_id), group in groups.items():
+        if action == UpstreamOperation.SUBSCRIBE:
+            failed = import_subscribers(list_id, group)
+        else:
+            failed = delete_subscribers(list_id, [op.email for op in group])
+        for op in group:
+            if op.email in failed:
+                failures[op] = failed[op.email]
+
+    sent = [op.pk for op in ops if op not in failures]
+    for chunk in chunked(sent, settings.SYNC_BATCH_SIZE):
+        UpstreamOperation.objects.filter(pk__in=chunk,
+                                         next_attempt_at=lease).delete()
+    for op, error in failures.items():
+        op.attempts += 1
+        op.last_error = error
+        op.next_attempt_at = timezone.now() + backoff(op.attempts)
+        op.failed = op.attempts >= settings.OUTBOX_MAX_ATTEMPTS
+        if op.failed:
+            log.error('Gave up on %s %s after %d attempts: %s', op.action,
+                      op.email, op.attempts, error)
+        else:
+            log.warning('Failed to %s %s (attempt %d): %s', op.action,
+                        op.email, op.attempts, error)
+        UpstreamOperation.objects.filter(
+            pk=op.pk, next_attempt_at=lease
+        ).update(attempts=op.attempts, last_error=op.last_error,
+                 next_attempt_at=op.next_attempt_at, failed=op.failed)
+    return len(ops)
@@ -0,0 +1,145 @@
+"""On-demand profiling of single requests.
+
+A request is profiled when it carries a valid token in the
+`settings.PROFILE_HEADER` header, as printed by `manage.py profile-token`,
+or when it is sampled at the rate set in the admin, see
+`.models.ProfilingConfig`. The request is then run under `cProfile`, and the
+SQL it issues is captured, into a `.models.RequestProfile` which can be
+downloaded from the admin and opened with `pstats` or any compatible viewer.
+
+The SQL is captured through `connection.queries_log`, which only keeps the
+latest 9000 queries (`connection.queries_limit`), so the SQL of requests
+issuing more is truncated to those. The debug cursor it requires is only
+enabled for the requests being profiled.
+
+Requests that are not profiled only cost a header lookup, and a comparison
+with the sampling rate, which is re-read every `settings.PROFILE_RATE_TTL`
+seconds.
+
+"""
+
+import time
+import random
+import logging
+import marshal
+import pstats
+import cProfile
+
+from django.conf import settings
+from django.core import signing
+from django.db import connection
+from django.utils.six import StringIO
+from django.utils.deprecation import MiddlewareMixin
+
+
+log = logging.getLogger(__name__)
+
+SALT = 'app.profiling'
+
+# The sampling rate and path prefix last read, and when.
+_config = {'rate': 0, 'prefix': '', 'read_at': None}
+
+
+def make_token():
+    """Return a token that triggers profiling of the requests carrying it."""
+    return signing.TimestampSigner(salt=SALT).sign('profile')
+
+
+def valid_token(token):
+    """Whether `token` has been made by `make_token` and has not expired."""
+    try:
+        signing.TimestampSigner(salt=SALT).unsign(
+            token, max_age=settings.PROFILE_TOKEN_MAX_AGE
+        )
+    except signing.BadSignature:
+        return False
+    return True
+
+
+def sampling():
+    """Return the sampling rate and path prefix set in the admin."""
+    now = time.time()
+    read_at = _config['read_at']
+    if read_at is None or now - read_at > settings.PROFILE_RATE_TTL:
+        from .models import ProfilingConfig
+        _config['read_at'] = now
+        try:
+            config = ProfilingConfig.objects.order_by('pk').first()
+        except Exception as exc:
+            log.error('Failed to read the profiling config: %r', exc)
+            config = None
+        _config['rate'] = config.sample_rate if config else 0
+        _config['prefix'] = config.path_prefix if config else ''
+    return _config['rate'], _config['prefix']
+
+
+def store(request, response, profiler, queries, duration, trigger):
+    """Store the profile of a request, dropping the oldest ones."""
+    from .models import RequestProfile
+    out = StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats('cumulative').print_stats(50)
+    RequestProfile.objects.create(
+        method=request.method,
+        path=request.path[:255],
+        status=response.status_code,
+        duration=duration,
+        trigger=trigger,
+        queries=len(queries),
+        sql='\n'.join('-- %ss\n%s;' % (query['time'], query['sql'])
+                      for query in queries),
+        summary=out.getvalue(),
+        stats=marshal.dumps(stats.stats),
+    )
+    stale = RequestProfile.objects.order_by(
+        '-pk'
+    ).values_list('pk', flat=True)[settings.PROFILE_KEEP:]
+    RequestProfile.objects.filter(pk__in=list(stale)).delete()
+
+
+class ProfilingMiddleware(MiddlewareMixin):
+    """Profile the requests triggered by a signed header or by sampling.
+
+    Only the view and the middleware below this one are profiled. Streaming
+    responses are profiled up to the point they are returned.
+
+    """
+
+    def trigger(self, request):
+        token = request.META.get(settings.PROFILE_HEADER)
+        if token is not None:
+            return 'header' if valid_token(token) else None
+        rate, prefix = sampling()
+        if rate and request.path.startswith(prefix):
+            if random.random() < rate:
+                return 'sample'
+        return None
+
+    def process_request(self, request):
+        trigger = self.trigger(request)
+        if trigger is None:
+            return
+        request._profiling = {'trigger': trigger,
+                              'debug_cursor': connection.force_debug_cursor,
+                              'queries': len(connection.queries_log),
+                              'profiler': cProfile.Profile(),
+                              'started': time.time()}
+        connection.force_debug_cursor = True
+        request._profiling['profiler'].enable()
+
+    def process_response(self, request, response):
+        profiling = getattr(request, '_profiling', None)
+        if profiling is None:
+            return response
+        profiling['profiler'].disable()
+        duration = time.time() - profiling['started']
+        queries = list(connection.queries_log)[profiling['queries']:]
+        connection.force_debug_cursor = profiling['debug_cursor']
+        del request._profiling
+        try:
+            store(request, response, profiling['profiler'], queries,
+                  duration, profiling['trigger'])
+        except Exception as exc:
+            log.error('Failed to store the profile of %s: %r', request.path,
+                      exc)
+        return response
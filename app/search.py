@@ -0,0 +1,151 @@
+"""Indexed substring search of subscribers by e-mail address and name.
+
+On SQLite, subscribers are indexed in an FTS5 table with the trigram
+tokenizer, `TABLE`, which is kept up to date by triggers on the subscriber
+table, so that saves, deletes and bulk syncs alike are indexed as part of the
+same statements. On PostgreSQL, trigram GIN indexes of the upper-cased
+e-mail address and name serve the `icontains` lookups directly. Both are
+created by migration 0010. Other backends, and SQLite builds without FTS5,
+fall back to `icontains` lookups, which scan the subscriber table.
+
+SQLite drops the triggers whenever Django remakes the subscriber table to
+alter it, so they are recreated, and the index rebuilt, after every
+`manage.py migrate`, see `ensure_index`. Until then the index is not used.
+
+A search matches the subscribers whose e-mail address or name contains every
+term of the query, in any case, as the admin search does.
+
+"""
+
+import logging
+
+from django.db import connections
+from django.db.models import Q
+
+
+log = logging.getLogger(__name__)
+
+
+# The FTS5 table indexing subscribers on SQLite.
+TABLE = 'app_campaignsubscriber_search'
+
+# The shortest term matched through the index. Shorter terms have no
+# trigrams, and are matched by scanning the subscribers found by the rest.
+MIN_TERM_LENGTH = 3
+
+# The triggers keeping `TABLE` up to date, as created by migration 0010.
+TRIGGERS = {
+    TABLE + '_insert':
+        "CREATE TRIGGER %s_insert "
+        "AFTER INSERT ON app_campaignsubscriber BEGIN "
+        "INSERT INTO %s (rowid, email, name) "
+        "VALUES (new.id, new.email, new.name); "
+        "END" % (TABLE, TABLE),
+    TABLE + '_delete':
+        "CREATE TRIGGER %s_delete "
+        "AFTER DELETE ON app_campaignsubscriber BEGIN "
+        "INSERT INTO %s (%s, rowid, email, name) "
+        "VALUES ('delete', old.id, old.email, old.name); "
+        "END" % (TABLE, TABLE, TABLE),
+    TABLE + '_update':
+        "CREATE TRIGGER %s_update "
+        "AFTER UPDATE OF email, name ON app_campaignsubscriber BEGIN "
+        "INSERT INTO %s (%s, rowid, email, name) "
+        "VALUES ('delete', old.id, old.email, old.name); "
+        "INSERT INTO %s (rowid, email, name) "
+        "VALUES (new.id, new.email, new.name); "
+        "END" % (TABLE, TABLE, TABLE, TABLE),
+}
+
+# Whether the FTS5 table and its triggers exist, per db alias.
+_indexed = {}
+
+
+def missing_triggers(connection):
+    """Return the names of the triggers of `TABLE` that do not exist."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+        existing = set(row[0] for row in cursor.fetchall())
+    return sorted(set(TRIGGERS) - existing)
+
+
+def indexed(using='default'):
+    """Whether subscribers are indexed in `TABLE` in the `using` db.
+
+    They are not if any of the triggers keeping the index up to date is
+    missing, in which case the index is stale until `ensure_index` is run.
+
+    """
+    if using not in _indexed:
+        connection = connections[using]
+        tables = connection.introspection.table_names()
+        _indexed[using] = connection.vendor == 'sqlite' and TABLE in tables
+        if _indexed[using]:
+            missing = missing_triggers(connection)
+            if missing:
+                log.warning('Not using the stale search index, missing %s',
+                            ', '.join(missing))
+                _indexed[using] = False
+    return _indexed[using]
+
+
+def ensure_index(using='default'):
+    """Recreate any missing trigger of `TABLE`, and then rebuild it.
+
+    Run after every migration, since SQLite drops the triggers along with
+    the subscriber table whenever it is remade.
+
+    """
+    _indexed.pop(using, None)
+    connection = connections[using]
+    if connection.vendor != 'sqlite':
+        return
+    if TABLE not in connection.introspection.table_names():
+        return
+    missing = missing_triggers(connection)
+    if not missing:
+        return
+    log.warning('Recreating %s and rebuilding the search index',
+                ', '.join(missing))
+    with connection.cursor() as cursor:
+        for name in missing:
+            cursor.execute(TRIGGERS[name])
+        cursor.execute("INSERT INTO %s (%s) VALUES ('rebuild')" % (TABLE,
+                                                                   TABLE))
+
+
+def match_expression(terms):
+    """Return the FTS5 query matching every one of `terms` as a substring."""
+    return ' AND '.join('"%s"' % term.replace('"', '""') for term in terms)
+
+
+def search(queryset, query):
+    """Filter a queryset of subscribers by the terms of `query`.
+
+    Arguments:
+        queryset    a queryset of `.models.CampaignSubscriber`
+        query       the space-separated terms to search for
+
+    """
+    terms = query.split()
+    if not terms:
+        return queryset
+    if indexed(queryset.db):
+        quote_name = connections[queryset.db].ops.quote_name
+        long_terms = [term for term in terms if len(term) >= MIN_TERM_LENGTH]
+        terms = [term for term in terms if len(term) < MIN_TERM_LENGTH]
+        if long_terms:
+            # A subquery in `pk__in` would be parenthesized twice, which
+            # SQLite reads as the first row of it, hence `extra`.
+            queryset = queryset.extra(
+                where=['%s.%s IN (SELECT rowid FROM %s WHERE %s MATCH %%s)' % (
+                    quote_name(queryset.model._meta.db_table),
+                    quote_name(queryset.model._meta.pk.column),
+                    TABLE, TABLE,
+                )],
+                params=[match_expression(long_terms)],
+            )
+    for term in terms:
+        matches = Q(email__icontains=term) | Q(name__icontains=term)
+        queryset = queryset.filter(matches)
+    return queryset
@@ -0,0 +1,104 @@
+"""Deduplication of concurrent calls across threads and processes."""
+
+import os
+import time
+import errno
+import fcntl
+import threading
+import contextlib
+
+
+class InFlight(Exception):
+    """Raised when a call in progress does not complete in time."""
+
+
+class _Call(object):
+    """The outcome of a call, shared with all of its waiters."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc = None
+
+
+class SingleFlight(object):
+    """Ensure that only a single call per key is in progress at any time.
+
+    The first caller for a key performs the call, while concurrent callers
+    in the same process wait for it and share its outcome. Callers across
+    processes are serialized through a file lock per key, so the function
+    called should first check whether its work has been done in the mean
+    time.
+
+    """
+
+    def __init__(self, lock_dir):
+        """Initialize a coordinator keeping its lock files in `lock_dir`."""
+        self.lock_dir = lock_dir
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def in_flight(self, key):
+        """Return whether a call for `key` is in progress in this process."""
+        with self._lock:
+            return key in self._calls
+
+    def do(self, key, func, timeout=None):
+        """Call `func` for `key`, unless a call is already in progress.
+
+        Arguments:
+            key         the key identifying the call
+            func        the function to call without any arguments
+            timeout     the maximum number of seconds to wait for a call in
+                        progress, after which `InFlight` is raised
+
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if not call.done.wait(timeout):
+                raise InFlight(key)
+            if call.exc is not None:
+                raise call.exc
+            return call.result
+
+        try:
+            with self._file_lock(key, timeout):
+                call.result = func()
+        except Exception as exc:
+            call.exc = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    @contextlib.contextmanager
+    def _file_lock(self, key, timeout):
+        """Hold an exclusive, inter-process lock for `key`."""
+        try:
+            os.makedirs(self.lock_dir)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        deadline = None if timeout is None else time.time() + timeout
+        with open(os.path.join(self.lock_dir, '%s.lock' % key), 'a') as fd:
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except (IOError, OSError) as exc:
+                    if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                if deadline is not None and time.time() >= deadline:
+                    raise InFlight(key)
+                time.sleep(0.1)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
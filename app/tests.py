@@ -0,0 +1,754 @@
+import os
+import json
+import time
+import shutil
+import sqlite3
+import tempfile
+import threading
+import datetime
+import unittest
+
+import createsend
+
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.test import TestCase
+from django.test import TransactionTestCase
+from django.test.utils import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from . import api
+from . import imports
+from . import outbox
+from . import webhooks
+from . import transport
+from . import upstream
+from . import profiling
+from . import search
+from .fake import FakeServer
+from .singleflight import InFlight
+from .singleflight import SingleFlight
+from .fake import FakeCreateSend
+from .models import CampaignList
+from .models import CampaignClient
+from .models import ImportJob
+from .models import UpstreamOperation
+from .models import WebhookEvent
+from .models import CampaignSubscriber
+
+
+class ViewTestCase(TestCase):
+    """A synced client with two lists, and a subscriber of the first."""
+
+    def setUp(self):
+        caches['pages'].clear()
+        # Read the sampling rate of the profiler, which is then cached, so
+        # that it is not counted as a query of the first request.
+        profiling.sampling()
+        self.client_ = CampaignClient.objects.create(
+            country='Greece', company='Acme', external_id='a' * 32,
+            synced_at=timezone.now(),
+        )
+        self.lists = [
+            CampaignList.objects.create(client=self.client_, name=name,
+                                        external_id=name * 32)
+            for name in 'bc'
+        ]
+        self.subscriber = CampaignSubscriber.objects.create(
+            email='known@example.com', name='Known', state='Active',
+        )
+        self.lists[0].subscribe(self.subscriber)
+        UpstreamOperation.objects.all().delete()
+
+    def subscribe(self, data):
+        return self.client.post(
+            reverse('add-subscriber',
+                    kwargs={'client_id': self.client_.external_id}),
+            data,
+        )
+
+
+class AddSubscriberToListTest(ViewTestCase):
+
+    def assertOwnershipLookups(self, queries, count=1):
+        lookups = [query for query in queries
+                   if 'FROM "app_campaignlist" INNER JOIN "app_campaignclient"'
+                   in query['sql']]
+        self.assertEqual(len(lookups), count)
+
+    def test_new_subscriber(self):
+        with self.assertNumQueries(21) as queries:
+            response = self.subscribe({
+                'email': 'new@example.com', 'name': 'New',
+                'lists': [clist.pk for clist in self.lists],
+            })
+        self.assertRedirects(response, reverse('client', kwargs={
+            'client_id': self.client_.external_id,
+        }), fetch_redirect_response=False)
+        self.assertOwnershipLookups(queries)
+        subscriber = CampaignSubscriber.objects.get(email='new@example.com')
+        self.assertEqual(set(subscriber.lists.all()), set(self.lists))
+        self.assertEqual(UpstreamOperation.objects.filter(
+            action=UpstreamOperation.SUBSCRIBE
+        ).count(), 2)
+
+    def test_existing_subscriber(self):
+        with self.assertNumQueries(19) as queries:
+            response = self.subscribe({
+                'email': self.subscriber.email, 'name': 'Renamed',
+                'lists': [clist.pk for clist in self.lists],
+            })
+        self.assertEqual(response.status_code, 302)
+        self.assertOwnershipLookups(queries)
+        self.subscriber.refresh_from_db()
+        self.assertEqual(self.subscriber.name, 'Renamed')
+        self.assertEqual(set(self.subscriber.lists.all()), set(self.lists))
+
+    def test_invalid_email(self):
+        response = self.subscribe({
+            'email': 'invalid', 'name': 'Invalid',
+            'lists': [self.lists[0].pk],
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('email', response.context['form'].errors)
+        self.assertFalse(CampaignSubscriber.objects.filter(
+            name='Invalid'
+        ).exists())
+        self.assertFalse(UpstreamOperation.objects.exists())
+
+    def test_list_of_another_client(self):
+        other = CampaignClient.objects.create(
+            country='Greece', company='Other', external_id='d' * 32,
+        )
+        clist = CampaignList.objects.create(client=other, name='d',
+                                            external_id='d' * 32)
+        response = self.subscribe({
+            'email': 'new@example.com', 'name': 'New',
+            'lists': [self.lists[0].pk, clist.pk],
+        })
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(UpstreamOperation.objects.exists())
+
+
+class RemoveSubscriberFromListTest(ViewTestCase):
+
+    def unsubscribe(self, clist):
+        return self.client.post(reverse('remove-subscriber', kwargs={
+            'client_id': self.client_.external_id,
+            'list_id': clist.external_id,
+            'subscriber_id': self.subscriber.pk,
+        }))
+
+    def test_last_list(self):
+        with self.assertNumQueries(24):
+            response = self.unsubscribe(self.lists[0])
+        self.assertEqual(response.status_code, 302)
+        self.assertFalse(CampaignSubscriber.objects.filter(
+            pk=self.subscriber.pk
+        ).exists())
+        self.assertEqual(UpstreamOperation.objects.filter(
+            action=UpstreamOperation.UNSUBSCRIBE
+        ).count(), 1)
+
+    def test_not_subscribed(self):
+        response = self.unsubscribe(self.lists[1])
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(UpstreamOperation.objects.exists())
+
+
+class CampaignClientDetailTest(ViewTestCase):
+
+    def get(self):
+        return self.client.get(reverse('client', kwargs={
+            'client_id': self.client_.external_id,
+        }))
+
+    def test_queries_do_not_grow_with_subscribers(self):
+        with self.assertNumQueries(5):
+            response = self.get()
+        self.assertContains(response, self.subscriber.email)
+
+        caches['pages'].clear()
+        for index in range(10):
+            subscriber = CampaignSubscriber.objects.create(
+                email='subscriber%d@example.com' % index, name='Subscriber',
+            )
+            for clist in self.lists:
+                clist.subscribe(subscriber)
+        with self.assertNumQueries(5):
+            response = self.get()
+        self.assertContains(response, 'subscriber9@example.com')
+
+    def test_cached_page(self):
+        self.get()
+        with self.assertNumQueries(1):
+            response = self.get()
+        self.assertEqual(response.status_code, 200)
+
+
+
+
+class AdminTest(ViewTestCase):
+
+    def setUp(self):
+        super(AdminTest, self).setUp()
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def test_list_memberships_are_queued(self):
+        other = CampaignSubscriber.objects.create(
+            email='other@example.com', name='Other', state='Active',
+        )
+        clist = self.lists[0]
+        membership = CampaignSubscriber.lists.through.objects.get(
+            campaignlist=clist
+        )
+        prefix = 'CampaignSubscriber_lists-'
+        response = self.client.post(
+            reverse('admin:app_campaignlist_change', args=[clist.pk]), {
+                prefix + 'TOTAL_FORMS': 2,
+                prefix + 'INITIAL_FORMS': 1,
+                prefix + '0-id': membership.pk,
+                prefix + '0-campaignlist': clist.pk,
+                prefix + '0-campaignsubscriber': self.subscriber.pk,
+                prefix + '0-DELETE': 'on',
+                prefix + '1-campaignlist': clist.pk,
+                prefix + '1-campaignsubscriber': other.pk,
+            },
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(list(clist.campaignsubscriber_set.all()), [other])
+        self.assertEqual(sorted(UpstreamOperation.objects.values_list(
+            'action', 'list_id', 'email'
+        )), [
+            (UpstreamOperation.SUBSCRIBE, clist.external_id, other.email),
+            (UpstreamOperation.UNSUBSCRIBE, clist.external_id,
+             self.subscriber.email),
+        ])
+        self.assertEqual(clist.state_counts, {'Active': 1})
+
+    def upload(self, content):
+        return self.client.post(reverse('admin:app_importjob_add'), {
+            'clist': self.lists[0].pk,
+            'file': SimpleUploadedFile('subscribers.csv', content),
+        })
+
+    def test_import_upload_is_stored_when_saved(self):
+        import_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, import_dir)
+        with override_settings(IMPORT_DIR=import_dir):
+            response = self.upload(b'email,name\n'
+                                   b'new@example.com,New\n'
+                                   b'other@example.com,Other\n')
+        self.assertEqual(response.status_code, 302)
+        job = ImportJob.objects.get()
+        self.assertEqual(job.total_rows, 2)
+        self.assertEqual(os.listdir(import_dir),
+                         [os.path.basename(job.path)])
+
+    def test_invalid_import_upload_leaves_no_file(self):
+        import_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, import_dir)
+        with override_settings(IMPORT_DIR=import_dir):
+            response = self.upload(b'email,name\n\xff\xfe,Invalid\n')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'Invalid CSV file')
+        self.assertFalse(ImportJob.objects.exists())
+        self.assertEqual(os.listdir(import_dir), [])
+
+
+class ImportBatchTest(ViewTestCase):
+
+    def test_inactive_subscribers_are_skipped(self):
+        clist = self.lists[1]
+        CampaignSubscriber.objects.create(
+            email='gone@example.com', name='Gone', state='Unsubscribed',
+        )
+        imported, skipped = imports.import_batch(clist, [
+            ('gone@example.com', 'Gone Again'),
+            ('known@example.com', ''),
+            ('new@example.com', 'New'),
+            ('invalid', 'Invalid'),
+        ])
+        self.assertEqual((imported, skipped), (2, 2))
+        self.assertEqual(sorted(clist.campaignsubscriber_set.values_list(
+            'email', 'name'
+        )), [('known@example.com', 'Known'), ('new@example.com', 'New')])
+        gone = CampaignSubscriber.objects.get(email='gone@example.com')
+        self.assertEqual((gone.name, gone.state), ('Gone', 'Unsubscribed'))
+        self.assertFalse(gone.lists.exists())
+        self.assertEqual(sorted(UpstreamOperation.objects.values_list(
+            'email', flat=True
+        )), ['known@example.com', 'new@example.com'])
+
+
+@override_settings(SYNC_STATUS=('active', ))
+class WebhookTest(ViewTestCase):
+
+    def post(self, *events, **kwargs):
+        clist = self.lists[0]
+        token = kwargs.get('token', webhooks.make_token(clist.external_id))
+        return self.client.post(
+            reverse('webhook', kwargs={'list_id': clist.external_id,
+                                       'token': token}),
+            json.dumps({'ListID': clist.external_id, 'Events': [
+                dict(zip(('Type', 'EmailAddress', 'Name', 'State', 'Date'),
+                         event[:5]), **(event[5] if len(event) > 5 else {}))
+                for event in events
+            ]}), content_type='application/json',
+        )
+
+    def push(self, *events):
+        self.assertEqual(self.post(*events).status_code, 200)
+        return webhooks.apply()
+
+    def subscribers(self):
+        return sorted(self.lists[0].campaignsubscriber_set.values_list(
+            'email', 'name', 'state'
+        ))
+
+    def test_bad_token(self):
+        response = self.post(('Subscribe', 'new@example.com', 'New',
+                              'Active', '2026-01-01 10:00:00'),
+                             token=webhooks.make_token(
+                                 self.lists[1].external_id
+                             ))
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_redelivered_batch(self):
+        batch = [
+            ('Subscribe', 'new@example.com', 'New', 'Active',
+             '2026-01-01 10:00:00'),
+            ('Deactivate', 'known@example.com', '', 'Unsubscribed',
+             '2026-01-01 10:00:00'),
+        ]
+        self.assertEqual(self.push(*batch), 2)
+        subscribers = self.subscribers()
+        self.assertEqual(subscribers, [
+            ('known@example.com', 'Known', 'Unsubscribed'),
+            ('new@example.com', 'New', 'Active'),
+        ])
+        self.assertEqual(self.push(*batch), 2)
+        self.assertEqual(self.subscribers(), subscribers)
+        self.assertEqual(self.lists[0].state_counts,
+                         {'Active': 1, 'Unsubscribed': 1})
+
+    def test_older_event_after_newer_one(self):
+        self.push(('Deactivate', 'known@example.com', '', 'Unsubscribed',
+                   '2026-01-02 10:00:00'))
+        self.push(('Subscribe', 'known@example.com', 'Known', 'Active',
+                   '2026-01-01 10:00:00'))
+        self.assertEqual(self.subscribers(), [
+            ('known@example.com', 'Known', 'Unsubscribed'),
+        ])
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_renamed_subscriber(self):
+        self.push(('Update', 'renamed@example.com', 'Renamed', 'Active',
+                   '2026-01-01 10:00:00',
+                   {'OldEmailAddress': 'known@example.com'}))
+        self.assertEqual(self.subscribers(), [
+            ('renamed@example.com', 'Renamed', 'Active'),
+        ])
+        self.assertFalse(CampaignSubscriber.objects.filter(
+            email='known@example.com'
+        ).exists())
+
+    def test_state_not_synced(self):
+        self.push(('Deactivate', 'ghost@example.com', 'Ghost', 'Unsubscribed',
+                   '2026-01-01 10:00:00'))
+        self.assertFalse(CampaignSubscriber.objects.filter(
+            email='ghost@example.com'
+        ).exists())
+        self.assertEqual(self.subscribers(), [
+            ('known@example.com', 'Known', 'Active'),
+        ])
+
+    @override_settings(SYNC_STATUS=('active', 'unsubscribed'))
+    def test_counters(self):
+        self.push(
+            ('Subscribe', 'new@example.com', 'New', 'Active',
+             '2026-01-01 10:00:00'),
+            ('Subscribe', 'other@example.com', 'Other', 'Active',
+             '2026-01-01 10:00:00'),
+            ('Deactivate', 'other@example.com', '', 'Unsubscribed',
+             '2026-01-01 11:00:00'),
+        )
+        clist = CampaignList.objects.get(pk=self.lists[0].pk)
+        self.assertEqual(clist.state_counts,
+                         {'Active': 2, 'Unsubscribed': 1})
+        # The name is that of the earlier event of the batch.
+        self.assertIn(('other@example.com', 'Other', 'Unsubscribed'),
+                      self.subscribers())
+        self.assertEqual(clist.subscriber_count,
+                         clist.campaignsubscriber_set.count())
+
+
+
+class APITest(ViewTestCase):
+
+    def setUp(self):
+        super(APITest, self).setUp()
+        clist = self.lists[0]
+        for index in range(11):
+            CampaignSubscriber.objects.create(
+                email='subscriber%02d@example.com' % index, name='Subscriber',
+            ).subscribe(clist)
+        self.url = reverse('api-subscribers', kwargs={
+            'client_id': self.client_.external_id,
+            'list_id': clist.external_id,
+        })
+
+    def test_pages_cover_every_subscriber_once(self):
+        emails = []
+        url = self.url + '?limit=5'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            page = response.json()
+            self.assertLessEqual(len(page['results']), 5)
+            emails.extend(item['email'] for item in page['results'])
+            if len(emails) == 5:
+                # Deleting a subscriber already served shifts no later ones
+                # out of the next page.
+                CampaignSubscriber.objects.filter(email=emails[0]).delete()
+            url = page['next']
+        self.assertEqual(len(emails), 12)
+        self.assertEqual(set(emails), set(
+            CampaignSubscriber.objects.values_list('email', flat=True)
+        ) | {emails[0]})
+
+    def test_lists_are_paged(self):
+        url = reverse('api-lists', kwargs={
+            'client_id': self.client_.external_id,
+        }) + '?limit=1'
+        ids = []
+        while url:
+            page = self.client.get(url).json()
+            ids.extend(clist['id'] for clist in page['results'])
+            url = page['next']
+        self.assertEqual(ids, [clist.external_id for clist in self.lists])
+
+    def test_bad_cursor(self):
+        for cursor in ('!', 'e30', api.encode_cursor('1')):
+            response = self.client.get(self.url, {'cursor': cursor})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json(), {'error': 'Invalid cursor'})
+
+    @override_settings(API_MAX_PAGE_SIZE=10)
+    def test_bad_limit(self):
+        for limit in ('', 'ten', '0', '-1', '11'):
+            response = self.client.get(self.url, {'limit': limit})
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('error', response.json())
+
+
+class SearchTest(ViewTestCase):
+
+    def setUp(self):
+        super(SearchTest, self).setUp()
+        if search.TABLE not in connection.introspection.table_names():
+            self.skipTest('SQLite was built without FTS5')
+        self.addCleanup(search._indexed.clear)
+
+    def find(self, query):
+        return list(search.search(CampaignSubscriber.objects.all(), query))
+
+    def matches(self, term):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT rowid FROM %s WHERE %s MATCH %%s' % (
+                search.TABLE, search.TABLE,
+            ), [search.match_expression([term])])
+            return [row[0] for row in cursor.fetchall()]
+
+    def test_triggers_exist_after_migrate(self):
+        self.assertEqual(search.missing_triggers(connection), [])
+        self.assertTrue(search.indexed())
+        self.assertEqual(self.find('KNOWN@example'), [self.subscriber])
+
+    def test_missing_trigger_is_recreated(self):
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TRIGGER %s_insert' % search.TABLE)
+        search._indexed.clear()
+        self.assertEqual(search.missing_triggers(connection),
+                         [search.TABLE + '_insert'])
+        self.assertFalse(search.indexed())
+        subscriber = CampaignSubscriber.objects.create(
+            email='unindexed@example.com', name='Unindexed',
+        )
+        # Not indexed, and found by scanning the subscribers instead.
+        self.assertEqual(self.matches('unindexed'), [])
+        self.assertEqual(self.find('unindexed'), [subscriber])
+
+        search.ensure_index()
+        self.assertEqual(search.missing_triggers(connection), [])
+        self.assertTrue(search.indexed())
+        self.assertEqual(self.matches('unindexed'), [subscriber.pk])
+        self.assertEqual(self.find('unindexed'), [subscriber])
+
+# Keeps tests against the fake API from waiting on the limiter or on retries.
+fake_api_settings = override_settings(
+    UPSTREAM_RATE=1000.0, UPSTREAM_BURST=1000,
+    UPSTREAM_RETRY_DELAY=0.01, UPSTREAM_MAX_RETRY_DELAY=0.05,
+)
+
+
+class FakeAPIMixin(object):
+    """Runs against a `FakeCreateSend` API with a list of 10 subscribers."""
+
+    @classmethod
+    def setUpClass(cls):
+        super(FakeAPIMixin, cls).setUpClass()
+        cls.base_uri = createsend.CreateSend.base_uri
+        cls.server = FakeServer(FakeCreateSend()).start()
+        transport.install(cls.server.base_uri)
+
+    @classmethod
+    def tearDownClass(cls):
+        transport.close_pools()
+        cls.server.shutdown()
+        cls.server.server_close()
+        createsend.CreateSend.base_uri = cls.base_uri
+        super(FakeAPIMixin, cls).tearDownClass()
+
+    def setUp(self):
+        # Limiters and breakers are kept per process, so start afresh.
+        transport._limiters.clear()
+        transport._breakers.clear()
+        self.api = self.server.api = FakeCreateSend()
+        self.client_id = self.api.add_client(10, lists=1)
+        self.list_id = self.api.clients[self.client_id]['lists'][0]
+
+
+@fake_api_settings
+class FakeAPITestCase(FakeAPIMixin, TestCase):
+    pass
+
+
+class DrainTest(FakeAPITestCase):
+
+    def enqueue(self, count, action=UpstreamOperation.SUBSCRIBE):
+        outbox.enqueue_many(action, [
+            (self.list_id, 'subscriber%d@example.com' % index, 'Subscriber')
+            for index in range(count)
+        ])
+
+    @unittest.skipUnless(connection.vendor == 'sqlite' and
+                         hasattr(sqlite3.Connection, 'setlimit'),
+                         'needs to lower the limit of SQLite variables')
+    @override_settings(IMPORT_BATCH_SIZE=1000)
+    def test_more_operations_than_sqlite_variables(self):
+        self.enqueue(1200)
+        connection.ensure_connection()
+        limit = connection.connection.setlimit(
+            sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999
+        )
+        try:
+            self.assertEqual(outbox.drain(), 1000)
+            self.assertEqual(outbox.drain(), 200)
+        finally:
+            connection.connection.setlimit(
+                sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, limit
+            )
+        self.assertFalse(UpstreamOperation.objects.exists())
+        self.assertEqual(self.api.calls['import_subscribers'], 2)
+        self.assertEqual(len(self.api.lists[self.list_id].changes), 1200)
+
+    def test_newer_operation_supersedes_pending_one(self):
+        self.enqueue(2)
+        self.enqueue(1, action=UpstreamOperation.UNSUBSCRIBE)
+        self.assertEqual(sorted(UpstreamOperation.objects.values_list(
+            'email', 'action'
+        )), [
+            ('subscriber0@example.com', UpstreamOperation.UNSUBSCRIBE),
+            ('subscriber1@example.com', UpstreamOperation.SUBSCRIBE),
+        ])
+        self.assertEqual(outbox.drain(), 2)
+        self.assertEqual(self.api.calls['delete_subscriber'], 1)
+        self.assertEqual(self.api.calls['import_subscribers'], 1)
+
+    @override_settings(OUTBOX_RETRY_DELAY=60, OUTBOX_MAX_DELAY=3600)
+    def test_failure_is_retried_later(self):
+        self.list_id = 'f' * 32  # Unknown to the fake API.
+        self.enqueue(1)
+        started = timezone.now()
+        self.assertEqual(outbox.drain(), 1)
+        op = UpstreamOperation.objects.get()
+        self.assertEqual(op.attempts, 1)
+        self.assertFalse(op.failed)
+        self.assertIn('Invalid ListID', op.last_error)
+        self.assertGreaterEqual(op.next_attempt_at,
+                                started + datetime.timedelta(seconds=30))
+        # Not due yet.
+        self.assertEqual(outbox.drain(), 0)
+        self.assertEqual(outbox.pending(), 1)
+
+        UpstreamOperation.objects.update(next_attempt_at=timezone.now())
+        self.assertEqual(outbox.drain(), 1)
+        op = UpstreamOperation.objects.get()
+        self.assertEqual(op.attempts, 2)
+        self.assertGreaterEqual(op.next_attempt_at,
+                                started + datetime.timedelta(seconds=60))
+
+    @override_settings(OUTBOX_MAX_ATTEMPTS=2)
+    def test_failed_after_max_attempts(self):
+        self.list_id = 'f' * 32
+        self.enqueue(1)
+        for attempt in range(2):
+            UpstreamOperation.objects.update(next_attempt_at=timezone.now())
+            self.assertEqual(outbox.drain(), 1)
+        op = UpstreamOperation.objects.get()
+        self.assertTrue(op.failed)
+        self.assertEqual(op.attempts, 2)
+        self.assertEqual((outbox.pending(), outbox.failed()), (0, 1))
+
+        UpstreamOperation.objects.update(next_attempt_at=timezone.now())
+        calls = sum(self.api.calls.values())
+        self.assertEqual(outbox.drain(), 0)
+        self.assertEqual(sum(self.api.calls.values()), calls)
+
+        self.assertEqual(outbox.retry(), 1)
+        self.assertEqual((outbox.pending(), outbox.failed()), (1, 0))
+        self.assertEqual(UpstreamOperation.objects.get().attempts, 0)
+
+
+@override_settings(UPSTREAM_RETRIES=2, UPSTREAM_BREAKER_THRESHOLD=5,
+                   UPSTREAM_BREAKER_COOLDOWN=60)
+class TransportTest(FakeAPITestCase):
+
+    def details(self):
+        return upstream.get_client_details(self.client_id)
+
+    def limiter(self):
+        limiter, = transport._limiters.values()
+        return limiter
+
+    def test_server_error_is_retried(self):
+        self.api.fail(503, count=2)
+        self.assertEqual(self.details().ClientID, self.client_id)
+        self.assertEqual(self.api.calls['fault'], 2)
+        self.assertEqual(self.api.calls['client_details'], 1)
+
+    def test_server_error_is_not_retried_past_retries(self):
+        self.api.fail(500, count=3)
+        with self.assertRaises(createsend.ServerError):
+            self.details()
+        self.assertEqual(self.api.calls['fault'], 3)
+
+    def test_post_is_not_retried(self):
+        self.api.fail(500)
+        with self.assertRaises(createsend.ServerError):
+            upstream.import_subscriber(self.list_id, email_address='a@b.com',
+                                       name='A')
+        self.assertEqual(self.api.calls['fault'], 1)
+        self.assertEqual(self.api.calls['add_subscriber'], 0)
+
+    def test_throttled_request_is_retried(self):
+        self.api.fail(429, retry_after=0)
+        self.assertEqual(self.details().ClientID, self.client_id)
+        self.assertEqual(self.api.calls['client_details'], 1)
+        self.assertLess(self.limiter().rate, 1000.0)
+
+    def test_long_retry_after_is_not_waited_for(self):
+        self.api.fail(429, retry_after=3600)
+        started = time.time()
+        with self.assertRaises(createsend.ClientError):
+            self.details()
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(self.api.calls['fault'], 1)
+        # The pause of the API key is capped too.
+        self.assertLessEqual(self.limiter().updated, time.time() + 0.05)
+
+    def test_retry_after_is_capped(self):
+        self.assertLessEqual(transport.backoff(0, retry_after=3600), 0.05)
+        self.assertGreaterEqual(transport.backoff(0, retry_after=0.04), 0.04)
+
+    @override_settings(UPSTREAM_BREAKER_THRESHOLD=2)
+    def test_breaker_opens_after_consecutive_failures(self):
+        self.api.fail(500, count=3)
+        with self.assertRaises(transport.CircuitOpen):
+            self.details()
+        self.assertFalse(transport.available())
+        with self.assertRaises(transport.CircuitOpen):
+            self.details()
+        self.assertEqual(self.api.calls['fault'], 2)
+
+
+@override_settings(METRICS_ALLOWED_IPS=['127.0.0.1'], METRICS_TOKEN='secret')
+class MetricsTest(FakeAPITestCase):
+
+    def get(self, **extra):
+        return self.client.get(reverse('metrics'), **extra)
+
+    def test_allowed_ip(self):
+        self.assertEqual(self.get().status_code, 200)
+
+    def test_other_ip(self):
+        self.assertEqual(self.get(REMOTE_ADDR='10.0.0.1').status_code, 403)
+        self.assertEqual(self.get(
+            REMOTE_ADDR='10.0.0.1', HTTP_AUTHORIZATION='Bearer wrong',
+        ).status_code, 403)
+        self.assertEqual(self.get(
+            REMOTE_ADDR='10.0.0.1', HTTP_AUTHORIZATION='Bearer secret',
+        ).status_code, 200)
+
+    @override_settings(METRICS_TOKEN='')
+    def test_no_token(self):
+        self.assertEqual(self.get(
+            REMOTE_ADDR='10.0.0.1', HTTP_AUTHORIZATION='Bearer ',
+        ).status_code, 403)
+
+    def test_sync_metrics_have_no_ids(self):
+        upstream.sync_client(self.client_id)
+        content = self.get().content.decode()
+        self.assertIn('sync_subscribers_processed_total', content)
+        self.assertNotIn(self.list_id, content)
+        self.assertNotIn(self.client_id, content)
+
+
+@fake_api_settings
+class SingleFlightTest(FakeAPIMixin, TransactionTestCase):
+    """Concurrent syncs of a client, run in threads with their own db
+    connections, which is why the db is not kept in a transaction."""
+
+    def sync(self, results):
+        try:
+            results.append(upstream.sync_client_once(self.client_id))
+        except Exception as exc:
+            results.append(exc)
+        finally:
+            connection.close()
+
+    @override_settings(SYNC_WAIT_TIMEOUT=0)
+    def test_concurrent_syncs_call_upstream_once(self):
+        results = []
+        threads = [threading.Thread(target=self.sync, args=(results, ))
+                   for index in range(2)]
+        # Hold the lock of the sync, as another process would, so that the
+        # first thread keeps it in flight until released.
+        other_process = SingleFlight(upstream._flights.lock_dir)
+        with other_process._file_lock(self.client_id, None):
+            for thread in threads:
+                thread.start()
+            while not upstream._flights.in_flight(self.client_id):
+                time.sleep(0.01)
+            with self.assertRaises(InFlight):
+                upstream.sync_client_once(self.client_id, timeout=0)
+            response = self.client.get(
+                reverse('client', kwargs={'client_id': self.client_id})
+            )
+            self.assertEqual(response.status_code, 202)
+        for thread in threads:
+            thread.join(10)
+
+        self.assertEqual(len(results), 2)
+        client = CampaignClient.objects.get(external_id=self.client_id)
+        self.assertEqual(results, [client, client])
+        self.assertEqual(dict(self.api.calls), {
+            'client_details': 1, 'client_lists': 1, 'list_subscribers': 1,
+        })
+        self.assertEqual(CampaignSubscriber.objects.count(), 10)
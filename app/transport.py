@@ -0,0 +1,386 @@
+"""Persistent, pooled HTTP connections for the createsend API client.
+
+The createsend library opens a new HTTPS connection for every request. Once
+`install`-ed, connections are drawn from a pool of persistent connections per
+host instead, so that a series of requests pays for the TCP and TLS setup
+once. Responses are requested gzip-compressed.
+
+Requests are also paced by a token bucket per API key, which slows down when
+throttled upstream, retried with jittered exponential backoff when that is
+safe, and short-circuited by a circuit breaker per host while the API keeps
+failing.
+
+"""
+
+import time
+import base64
+import random
+import socket
+import threading
+
+import createsend
+import createsend.createsend
+
+from createsend.utils import VerifiedHTTPSConnection
+
+from django.conf import settings
+from django.utils.six.moves.urllib.parse import urlparse
+from django.utils.http import parse_http_date_safe
+from django.utils.six.moves import queue
+from django.utils.six.moves import http_client
+
+
+class ConnectionPool(object):
+    """A thread-safe pool of persistent connections to a single host."""
+
+    def __init__(self, host, size, timeout, secure=True):
+        """Initialize a pool keeping up to `size` idle connections."""
+        self.host = host
+        self.timeout = timeout
+        self.secure = secure
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def connect(self):
+        """Return a new connection."""
+        if not self.secure:
+            return http_client.HTTPConnection(self.host, timeout=self.timeout)
+        return VerifiedHTTPSConnection(self.host, timeout=self.timeout)
+
+    def acquire(self):
+        """Return an idle connection, or a new one if none is available.
+
+        Returns a tuple of the connection and whether it has been used
+        before.
+
+        """
+        try:
+            return self.idle.get_nowait(), True
+        except queue.Empty:
+            return self.connect(), False
+
+    def release(self, conn):
+        """Return a connection to the pool, or close it if the pool is full."""
+        try:
+            self.idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        """Close the idle connections."""
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class RateLimiter(object):
+    """A thread-safe token bucket, adapting its rate to upstream throttling.
+
+    The rate is halved and requests are paused whenever upstream responds
+    with a 429, and is then increased gradually back to its configured
+    maximum on every successful request.
+
+    """
+
+    def __init__(self, rate, burst, max_pause=None):
+        """Initialize a bucket allowing `rate` requests per second.
+
+        Pauses asked for by upstream are capped at `max_pause` seconds, if
+        given.
+
+        """
+        self.max_rate = self.rate = float(rate)
+        self.burst = self.tokens = float(burst)
+        self.max_pause = max_pause
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        while True:
+            with self.lock:
+                now = time.time()
+                elapsed = max(0, now - self.updated)
+                self.tokens = min(self.burst,
+                                  self.tokens + elapsed * self.rate)
+                self.updated = max(now, self.updated)
+                wait = self.updated - now
+                if not wait:
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttle(self, retry_after=None):
+        """Slow down after being throttled, pausing for `retry_after`."""
+        with self.lock:
+            self.rate = max(self.rate / 2, self.max_rate / 100)
+            self.tokens = 0
+            if retry_after:
+                if self.max_pause is not None:
+                    retry_after = min(retry_after, self.max_pause)
+                self.updated = max(self.updated, time.time() + retry_after)
+
+    def success(self):
+        """Speed up after a successful request."""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+class CircuitOpen(createsend.Unavailable):
+    """Raised instead of sending requests to a host that keeps failing."""
+
+
+class CircuitBreaker(object):
+    """Fail fast after too many consecutive failures of a host.
+
+    After `threshold` consecutive failures, requests fail immediately for
+    `cooldown` seconds. A single trial request is then let through, which
+    either closes the circuit or opens it for another cooldown period.
+
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def open(self):
+        """Whether requests are currently failing fast."""
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            return time.time() - self.opened_at < self.cooldown
+
+    def check(self):
+        """Raise `CircuitOpen`, unless a request may be sent."""
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if time.time() - self.opened_at < self.cooldown:
+                raise CircuitOpen()
+            # Let this request through as a trial, failing others fast.
+            self.opened_at = time.time()
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
+
+
+_pools = {}
+_breakers = {}
+_limiters = {}
+_registry_lock = threading.Lock()
+
+
+def get_pool(host):
+    """Return the connection pool of `host`, creating it if necessary."""
+    with _registry_lock:
+        if host not in _pools:
+            # Plain HTTP is only used against a local stand-in of the API.
+            base_uri = urlparse(createsend.CreateSend.base_uri)
+            secure = base_uri.netloc != host or base_uri.scheme != 'http'
+            _pools[host] = ConnectionPool(host, settings.UPSTREAM_POOL_SIZE,
+                                          settings.UPSTREAM_TIMEOUT, secure)
+        return _pools[host]
+
+
+def close_pools():
+    """Close the idle connections of every pool.
+
+    Called before shutting down a local stand-in of the API, whose handler
+    threads would otherwise be left waiting on the connections.
+
+    """
+    with _registry_lock:
+        for pool in _pools.values():
+            pool.close()
+
+
+def get_breaker(host):
+    """Return the circuit breaker of `host`, creating it if necessary."""
+    with _registry_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(
+                settings.UPSTREAM_BREAKER_THRESHOLD,
+                settings.UPSTREAM_BREAKER_COOLDOWN,
+            )
+        return _breakers[host]
+
+
+def get_limiter(authorization):
+    """Return the rate limiter of the API key used in `authorization`.
+
+    The rate of each API key may be set in `settings.UPSTREAM_RATE_LIMITS`,
+    falling back to `settings.UPSTREAM_RATE`.
+
+    """
+    with _registry_lock:
+        if authorization not in _limiters:
+            api_key = None
+            scheme, _, credentials = (authorization or '').partition(' ')
+            if scheme == 'Basic':
+                api_key = base64.b64decode(credentials.encode()).decode()
+                api_key = api_key.partition(':')[0]
+            rate = settings.UPSTREAM_RATE_LIMITS.get(api_key,
+                                                     settings.UPSTREAM_RATE)
+            _limiters[authorization] = RateLimiter(
+                rate, settings.UPSTREAM_BURST,
+                max_pause=settings.UPSTREAM_MAX_RETRY_DELAY,
+            )
+        return _limiters[authorization]
+
+
+def available():
+    """Whether requests to the createsend API are currently let through."""
+    host = urlparse(createsend.CreateSend.base_uri).netloc
+    return not get_breaker(host).open
+
+
+def parse_retry_after(value):
+    """Return the seconds to wait, as specified by a Retry-After header."""
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        date = parse_http_date_safe(value)
+        return None if date is None else max(0, date - time.time())
+
+
+def backoff(attempt, retry_after=None):
+    """Return the jittered delay before retrying a failed request.
+
+    The delay is at least `retry_after`, and at most
+    `settings.UPSTREAM_MAX_RETRY_DELAY` either way.
+
+    """
+    max_delay = settings.UPSTREAM_MAX_RETRY_DELAY
+    delay = min(max_delay, settings.UPSTREAM_RETRY_DELAY * 2 ** attempt)
+    return max(random.uniform(delay / 2.0, delay),
+               min(retry_after or 0, max_delay))
+
+
+class PooledConnection(object):
+    """A drop-in replacement for createsend's `VerifiedHTTPSConnection`.
+
+    The request is sent over a pooled connection, which is returned to the
+    pool once the response has been fully read and the connection is closed
+    by createsend. A request that fails over a reused connection, which may
+    have been closed by the server in the mean time, is retried once over a
+    new connection.
+
+    Requests that are throttled, as well as idempotent requests that fail,
+    are retried up to `settings.UPSTREAM_RETRIES` times. Requests throttled
+    for longer than `settings.UPSTREAM_MAX_RETRY_DELAY` are not retried,
+    and count as failures of the host. The response of the last attempt is
+    handed to createsend, which raises accordingly.
+
+    """
+
+    IDEMPOTENT = ('GET', 'HEAD', 'PUT', 'DELETE', )
+
+    def __init__(self, host, *args, **kwargs):
+        self.pool = get_pool(host)
+        self.breaker = get_breaker(host)
+        self.conn = None
+        self.response = None
+
+    def request(self, method, url, body=None, headers=None):
+        headers = dict(headers or {})
+        # createsend only knows how to decompress gzip-encoded responses.
+        headers['Accept-Encoding'] = 'gzip'
+        limiter = get_limiter(headers.get('Authorization'))
+        retries = settings.UPSTREAM_RETRIES
+        attempt = 0
+        while True:
+            self.breaker.check()
+            limiter.acquire()
+            try:
+                self.send(method, url, body, headers)
+            except (socket.error, http_client.HTTPException):
+                self.breaker.failure()
+                if method not in self.IDEMPOTENT or attempt >= retries:
+                    raise
+                retry_after = None
+            else:
+                status = self.response.status
+                if status == 429:
+                    # Throttled requests have not been processed upstream.
+                    retry_after = parse_retry_after(
+                        self.response.getheader('Retry-After')
+                    )
+                    limiter.throttle(retry_after)
+                    retry = attempt < retries
+                    if (retry_after or 0) > settings.UPSTREAM_MAX_RETRY_DELAY:
+                        # Not worth blocking for, so fail now, as the host
+                        # is as good as unavailable.
+                        self.breaker.failure()
+                        retry = False
+                elif status >= 500:
+                    self.breaker.failure()
+                    retry_after = None
+                    retry = method in self.IDEMPOTENT and attempt < retries
+                else:
+                    self.breaker.success()
+                    limiter.success()
+                    return
+                if not retry:
+                    return
+                self.response.read()
+                self.close()
+            time.sleep(backoff(attempt, retry_after))
+            attempt += 1
+
+    def send(self, method, url, body, headers):
+        """Send a request over a pooled connection and get its response."""
+        conn, reused = self.pool.acquire()
+        while True:
+            try:
+                conn.request(method, url, body, headers)
+                self.response = conn.getresponse()
+            except (socket.error, http_client.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+                conn, reused = self.pool.connect(), False
+            else:
+                self.conn = conn
+                return
+
+    def getresponse(self):
+        return self.response
+
+    def close(self):
+        if self.conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.conn)
+        else:
+            self.conn.close()
+        self.conn = self.response = None
+
+
+def install(base_uri=None):
+    """Make the createsend library use pooled connections.
+
+    Arguments:
+        base_uri    if given, the URI of the createsend API to use instead
+                    of the default, such as that of `.fake`'s local server
+
+    """
+    if base_uri:
+        createsend.CreateSend.base_uri = base_uri.rstrip('/')
+    createsend.createsend.VerifiedHTTPSConnection = PooledConnection
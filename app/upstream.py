@@ -1,12 +1,43 @@
 """Set of convenience methods to interact with the createsend API."""
 
+import logging
+import datetime
+import threading
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
 import createsend
 
 from django.conf import settings
+from django.db import connection
+from django.db import transaction
+from django.utils import timezone
+from django.core.exceptions import ValidationError
+
+from . import counters
+from . import metrics
+from .utils import chunked
+from .utils import interleave
+from .cache import invalidate
+from .cache import invalidate_lists
+from .singleflight import InFlight
+from .singleflight import SingleFlight
+from .transport import install
+from .transport import available
+
+
+log = logging.getLogger(__name__)
 
 
 CS_AUTH = {'api_key': settings.API_KEY}
 
+# Reuse persistent connections across all createsend API calls.
+install(settings.CREATESEND_BASE_URI)
+
+# All subscriber statuses, as named by `createsend.List`'s methods.
+STATUSES = ('active', 'bounced', 'deleted', 'unconfirmed', 'unsubscribed', )
+
 
 def get_client_details(client_id):
     """Fetch client details from Campaign Monitoring.
@@ -16,32 +47,110 @@ def get_client_details(client_id):
 
     """
     client = createsend.Client(CS_AUTH, client_id=client_id)
-    return client.details().BasicDetails()
+    with metrics.upstream_call('client.details'):
+        return client.details().BasicDetails()
 
 
-def sync_client(client_id):
-    """Fully sync upstream data of a Campaign Monitorig Client.
+def sync_client(client_id, full=False, checkpoint=False):
+    """Sync upstream data of a Campaign Monitorig Client.
 
     Fetches and stores locally client details, campaigns lists,
-    and subscribers.
+    and subscribers. If the client already exists locally, its details
+    are updated in place and its lists are synced incrementally, unless
+    a full sync is requested.
 
     Arguments:
         client_id   the ClientID assigned by Campaign Monitoring
+        full        whether to re-download all subscribers of every list
+        checkpoint  whether to sync lists resumably, see `sync_lists`
 
     """
     from .models import CampaignClient
     details = get_client_details(client_id)
-    client = CampaignClient()
+    try:
+        client = CampaignClient.objects.get(external_id=details.ClientID)
+    except CampaignClient.DoesNotExist:
+        client = CampaignClient()
     client.name = details.ContactName
     client.email = details.EmailAddress
     client.company = details.CompanyName
     client.country = details.Country
     client.external_id = details.ClientID
     client.save()
-    sync_client_lists(client)
+    sync_client_lists(client, full=full, checkpoint=checkpoint)
+    client.synced_at = timezone.now()
+    client.save(update_fields=['synced_at'])
+    invalidate(client.external_id)
     return client
 
 
+# Coordinates syncs of the same client across threads and processes.
+_flights = SingleFlight(settings.SYNC_LOCK_DIR)
+
+
+def sync_client_once(client_id, max_age=None, timeout=None, full=False,
+                     checkpoint=False):
+    """Sync a client, unless another sync of it is already in progress.
+
+    Concurrent callers for the same client, either in this or in other
+    processes, wait for the sync in progress instead of starting their
+    own. The client is only synced if it does not exist locally, or if
+    it is older than `max_age`, once the wait is over.
+
+    Raises `.singleflight.InFlight` if the sync in progress does not
+    complete within `timeout` seconds.
+
+    Arguments:
+        client_id   the ClientID assigned by Campaign Monitoring
+        max_age     the maximum age, in seconds, of a local client
+                    to be returned without syncing it
+        timeout     the maximum number of seconds to wait
+        full        whether to re-download all subscribers of every list
+        checkpoint  whether to sync lists resumably, see `sync_lists`
+
+    """
+    from .models import CampaignClient
+
+    def sync():
+        client = CampaignClient.objects.filter(external_id=client_id).first()
+        if client is None:
+            return sync_client(client_id, full=full, checkpoint=checkpoint)
+        if max_age is not None and client.older_than(max_age):
+            return sync_client(client_id, full=full, checkpoint=checkpoint)
+        return client
+
+    return _flights.do(client_id, sync, timeout=timeout)
+
+
+def refresh_client(client_id):
+    """Sync a stale client in a background thread.
+
+    Does nothing if the client is already being synced, or if the createsend
+    API is currently unavailable.
+
+    Arguments:
+        client_id   the ClientID assigned by Campaign Monitoring
+
+    """
+    if _flights.in_flight(client_id) or not available():
+        return
+
+    def refresh():
+        try:
+            sync_client_once(client_id, max_age=settings.CLIENT_TTL,
+                             timeout=0)
+        except InFlight:
+            pass
+        except Exception as exc:
+            log.error('Failed to refresh client %s: %r', client_id, exc)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=refresh)
+    thread.daemon = True
+    thread.start()
+
+
 def get_client_lists(client):
     """Yield the client's campaign lists.
 
@@ -50,57 +159,290 @@ def get_client_lists(client):
 
     """
     cs = createsend.Client(CS_AUTH, client_id=client.external_id)
-    for clist in cs.lists():
+    with metrics.upstream_call('client.lists'):
+        clists = cs.lists()
+    for clist in clists:
         yield clist
 
 
-def sync_client_lists(client):
+def sync_client_lists(client, full=False, checkpoint=False):
     """Fetch a client's lists and store them locally.
 
+    Lists that already exist locally are updated in place.
+
     Arguments:
-        client   an instance of `.models.CampaignClient`
+        client      an instance of `.models.CampaignClient`
+        full        whether to re-download all subscribers of every list
+        checkpoint  whether to sync lists resumably, see `sync_lists`
 
     """
     from .models import CampaignList
+    clists = {clist.external_id: clist
+              for clist in client.campaignlist_set.all()}
     for upstream_list in get_client_lists(client):
-        clist = CampaignList()
+        clist = clists.get(upstream_list.ListID) or CampaignList()
         clist.client = client
         clist.name = upstream_list.Name
         clist.external_id = upstream_list.ListID
         clist.save()
-        sync_list_subscribers(clist)
+        clists[clist.external_id] = clist
+    sync_lists(list(clists.values()), full=full, checkpoint=checkpoint)
+
+
+def get_list_pages(clist, status, since=None, first_page=1):
+    """Yield every page of a campaign list's subscribers of a given status.
 
+    Pages are requested one at a time, `settings.SYNC_PAGE_SIZE` subscribers
+    each, until the last page reported by Campaign Monitoring.
+
+    Arguments:
+        clist       an instance of `.models.CampaignList`
+        status      the subscriber status to fetch, e.g. "active"
+        since       if given, fetch only subscribers changed since this
+                    datetime
+        first_page  the number of the page to start from
 
-def get_list_subscribers(clist):
+    """
+    date = ''
+    if since is not None:
+        # The API filters by day in the client's own timezone, so step back
+        # a day to never miss a change. Re-applying changes is harmless.
+        date = (since - datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+    upstream_clist = createsend.List(CS_AUTH, clist.external_id)
+    page = first_page
+    while True:
+        with metrics.upstream_call('list.%s' % status):
+            result = getattr(upstream_clist, status)(
+                date=date, page=page, page_size=settings.SYNC_PAGE_SIZE
+            )
+        yield result.Results
+        if page >= result.NumberOfPages:
+            break
+        page += 1
+
+
+def get_list_subscribers(clist, since=None):
     """Yield all the subscribers of a campaign list.
 
+    Subscribers of every status in `settings.SYNC_STATUS` are streamed page
+    by page. The pages of different statuses are fetched concurrently in
+    the background, while the ones already fetched are being consumed, so
+    that only a few pages are held in memory at any time.
+
     Arguments:
         clist   an instance of `.models.CampaignList`
+        since   if given, fetch only subscribers changed since this datetime
 
     """
-    upstream_clist = createsend.List(CS_AUTH, clist.external_id)
-    for status in settings.SYNC_STATUS:
-        for subscriber in getattr(upstream_clist, status)().Results:
+    pages = [get_list_pages(clist, status, since=since)
+             for status in settings.SYNC_STATUS]
+    for page in interleave(pages, settings.SYNC_CONCURRENCY,
+                           size=settings.SYNC_CONCURRENCY):
+        for subscriber in page:
             yield subscriber
 
 
-def sync_list_subscribers(clist):
+def sync_list_subscribers(clist, full=False):
     """Store subscriber details.
 
     Arguments:
         clist   an instance of `.models.CampaignList`
+        full    whether to re-download all of the list's subscribers
+
+    """
+    sync_lists([clist], full=full)
+
+
+def pushed(clist):
+    """Whether all changes of a list since its last sync have been pushed.
+
+    That is, whether the list has a webhook, which was registered before
+    its last sync.
+
+    """
+    if not (clist.webhook_id and clist.webhook_since and clist.synced_at):
+        return False
+    return clist.synced_at > clist.webhook_since
+
+
+def sync_lists(clists, full=False, checkpoint=False):
+    """Fetch the subscribers of campaign lists and store them locally.
+
+    The subscribers of every list and status are fetched concurrently by up
+    to `settings.SYNC_CONCURRENCY` threads, while the current thread writes
+    them to the db as they arrive, in batches of `settings.SYNC_BATCH_SIZE`.
+    Keeping a single writer serializes the db writes, and lets the whole
+    sync run within a single transaction.
+
+    Lists that have been synced before are synced incrementally, starting
+    from their `synced_at` watermark, unless `full` is True. An incremental
+    sync fetches subscribers of all statuses, so that state transitions of
+    known subscribers are applied even for statuses that are not synced
+    otherwise. Lists whose changes are pushed by a webhook, and that have
+    been synced since it was registered, are skipped by incremental syncs,
+    see `.webhooks`.
+
+    With `checkpoint`, every page is stored in a transaction of its own,
+    alongside a `.models.SyncCheckpoint` of the list and status, so that an
+    interrupted sync resumes from the page after the last one stored, with
+    the watermark it started from. Subscribers that move across pages
+    upstream in the meantime may be missed until the next full sync.
+
+    Arguments:
+        clists      a list of `.models.CampaignList` instances
+        full        whether to re-download all subscribers of every list
+        checkpoint  whether to resume from, and record, checkpoints
+
+    """
+    from .models import CampaignList
+    from .models import SyncCheckpoint
+
+    def list_pages(clist, status, since, first_page):
+        pages = get_list_pages(clist, status, since=since,
+                               first_page=first_page)
+        for number, page in enumerate(pages, first_page):
+            yield clist, status, number, page
+
+    def store(clist, status, number, page):
+        metrics.SYNC_PAGES.labels().inc()
+        for batch in chunked(page, settings.SYNC_BATCH_SIZE):
+            store_subscribers(clist, batch,
+                              create=status in settings.SYNC_STATUS)
+            metrics.SYNC_SUBSCRIBERS.labels().inc(len(batch))
+        if checkpoint:
+            SyncCheckpoint.objects.filter(
+                clist=clist, status=status
+            ).update(page=number)
+
+    now = timezone.now()
+    checkpoints = {}
+    if checkpoint:
+        checkpoints = {(cp.clist_id, cp.status): cp for cp in
+                       SyncCheckpoint.objects.filter(clist__in=clists)}
+    started = {}
+    pages = []
+    for clist in clists:
+        resumed = [cp for (pk, status), cp in checkpoints.items()
+                   if pk == clist.pk]
+        if not (full or resumed) and pushed(clist):
+            continue
+        since = None if full else clist.synced_at
+        started[clist.pk] = now
+        if resumed:
+            since, started[clist.pk] = resumed[0].since, resumed[0].started_at
+            log.info('Resuming the sync of %s', clist)
+        statuses = settings.SYNC_STATUS if since is None else STATUSES
+        for status in statuses:
+            cp = checkpoints.get((clist.pk, status))
+            if checkpoint and cp is None:
+                cp = SyncCheckpoint.objects.create(
+                    clist=clist, status=status, since=since,
+                    started_at=started[clist.pk],
+                )
+            first_page = cp.page + 1 if cp is not None else 1
+            pages.append(list_pages(clist, status, since, first_page))
+
+    def finish():
+        for value in set(started.values()):
+            CampaignList.objects.filter(pk__in=[
+                pk for pk in started if started[pk] == value
+            ]).update(synced_at=value)
+        SyncCheckpoint.objects.filter(clist__in=clists).delete()
+
+    pages = interleave(pages, settings.SYNC_CONCURRENCY,
+                       size=settings.SYNC_CONCURRENCY)
+    if checkpoint:
+        for page in pages:
+            with transaction.atomic():
+                store(*page)
+        with transaction.atomic():
+            finish()
+    else:
+        with transaction.atomic():
+            for page in pages:
+                store(*page)
+            finish()
+    for clist in clists:
+        clist.synced_at = started.get(clist.pk, clist.synced_at)
+    invalidate_lists(clists)
+
+
+def store_subscribers(clist, upstream_subscribers, create=True):
+    """Upsert a batch of upstream subscribers and add them to a list.
+
+    Records are validated in memory and de-duplicated by e-mail address.
+    Existing subscribers are looked up with a single query, new ones are
+    bulk inserted, and missing memberships are bulk inserted into the m2m
+    through table.
+
+    Arguments:
+        clist                   an instance of `.models.CampaignList`
+        upstream_subscribers    an iterable of createsend subscriber details
+        create                  whether to store new subscribers, or only
+                                update the existing members of `clist`
 
     """
     from .models import CampaignSubscriber
-    for upstream_subscriber in get_list_subscribers(clist):
-        subscriber = CampaignSubscriber()
-        # We need to save before being able to create a m2m relationship.
-        subscriber.save()
-        subscriber.lists.add(clist)
-        subscriber.name = upstream_subscriber.Name
-        subscriber.email = upstream_subscriber.EmailAddress
-        subscriber.state = upstream_subscriber.State
-        subscriber.save()
+    membership = CampaignSubscriber.lists.through
+
+    records = OrderedDict()
+    for upstream_subscriber in upstream_subscribers:
+        subscriber = CampaignSubscriber(name=upstream_subscriber.Name,
+                                        email=upstream_subscriber.EmailAddress,
+                                        state=upstream_subscriber.State)
+        try:
+            subscriber.clean_fields()
+        except ValidationError as exc:
+            log.warning('Skipping invalid subscriber %s: %r',
+                        upstream_subscriber.EmailAddress, exc)
+            continue
+        records[subscriber.email] = subscriber
+    if not records:
+        return
+
+    existing = CampaignSubscriber.objects.filter(email__in=list(records))
+    if not create:
+        existing = existing.filter(lists=clist)
+    existing = {subscriber.email: subscriber for subscriber in existing}
+
+    # Group pending updates by their new values, so that each distinct
+    # (name, state) pair costs a single UPDATE query.
+    updates = {}
+    for email, subscriber in records.items():
+        current = existing.get(email)
+        if current is None:
+            continue
+        if (current.name, current.state) != (subscriber.name,
+                                             subscriber.state):
+            key = (subscriber.name, subscriber.state)
+            updates.setdefault(key, []).append(current.pk)
+    if updates:
+        updated = [pk for pks in updates.values() for pk in pks]
+        deltas = counters.tally(campaignsubscriber__in=updated)
+        for (name, state), pks in updates.items():
+            CampaignSubscriber.objects.filter(pk__in=pks).update(name=name,
+                                                                 state=state)
+        deltas.subtract(counters.tally(campaignsubscriber__in=updated))
+        counters.update(deltas, sign=-1)
+    if not create:
+        return
+
+    CampaignSubscriber.objects.bulk_create(
+        [sub for email, sub in records.items() if email not in existing]
+    )
+
+    pks = set(CampaignSubscriber.objects.filter(
+        email__in=list(records)
+    ).values_list('pk', flat=True))
+    pks -= set(membership.objects.filter(
+        campaignlist=clist, campaignsubscriber__in=pks
+    ).values_list('campaignsubscriber_id', flat=True))
+    membership.objects.bulk_create([
+        membership(campaignlist_id=clist.pk, campaignsubscriber_id=pk)
+        for pk in pks
+    ])
+    counters.update(counters.tally(campaignlist=clist,
+                                   campaignsubscriber__in=pks))
 
 
 def import_subscriber(list_id, custom_fields=None, resubscribe=True, **params):
@@ -112,8 +454,9 @@ def import_subscriber(list_id, custom_fields=None, resubscribe=True, **params):
 
     """
     subscriber = createsend.Subscriber(CS_AUTH, list_id=list_id)
-    subscriber.add(list_id=list_id, custom_fields=custom_fields,
-                   resubscribe=resubscribe, **params)
+    with metrics.upstream_call('subscriber.add'):
+        subscriber.add(list_id=list_id, custom_fields=custom_fields,
+                       resubscribe=resubscribe, **params)
 
 
 def delete_subscriber(list_id, email):
@@ -127,4 +470,100 @@ def delete_subscriber(list_id, email):
     subscriber = createsend.Subscriber(
         CS_AUTH, list_id=list_id, email_address=email
     )
-    subscriber.delete()
+    with metrics.upstream_call('subscriber.delete'):
+        subscriber.delete()
+
+
+def import_subscribers(list_id, subscribers, resubscribe=True):
+    """Import subscribers to an existing list in bulk.
+
+    Subscribers are sent in chunks of `settings.IMPORT_BATCH_SIZE`, one
+    createsend bulk import request per chunk.
+
+    Arguments:
+        list_id         the ListID assigned by Campaign Monitoring
+        subscribers     an iterable of `.models.CampaignSubscriber`
+
+    Returns a dict mapping the e-mail addresses that failed to be imported
+    to the corresponding error message.
+
+    """
+    failures = {}
+    upstream_subscriber = createsend.Subscriber(CS_AUTH, list_id=list_id)
+    for chunk in chunked(subscribers, settings.IMPORT_BATCH_SIZE):
+        records = [{'EmailAddress': sub.email, 'Name': sub.name}
+                   for sub in chunk]
+        try:
+            with metrics.upstream_call('subscriber.import'):
+                result = upstream_subscriber.import_subscribers(
+                    list_id, records, resubscribe
+                )
+        except Exception as exc:
+            log.error('Failed to import %d subscribers to %s: %r',
+                      len(chunk), list_id, exc)
+            failures.update((sub.email, str(exc)) for sub in chunk)
+            continue
+        for failure in getattr(result, 'FailureDetails', None) or []:
+            failures[failure.EmailAddress] = failure.Message
+    return failures
+
+
+def delete_subscribers(list_id, emails):
+    """Delete existing subscribers from a list in bulk.
+
+    The createsend API has no bulk delete endpoint, so up to
+    `settings.UPSTREAM_CONCURRENCY` deletions are run in parallel instead.
+
+    Arguments:
+        list_id    the ListID assigned by Campaign Monitoring
+        emails     the e-mail addresses of the subscribers to delete
+
+    Returns a dict mapping the e-mail addresses that failed to be deleted
+    to the corresponding error message.
+
+    """
+    def delete(email):
+        try:
+            delete_subscriber(list_id, email)
+        except Exception as exc:
+            log.error('Failed to delete %s from %s: %r', email, list_id, exc)
+            return email, str(exc)
+
+    emails = list(emails)
+    if not emails:
+        return {}
+    pool = ThreadPool(min(settings.UPSTREAM_CONCURRENCY, len(emails)))
+    try:
+        return dict(failure for failure in pool.imap_unordered(delete, emails)
+                    if failure is not None)
+    finally:
+        pool.close()
+
+
+def create_webhook(list_id, url, events=('Subscribe', 'Deactivate', 'Update')):
+    """Register a webhook POSTing a list's changes to `url` as JSON.
+
+    Arguments:
+        list_id    the ListID assigned by Campaign Monitoring
+        url        the URL to POST batches of events to
+        events     the types of the events to POST
+
+    Returns the WebhookID of the new webhook.
+
+    """
+    upstream_clist = createsend.List(CS_AUTH, list_id)
+    with metrics.upstream_call('list.webhooks.create'):
+        return upstream_clist.create_webhook(list(events), url, 'json')
+
+
+def delete_webhook(list_id, webhook_id):
+    """Delete a webhook of a list.
+
+    Arguments:
+        list_id     the ListID assigned by Campaign Monitoring
+        webhook_id  the WebhookID returned by `create_webhook`
+
+    """
+    upstream_clist = createsend.List(CS_AUTH, list_id)
+    with metrics.upstream_call('list.webhooks.delete'):
+        upstream_clist.delete_webhook(webhook_id)
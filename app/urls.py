@@ -1,9 +1,23 @@
 from django.conf.urls import url
 
+from . import api
 from . import views
 
 
 urlpatterns = [
+    url(r'^metrics$', views.metrics, name='metrics'),
+    url(r'^webhooks/(?P<list_id>[a-zA-Z0-9]+)/(?P<token>[a-zA-Z0-9_-]+)/$',
+        views.webhook, name='webhook'),
+    url(r'^api/clients/(?P<client_id>[a-zA-Z0-9]+)/$',
+        api.ClientDetail.as_view(), name='api-client'),
+    url(r'^api/clients/(?P<client_id>[a-zA-Z0-9]+)/lists/$',
+        api.ClientLists.as_view(), name='api-lists'),
+    url(r'^api/clients/(?P<client_id>[a-zA-Z0-9]+)/lists/(?P<list_id>[a-zA-Z0-9]+)/subscribers/$',
+        api.ListSubscribers.as_view(), name='api-subscribers'),
+    url(r'^api/clients/(?P<client_id>[a-zA-Z0-9]+)/search/$',
+        api.SearchSubscribers.as_view(), name='api-search'),
+    url(r'^api/clients/(?P<client_id>[a-zA-Z0-9]+)/export/$',
+        api.ClientExport.as_view(), name='api-export'),
     url(r'^(?P<client_id>[a-zA-z0-9]+)/$',
         views.CampaignClientDetail.as_view(), name='client'),
     url(r'^(?P<client_id>[a-zA-Z0-9]+)/lists/subscribe/$',
@@ -0,0 +1,98 @@
+"""Miscellaneous helpers shared across the app."""
+
+import itertools
+import threading
+
+from django.utils.six.moves import queue
+
+
+# Marks the end of the items produced in the background.
+_DONE = object()
+
+
+def chunked(iterable, size):
+    """Yield successive lists of at most `size` items from `iterable`.
+
+    Arguments:
+        iterable    any iterable, which is consumed lazily
+        size        the maximum length of each yielded chunk
+
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def interleave(iterables, workers, size=1):
+    """Consume several iterables concurrently and yield all of their items.
+
+    Up to `workers` background threads iterate over `iterables`, each one
+    picking the next pending iterable once it is done with the previous.
+    Items are yielded in the order they are produced, with at most `size`
+    of them buffered ahead of the consumer. The first exception raised by
+    any of the iterables is re-raised in the consuming thread.
+
+    Arguments:
+        iterables   a sequence of iterables to consume in the background
+        workers     the maximum number of concurrent background threads
+        size        the maximum number of items to read ahead
+
+    """
+    jobs = queue.Queue()
+    for iterable in iterables:
+        jobs.put(iterable)
+    workers = min(workers, jobs.qsize())
+    if not workers:
+        return
+
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    lock = threading.Lock()
+    running = [workers]
+
+    def put(item, exc=None):
+        while not stop.is_set():
+            try:
+                items.put((item, exc), timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            while not stop.is_set():
+                try:
+                    iterable = jobs.get_nowait()
+                except queue.Empty:
+                    break
+                for item in iterable:
+                    if not put(item):
+                        return
+        except Exception as exc:
+            put(_DONE, exc)
+            return
+        with lock:
+            running[0] -= 1
+            if running[0]:
+                return
+        put(_DONE)
+
+    for _ in range(workers):
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+    try:
+        while True:
+            item, exc = items.get()
+            if item is _DONE:
+                if exc is not None:
+                    raise exc
+                return
+            yield item
+    finally:
+        # Let the producers exit, if the consumer stopped early.
+        stop.set()
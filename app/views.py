@@ -1,17 +1,49 @@
+import json
 import logging
+import itertools
 
 from .models import CampaignList
 from .models import CampaignClient
 from .models import CampaignSubscriber
 from .models import SubscriberCreationForm
 
-from .upstream import sync_client
+from .upstream import refresh_client
+from .upstream import sync_client_once
 
+from .singleflight import InFlight
+
+from .transport import CircuitOpen
+
+from .cache import get_page
+from .cache import set_page
+from .cache import page_response
+from .cache import CSRF_PLACEHOLDER
+
+from .utils import chunked
+
+from .metrics import render as render_metrics
+
+from .webhooks import receive
+from .webhooks import valid_token
+from .webhooks import InvalidPayload
+
+from django.conf import settings
 from django.urls import reverse
 from django.http import Http404
+from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
+from django.http import HttpResponseForbidden
+from django.http import StreamingHttpResponse
 from django.http.response import HttpResponseRedirect
-from django.shortcuts import get_object_or_404
-
+from django.shortcuts import render
+from django.template.loader import render_to_string
+from django.utils.crypto import constant_time_compare
+from django.db.models import Prefetch
+from django.db.models import prefetch_related_objects
+
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET
+from django.views.decorators.http import require_POST
 from django.views.generic import DetailView
 from django.views.generic import DeleteView
 from django.views.generic.edit import CreateView
@@ -35,6 +67,22 @@ class CampaignClientDetail(DetailView):
         If the client with the specified ClientID does not exist, then the
         client's data is fetched and also stored locally.
 
+        Clients stored locally are served from the db. If they are older than
+        `settings.CLIENT_TTL`, they are still served as is, while a refresh
+        is triggered in the background. Only clients older than
+        `settings.CLIENT_MAX_AGE` are refreshed before being served.
+
+        Concurrent requests for a client being synced wait for the sync in
+        progress. If it takes longer than `settings.SYNC_WAIT_TIMEOUT`, a
+        "syncing" page is returned with a 202 status code instead.
+
+        While Campaign Monitor is unavailable, local clients are served as is,
+        whereas clients not stored locally get a 503 response.
+
+        Rendered pages are cached until the client's data changes, and are
+        served with an ETag and a Last-Modified header, so that repeat
+        visitors get a 304 response.
+
         This endpoint basically serves as a cachable proxy between the local
         app and Campaign Monitor's API.
 
@@ -44,19 +92,113 @@ class CampaignClientDetail(DetailView):
         except Http404 as err:
             log.warning('Pulling new client (%s) details', kwargs['client_id'])
             try:
-                self.object = sync_client(kwargs['client_id'])
+                self.object = sync_client_once(
+                    kwargs['client_id'], timeout=settings.SYNC_WAIT_TIMEOUT
+                )
+            except InFlight:
+                return render(request, 'app/syncing.html', status=202,
+                              context={'client_id': kwargs['client_id']})
+            except CircuitOpen:
+                return render(request, 'app/unavailable.html', status=503,
+                              context={'client_id': kwargs['client_id']})
             except Exception as exc:
                 log.error('Failed to sync client details: %r', exc)
                 raise err
-        return super(CampaignClientDetail, self).get(request, *args, **kwargs)
+        else:
+            if self.object.expired:
+                log.info('Refreshing expired client %s', self.object)
+                try:
+                    self.object = sync_client_once(
+                        kwargs['client_id'],
+                        max_age=settings.CLIENT_MAX_AGE,
+                        timeout=settings.SYNC_WAIT_TIMEOUT,
+                    )
+                except Exception as exc:
+                    log.error('Failed to refresh client details: %r', exc)
+            elif self.object.stale:
+                refresh_client(kwargs['client_id'])
+
+        page = get_page(kwargs['client_id'])
+        if page is None:
+            response = super(CampaignClientDetail, self).get(request,
+                                                             *args, **kwargs)
+            if isinstance(response, StreamingHttpResponse):
+                return response
+            page = set_page(kwargs['client_id'], response.render().content)
+        return page_response(request, page)
 
     def get_context_data(self, **kwargs):
-        """Enrich context with the corresponding client and campaign lists."""
+        """Enrich context with the corresponding client and campaign lists.
+
+        The subscribers of all lists are prefetched with a single query. For
+        clients with more than `settings.STREAM_THRESHOLD` subscriptions, as
+        read from the lists' counters, the page is streamed instead, so that
+        subscribers are not loaded upfront.
+
+        Pages that are not streamed are cached, so they are rendered with a
+        placeholder in place of the visitor's CSRF token.
+
+        """
         context = super(CampaignClientDetail, self).get_context_data(**kwargs)
         context['client'] = self.object
-        context['lists'] = self.object.campaignlist_set.all()
+        lists = list(self.object.campaignlist_set.order_by(
+            'pk'
+        ).prefetch_related('counters'))
+        context['stream'] = sum(
+            clist.subscriber_count for clist in lists
+        ) > settings.STREAM_THRESHOLD
+        if not context['stream']:
+            prefetch_related_objects(lists, Prefetch(
+                'campaignsubscriber_set',
+                queryset=CampaignSubscriber.objects.order_by('email'),
+            ))
+            context['csrf_token'] = CSRF_PLACEHOLDER
+        context['lists'] = lists
         return context
 
+    def render_to_response(self, context, **response_kwargs):
+        """Stream the page of large clients, or render it otherwise."""
+        if not context['stream']:
+            return super(CampaignClientDetail, self).render_to_response(
+                context, **response_kwargs
+            )
+        return StreamingHttpResponse(self.stream(context), **response_kwargs)
+
+    def stream(self, context):
+        """Render the page incrementally, a chunk of subscribers at a time.
+
+        All subscriptions of the client are read through a single, ordered
+        query, whose results are iterated over in chunks, so that memory use
+        stays bounded regardless of the number of subscribers.
+
+        """
+        def render(template_name, **extra):
+            return render_to_string('app/%s.html' % template_name,
+                                    dict(context, **extra), self.request)
+
+        memberships = CampaignSubscriber.lists.through.objects.filter(
+            campaignlist__client=self.object
+        ).select_related('campaignsubscriber').order_by(
+            'campaignlist_id', 'campaignsubscriber__email'
+        ).iterator()
+        groups = itertools.groupby(memberships,
+                                   key=lambda m: m.campaignlist_id)
+        group = next(groups, None)
+
+        yield render('campaignclient_detail_header')
+        for clist in context['lists']:
+            yield render('campaignlist_header', list=clist)
+            if group is not None and group[0] == clist.pk:
+                subscribers = (m.campaignsubscriber for m in group[1])
+                for chunk in chunked(subscribers, settings.STREAM_CHUNK_SIZE):
+                    yield render('campaignsubscriber_rows', list=clist,
+                                 subscribers=chunk)
+                group = next(groups, None)
+            yield '</table>'
+        if not context['lists']:
+            yield '<h3>No Campaign Lists Available</h3>'
+        yield render('campaignclient_detail_footer')
+
 
 class AddSubscriberToList(CreateView):
     """Import a new subscriber to an existing subscription list."""
@@ -84,24 +226,35 @@ class AddSubscriberToList(CreateView):
         name = self.request.POST.get('name')
         email = self.request.POST.get('email')
 
-        for clist_id in request.POST.getlist('lists'):
-            # Get subscription list and verify ownership.
-            self.clist = get_object_or_404(CampaignList, pk=clist_id)
-            if self.clist.client.external_id != kwargs['client_id']:
-                raise Http404()
-            # Persist locally. The object is instantiated either by fetching it
-            # from the db or while processing the corresponding form during the
-            # call to `super()` in case we are creating a new object.
-            try:
-                self.object = CampaignSubscriber.objects.get(email=email)
+        # Get the subscription lists, verifying their ownership in a single
+        # query.
+        clist_ids = set(request.POST.getlist('lists'))
+        if not all(clist_id.isdigit() for clist_id in clist_ids):
+            raise Http404()
+        clists = CampaignList.objects.select_related('client').filter(
+            pk__in=clist_ids, client__external_id=kwargs['client_id']
+        ).order_by('pk')
+        if not clist_ids or len(clists) != len(clist_ids):
+            raise Http404()
+        self.clist = clists[0]
+
+        # Persist locally. The object is instantiated either by fetching it
+        # from the db or while processing the corresponding form during the
+        # call to `super()` in case we are creating a new object.
+        try:
+            self.object = CampaignSubscriber.objects.get(email=email)
+        except CampaignSubscriber.DoesNotExist:
+            http_redirect = super(AddSubscriberToList,
+                                  self).post(request, *args, **kwargs)
+            if self.object is None:
+                # The form is invalid, and rendered again with its errors.
+                return http_redirect
+        else:
+            if self.object.name != name:
                 self.object.name = name
-            except CampaignSubscriber.DoesNotExist:
-                http_redirect = super(AddSubscriberToList,
-                                      self).post(request, *args, **kwargs)
-            else:
-                http_redirect = HttpResponseRedirect(self.get_success_url())
-            self.object.subscribe(self.clist)
-            self.object.save()
+                self.object.save()
+            http_redirect = HttpResponseRedirect(self.get_success_url())
+        self.object.subscribe(*clists)
 
         return http_redirect
 
@@ -129,21 +282,21 @@ class RemoveSubscriberFromList(DeleteView):
         to DELETE.
 
         """
-        subscriber = self.get_object()
-        for clist in subscriber.lists.all():
-            if clist.external_id != kwargs['list_id']:
-                continue
-            if clist.client.external_id != kwargs['client_id']:
-                continue
-            self.clist = clist
-            try:
-                self.clist.unsubscribe(subscriber)
-            except Exception as exc:
-                log.error('Failed to remove subscriber: %r', exc)
-                raise
-            return super(RemoveSubscriberFromList, self).post(request,
-                                                              *args, **kwargs)
-        raise Http404()
+        subscriber = self.object = self.get_object()
+        try:
+            self.clist = subscriber.lists.select_related('client').get(
+                external_id=kwargs['list_id'],
+                client__external_id=kwargs['client_id'],
+            )
+        except CampaignList.DoesNotExist:
+            raise Http404()
+        try:
+            self.clist.unsubscribe(subscriber)
+        except Exception as exc:
+            log.error('Failed to remove subscriber: %r', exc)
+            raise
+        return super(RemoveSubscriberFromList, self).post(request,
+                                                          *args, **kwargs)
 
     def delete(self, request, *args, **kwargs):
         """Delete the fetched object and then redirect to the success URL.
@@ -153,8 +306,9 @@ class RemoveSubscriberFromList(DeleteView):
         is also called on the db object.
 
         """
-        self.object = self.get_object()
-        if not self.object.lists.count():
+        if getattr(self, 'object', None) is None:
+            self.object = self.get_object()
+        if not self.object.lists.exists():
             self.object.delete()
         return HttpResponseRedirect(self.get_success_url())
 
@@ -162,3 +316,49 @@ class RemoveSubscriberFromList(DeleteView):
         return reverse(
             'client', kwargs={'client_id': self.clist.client.external_id}
         )
+
+
+def metrics_allowed(request):
+    """Whether `request` may read the metrics.
+
+    Metrics are served to `settings.METRICS_ALLOWED_IPS`, and to requests
+    authorized with a bearer token of `settings.METRICS_TOKEN`, if set.
+
+    """
+    if request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS:
+        return True
+    scheme, _, token = request.META.get('HTTP_AUTHORIZATION',
+                                        '').partition(' ')
+    return bool(settings.METRICS_TOKEN) and scheme == 'Bearer' and (
+        constant_time_compare(token, settings.METRICS_TOKEN)
+    )
+
+
+@require_GET
+def metrics(request):
+    """Expose the metrics of this process in the Prometheus text format."""
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(),
+                        content_type='text/plain; version=0.0.4')
+
+
+@csrf_exempt
+@require_POST
+def webhook(request, list_id, token):
+    """Receive a batch of events pushed by the webhook of a list.
+
+    The events are verified and queued, to be applied by
+    `manage.py apply-webhooks`. See `.webhooks`.
+
+    """
+    if not valid_token(list_id, token):
+        return HttpResponseForbidden()
+    try:
+        payload = json.loads(request.body.decode('utf-8'))
+        received = receive(list_id, payload)
+    except (ValueError, InvalidPayload) as exc:
+        log.warning('Rejected webhook events of %s: %s', list_id, exc)
+        return HttpResponseBadRequest()
+    log.info('Received %d webhook event(s) of %s', received, list_id)
+    return HttpResponse()
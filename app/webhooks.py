@@ -0,0 +1,290 @@
+"""Subscriber changes pushed by Campaign Monitoring list webhooks.
+
+Each list's webhook is registered by `manage.py webhooks register` to POST
+its Subscribe, Deactivate and Update events, in JSON batches, to a URL
+holding a token signed for the list, see `webhook_url`. Batches are verified
+against their token and stored as `.models.WebhookEvent`s by `receive`, in
+a single insert, so that they are acknowledged quickly. Pending events are
+then applied in bulk by `apply`, which is run by `manage.py apply-webhooks`.
+
+Applying an event sets a subscriber's details and its membership of the list
+to those of the event, the latest event per subscriber winning, so events
+applied more than once, as redelivered by Campaign Monitoring, leave the
+same result. The date of the latest event applied per list and subscriber is
+kept, so that events redelivered after a later one are skipped.
+
+Lists whose changes are pushed are skipped by incremental syncs, once synced
+after their webhook was registered, so that the steady-state traffic to the
+createsend API is reduced to refreshing the clients' details and lists. Full
+syncs still reconcile every list, in case of lost events.
+
+"""
+
+import logging
+import datetime
+import collections
+
+from django.conf import settings
+from django.core import signing
+from django.db import transaction
+from django.urls import reverse
+from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+
+from .utils import chunked
+from .cache import invalidate_lists
+from .upstream import create_webhook
+from .upstream import delete_webhook
+from .upstream import store_subscribers
+from .singleflight import SingleFlight
+
+
+log = logging.getLogger(__name__)
+
+SALT = 'app.webhooks'
+
+# The format of the events' dates.
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# The details of a subscriber to store, in the shape of createsend's.
+Subscriber = collections.namedtuple('Subscriber', 'EmailAddress Name State')
+
+# Ensures that events are applied by a single thread or process at a time.
+_flights = SingleFlight(settings.SYNC_LOCK_DIR)
+
+
+class InvalidPayload(Exception):
+    """Raised for webhook payloads that fail verification."""
+
+
+def make_token(list_id):
+    """Return the token of the webhook URL of a list."""
+    return signing.Signer(salt=SALT).signature(list_id)
+
+
+def valid_token(list_id, token):
+    """Whether `token` has been made by `make_token` for `list_id`."""
+    return constant_time_compare(make_token(list_id), token)
+
+
+def webhook_url(list_id, base_url=None):
+    """Return the URL for a list's webhook to POST to.
+
+    Arguments:
+        list_id     the ListID assigned by Campaign Monitoring
+        base_url    the URL the app is reachable at by Campaign Monitoring,
+                    `settings.WEBHOOK_BASE_URL` by default
+
+    """
+    base_url = base_url or settings.WEBHOOK_BASE_URL
+    return base_url.rstrip('/') + reverse('webhook', kwargs={
+        'list_id': list_id, 'token': make_token(list_id),
+    })
+
+
+def parse_date(value):
+    try:
+        date = datetime.datetime.strptime(value, DATE_FORMAT)
+    except (TypeError, ValueError):
+        return None
+    return timezone.make_aware(date) if settings.USE_TZ else date
+
+
+def parse_events(list_id, payload):
+    """Return the `.models.WebhookEvent`s of a webhook's payload.
+
+    Raises `InvalidPayload` unless the payload is a batch of events of the
+    list `list_id`.
+
+    """
+    from .models import STATES
+    from .models import WebhookEvent
+    if not isinstance(payload, dict) or payload.get('ListID') != list_id:
+        raise InvalidPayload('Not a batch of events of %s' % list_id)
+    events = payload.get('Events')
+    if not isinstance(events, list):
+        raise InvalidPayload('Missing events')
+    kinds = dict(WebhookEvent._meta.get_field('kind').choices)
+    parsed = []
+    for event in events:
+        if not isinstance(event, dict):
+            raise InvalidPayload('Invalid event')
+        if event.get('Type') not in kinds:
+            raise InvalidPayload('Invalid event type: %s' % event.get('Type'))
+        if not event.get('EmailAddress'):
+            raise InvalidPayload('Missing e-mail address')
+        state = event.get('State') or 'Active'
+        if state not in dict(STATES):
+            raise InvalidPayload('Invalid state: %s' % state)
+        parsed.append(WebhookEvent(
+            list_id=list_id,
+            kind=event['Type'],
+            email=event['EmailAddress'][:254],
+            old_email=(event.get('OldEmailAddress') or '')[:254],
+            name=(event.get('Name') or '')[:64],
+            state=state,
+            date=parse_date(event.get('Date')),
+        ))
+    return parsed
+
+
+def receive(list_id, payload):
+    """Verify and store a batch of events of a list's webhook.
+
+    Raises `InvalidPayload` if the batch fails verification, or belongs to
+    a list that is not stored locally.
+
+    Returns the number of events stored.
+
+    """
+    from .models import CampaignList
+    from .models import WebhookEvent
+    events = parse_events(list_id, payload)
+    if not CampaignList.objects.filter(external_id=list_id).exists():
+        raise InvalidPayload('Unknown list: %s' % list_id)
+    WebhookEvent.objects.bulk_create(events)
+    return len(events)
+
+
+def pending():
+    """Return the number of events not applied yet."""
+    from .models import WebhookEvent
+    return WebhookEvent.objects.count()
+
+
+def apply(limit=None):
+    """Apply pending events in bulk, in the order they were received.
+
+    Raises `.singleflight.InFlight` if events are already being applied.
+
+    Arguments:
+        limit   the maximum number of events to apply, by default
+                `settings.SYNC_BATCH_SIZE`
+
+    Returns the number of events applied.
+
+    """
+    return _flights.do('webhooks', lambda: _apply(limit), timeout=0)
+
+
+def _apply(limit=None):
+    from .models import CampaignList
+    from .models import WebhookEvent
+    events = list(WebhookEvent.objects.order_by('pk')[
+        :limit or settings.SYNC_BATCH_SIZE
+    ])
+    if not events:
+        return 0
+    by_list = collections.defaultdict(list)
+    for event in events:
+        by_list[event.list_id].append(event)
+    clists = list(CampaignList.objects.filter(external_id__in=list(by_list)))
+    with transaction.atomic():
+        for clist in clists:
+            apply_events(clist, by_list[clist.external_id])
+        WebhookEvent.objects.filter(pk__in=[event.pk for event in events]
+                                    ).delete()
+    invalidate_lists(clists)
+    return len(events)
+
+
+def apply_events(clist, events):
+    """Apply the events of a list, in the order they were received.
+
+    Events older than the last one applied to the same subscriber of the
+    list, as recorded by `.models.WebhookWatermark`, are skipped. Subscribers
+    whose e-mail address changed are renamed first, unless the new address
+    is taken. Then the latest event of every subscriber is stored through
+    `.upstream.store_subscribers`. As with syncs, subscribers in a state
+    missing from `settings.SYNC_STATUS` are only updated if they are already
+    members of the list, rather than stored. Events with no name keep the
+    name of an earlier event of the batch, or else of the subscriber.
+
+    """
+    from .models import CampaignSubscriber
+    from .models import WebhookWatermark
+    emails = set(event.email for event in events)
+    emails.update(event.old_email for event in events if event.old_email)
+    watermarks = {}
+    for chunk in chunked(emails, settings.SYNC_BATCH_SIZE):
+        watermarks.update(WebhookWatermark.objects.filter(
+            clist=clist, email__in=chunk
+        ).values_list('email', 'date'))
+
+    latest = collections.OrderedDict()
+    names = {}
+    for event in sorted(events, key=lambda event: (
+        event.date or timezone.now(), event.pk
+    )):
+        if event.date is not None and any(
+            event.date < watermarks[email]
+            for email in (event.email, event.old_email) if email in watermarks
+        ):
+            log.debug('Skipping %s, older than the last event applied', event)
+            continue
+        if event.old_email and event.old_email != event.email:
+            if not CampaignSubscriber.objects.filter(
+                email=event.email
+            ).exists():
+                CampaignSubscriber.objects.filter(
+                    email=event.old_email
+                ).update(email=event.email)
+            latest.pop(event.old_email, None)
+            names.setdefault(event.email, names.pop(event.old_email, ''))
+        latest.pop(event.email, None)
+        latest[event.email] = event
+        names[event.email] = event.name or names.get(event.email, '')
+    if not latest:
+        return
+
+    blank = [email for email in latest if not names[email]]
+    for chunk in chunked(blank, settings.SYNC_BATCH_SIZE):
+        names.update(CampaignSubscriber.objects.filter(
+            email__in=chunk
+        ).values_list('email', 'name'))
+    for create in (True, False):
+        synced = [event for event in latest.values()
+                  if (event.state.lower() in settings.SYNC_STATUS) == create]
+        for chunk in chunked(synced, settings.SYNC_BATCH_SIZE):
+            store_subscribers(clist, [
+                Subscriber(event.email, names[event.email], event.state)
+                for event in chunk
+            ], create=create)
+
+    dated = [event for event in latest.values() if event.date is not None]
+    for chunk in chunked(dated, settings.SYNC_BATCH_SIZE):
+        WebhookWatermark.objects.filter(
+            clist=clist, email__in=[event.email for event in chunk]
+        ).delete()
+        WebhookWatermark.objects.bulk_create([
+            WebhookWatermark(clist=clist, email=event.email, date=event.date)
+            for event in chunk
+        ])
+
+
+def register(clist, base_url=None):
+    """Register a webhook pushing the changes of a list, if it has none.
+
+    The list keeps being synced incrementally until its next sync, which
+    picks up any change made before the webhook was registered.
+
+    """
+    if clist.webhook_id:
+        return clist
+    clist.webhook_id = create_webhook(clist.external_id,
+                                      webhook_url(clist.external_id,
+                                                  base_url))
+    clist.webhook_since = timezone.now()
+    clist.save(update_fields=['webhook_id', 'webhook_since'])
+    return clist
+
+
+def unregister(clist):
+    """Delete the webhook of a list, if any."""
+    if not clist.webhook_id:
+        return clist
+    delete_webhook(clist.external_id, clist.webhook_id)
+    clist.webhook_id = ''
+    clist.webhook_since = None
+    clist.save(update_fields=['webhook_id', 'webhook_since'])
+    return clist
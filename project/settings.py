@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.9/ref/settings/
 """
 
 import os
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -41,6 +42,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE_CLASSES = [
+    'app.metrics.MetricsMiddleware',
+    'app.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -149,6 +152,164 @@ SYNC_STATUS = ('active', )
 if not ONLY_ACTIVE:
     SYNC_STATUS += ('bounced', 'deleted', 'unconfirmed', 'unsubscribed', )
 
+# Maximum number of upstream fetches running concurrently during a sync
+
+SYNC_CONCURRENCY = int(os.getenv('SYNC_CONCURRENCY', 4))
+
+# Number of subscribers fetched per upstream page (createsend allows 10-1000)
+
+SYNC_PAGE_SIZE = int(os.getenv('SYNC_PAGE_SIZE', 1000))
+
+# Number of subscribers written to the db per bulk query during a sync
+
+SYNC_BATCH_SIZE = int(os.getenv('SYNC_BATCH_SIZE', 500))
+
+
+# The URI of the createsend API, if not the default, e.g. that of a local fake
+# server started by `manage.py fake-createsend`.
+
+CREATESEND_BASE_URI = os.getenv('CREATESEND_BASE_URI')
+
+
+# Connections to the createsend API are kept alive and reused, keeping up to
+# UPSTREAM_POOL_SIZE idle connections. Requests time out after
+# UPSTREAM_TIMEOUT seconds.
+
+UPSTREAM_POOL_SIZE = int(os.getenv('UPSTREAM_POOL_SIZE', 10))
+UPSTREAM_TIMEOUT = int(os.getenv('UPSTREAM_TIMEOUT', 30))
+
+# Requests to the createsend API are limited to UPSTREAM_RATE per second, with
+# bursts of up to UPSTREAM_BURST, unless a different rate is set for an API key
+# in UPSTREAM_RATE_LIMITS. Throttled and failed idempotent requests are retried
+# up to UPSTREAM_RETRIES times, waiting UPSTREAM_RETRY_DELAY seconds, doubling
+# on every attempt up to UPSTREAM_MAX_RETRY_DELAY. After
+# UPSTREAM_BREAKER_THRESHOLD consecutive failures, requests fail fast for
+# UPSTREAM_BREAKER_COOLDOWN seconds.
+
+UPSTREAM_RATE = float(os.getenv('UPSTREAM_RATE', 10))
+UPSTREAM_BURST = int(os.getenv('UPSTREAM_BURST', 10))
+UPSTREAM_RATE_LIMITS = {}
+UPSTREAM_RETRIES = int(os.getenv('UPSTREAM_RETRIES', 3))
+UPSTREAM_RETRY_DELAY = float(os.getenv('UPSTREAM_RETRY_DELAY', 0.5))
+UPSTREAM_MAX_RETRY_DELAY = float(os.getenv('UPSTREAM_MAX_RETRY_DELAY', 30))
+UPSTREAM_BREAKER_THRESHOLD = int(os.getenv('UPSTREAM_BREAKER_THRESHOLD', 5))
+UPSTREAM_BREAKER_COOLDOWN = int(os.getenv('UPSTREAM_BREAKER_COOLDOWN', 30))
+
+
+# Subscribers are imported upstream in bulk, IMPORT_BATCH_SIZE at a time (the
+# createsend API accepts up to 1000), while other bulk mutations are sent by
+# up to UPSTREAM_CONCURRENCY concurrent requests.
+
+IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', 1000))
+UPSTREAM_CONCURRENCY = int(os.getenv('UPSTREAM_CONCURRENCY', 4))
+
+
+# Subscription changes are sent upstream by `manage.py drain-outbox`. Failed
+# operations are retried after OUTBOX_RETRY_DELAY seconds, doubling on every
+# attempt up to OUTBOX_MAX_DELAY, and marked as failed after OUTBOX_MAX_ATTEMPTS
+# attempts. Operations being sent are leased to a single worker for
+# OUTBOX_LEASE seconds.
+
+OUTBOX_RETRY_DELAY = int(os.getenv('OUTBOX_RETRY_DELAY', 30))
+OUTBOX_MAX_DELAY = int(os.getenv('OUTBOX_MAX_DELAY', 60 * 60))
+OUTBOX_LEASE = int(os.getenv('OUTBOX_LEASE', 5 * 60))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', 10))
+
+
+# Freshness of locally stored clients, in seconds. Clients older than the TTL
+# are served as is and refreshed in the background, while clients older than
+# the max age are refreshed before being served.
+
+CLIENT_TTL = int(os.getenv('CLIENT_TTL', 5 * 60))
+CLIENT_MAX_AGE = int(os.getenv('CLIENT_MAX_AGE', 24 * 60 * 60))
+
+# Concurrent syncs of the same client wait for the one in progress for up to
+# SYNC_WAIT_TIMEOUT seconds. Syncs across processes are coordinated through
+# lock files kept in SYNC_LOCK_DIR.
+
+SYNC_WAIT_TIMEOUT = int(os.getenv('SYNC_WAIT_TIMEOUT', 10))
+SYNC_LOCK_DIR = os.getenv('SYNC_LOCK_DIR', os.path.join(tempfile.gettempdir(),
+                                                        'campaign-sync'))
+
+
+# Client pages with more than STREAM_THRESHOLD subscriptions are streamed,
+# rendering STREAM_CHUNK_SIZE subscribers at a time.
+
+STREAM_THRESHOLD = int(os.getenv('STREAM_THRESHOLD', 10000))
+STREAM_CHUNK_SIZE = int(os.getenv('STREAM_CHUNK_SIZE', 500))
+
+
+# Cache of rendered client pages. PAGE_CACHE selects the backend, one of
+# "locmem", "file" or "redis". Unlike "locmem", the latter two are shared
+# across processes. "redis" requires a Redis-compatible server listening at
+# REDIS_URL.
+
+PAGE_CACHE = os.getenv('PAGE_CACHE', 'locmem')
+PAGE_CACHE_TIMEOUT = int(os.getenv('PAGE_CACHE_TIMEOUT', 24 * 60 * 60))
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'pages': {
+        'locmem': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'pages',
+        },
+        'file': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.getenv('PAGE_CACHE_DIR', os.path.join(
+                tempfile.gettempdir(), 'campaign-pages'
+            )),
+        },
+        'redis': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL', 'redis://127.0.0.1:6379/0'),
+        },
+    }[PAGE_CACHE],
+}
+
+
+# Pages of the JSON API hold API_PAGE_SIZE items, unless a different limit of
+# up to API_MAX_PAGE_SIZE is requested.
+
+API_PAGE_SIZE = int(os.getenv('API_PAGE_SIZE', 100))
+API_MAX_PAGE_SIZE = int(os.getenv('API_MAX_PAGE_SIZE', 1000))
+
+
+# Single requests are profiled when sent with a PROFILE_HEADER header holding
+# a token printed by `manage.py profile-token`, which is valid for
+# PROFILE_TOKEN_MAX_AGE seconds, or when sampled at the rate set in the admin,
+# which is re-read every PROFILE_RATE_TTL seconds. The latest PROFILE_KEEP
+# profiles are kept.
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+PROFILE_TOKEN_MAX_AGE = int(os.getenv('PROFILE_TOKEN_MAX_AGE', 60 * 60))
+PROFILE_RATE_TTL = int(os.getenv('PROFILE_RATE_TTL', 30))
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', 50))
+
+
+# CSV files of subscribers uploaded for import are kept in IMPORT_DIR, and
+# imported IMPORT_BATCH_SIZE rows at a time.
+
+IMPORT_DIR = os.getenv('IMPORT_DIR', os.path.join(tempfile.gettempdir(),
+                                                  'campaign-imports'))
+
+
+# List webhooks registered by `manage.py webhooks register` POST their events
+# to the app at WEBHOOK_BASE_URL, which has to be reachable by Campaign
+# Monitoring.
+
+WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL', 'http://localhost:8000')
+
+# The metrics of every process are served on /metrics to the comma-separated
+# METRICS_ALLOWED_IPS, and to requests with an "Authorization: Bearer" header
+# holding METRICS_TOKEN, if set.
+
+METRICS_ALLOWED_IPS = os.getenv('METRICS_ALLOWED_IPS',
+                                '127.0.0.1,::1').split(',')
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
 
 # Override configuration with environmental variables
 